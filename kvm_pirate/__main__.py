@@ -1,11 +1,41 @@
 #!/usr/bin/env python3
 
 import argparse
+import os
 import sys
-from typing import NoReturn
+import time
+from typing import List, NoReturn, Optional
 
 from .coredump import generate_coredump
-from .kvm import GuestError, Hypervisor, get_hypervisor
+from .exits import render_top
+from .guestmem import GuestMemory, GuestRam
+from .incremental import apply_delta, generate_delta
+from .kallsyms import (
+    KallsymsError,
+    KernelSymbols,
+    Symbolizer,
+    cache_dir,
+    kernel_symbols,
+)
+from .kdump import KDUMP_COMPRESSORS, generate_kdump
+from .kvm import (
+    MEMSLOT_SOURCES,
+    GuestError,
+    Hypervisor,
+    find_hypervisors,
+    get_hypervisor,
+)
+from .kvm_exits import ExitTracer
+from .kvm_memslots import DEFAULT_WORKERS, get_all_maps
+from .memcache import CachedGuestMemory
+from .memslot_tracker import MemslotTracker, Slot, SlotChange
+from .pageindex import LayoutError
+from .pagetable import PageTableWalker
+from .proc import KvmMapping
+from .profile import DEFAULT_FREQUENCY, sample_guest_rip, write_folded
+from .snapshot import fork_snapshot, generate_precopy_coredump
+from .stream import COMPRESSORS, generate_stream_coredump
+from .throttle import RunDelay, Throttle
 
 
 def die(msg: str) -> NoReturn:
@@ -15,29 +45,469 @@ def die(msg: str) -> NoReturn:
 
 def inspect_vm(args: argparse.Namespace, vm: Hypervisor) -> None:
     slots = vm.get_maps()
+    print(f"memslots from {vm.memslots_from}")
     for slot in slots:
         print(
-            f"vm mem: 0x{slot.start:x} -> 0x{slot.stop:x} (physical 0x{slot.physical_start:x})"
+            f"vm mem: 0x{slot.start:x} -> 0x{slot.stop:x} (physical 0x{slot.physical_start:x}, {slot.page_size // 1024} kB pages)"
         )
+    with GuestRam(vm.pid, slots) as ram:
+        print(f"{ram.mapped}/{len(slots)} memslots can be mapped directly")
+
+
+def dump_memory(
+    args: argparse.Namespace,
+    pid: int,
+    slots: List[KvmMapping],
+    core_path: str,
+    throttle: Optional[Throttle],
+) -> None:
+    if args.format == "kdump" or args.stream or args.incremental:
+        if args.io != "mmap":
+            die("--io only applies to ELF core files")
+        if args.numa:
+            die("--numa only applies to ELF core files")
+        if args.resume:
+            die("--resume only applies to ELF core files")
+    if args.format == "kdump":
+        if args.stream or args.incremental or args.index:
+            die("--format kdump does not support --stream, --incremental or --index")
+        compression = args.compress or "zlib"
+        if compression not in KDUMP_COMPRESSORS:
+            die(f"--format kdump supports {', '.join(KDUMP_COMPRESSORS)} compression")
+        generate_kdump(
+            pid, slots, args.jobs, compression, args.sparse, core_path, throttle
+        )
+    elif args.stream:
+        if args.incremental or args.index:
+            die("--stream only supports full coredumps")
+        compression = args.compress or "none"
+        if compression not in COMPRESSORS:
+            die(f"--stream supports {', '.join(COMPRESSORS)} compression")
+        generate_stream_coredump(
+            pid, slots, args.stream, args.jobs, compression, args.sparse, throttle
+        )
+    elif args.compress:
+        die("--compress requires --stream or --format kdump")
+    elif args.incremental:
+        if args.sparse:
+            die("--sparse is not supported with --incremental")
+        try:
+            generate_delta(pid, slots, args.incremental, args.jobs, core_path, throttle)
+        except LayoutError as err:
+            die(f"Cannot write incremental coredump: {err}")
+    else:
+        try:
+            generate_coredump(
+                pid,
+                slots,
+                args.jobs,
+                args.sparse,
+                core_path,
+                args.index,
+                args.io,
+                args.resume,
+                throttle,
+                args.numa,
+            )
+        except (FileNotFoundError, LayoutError) as err:
+            if not args.resume:
+                raise
+            die(f"Cannot resume {core_path}: {err}")
 
 
 def coredump_vm(args: argparse.Namespace, vm: Hypervisor) -> None:
+    if vm.memslot_source == "proc" and (
+        args.precopy or args.resume or args.incremental or args.index
+    ):
+        # these need the memslot ids or the same slots as earlier dumps
+        die(
+            "--memslots proc does not support --precopy, --resume, --incremental or --index"
+        )
+    slots = vm.get_maps()
+    core_path = f"core.{vm.pid}"
+    if args.precopy:
+        if (
+            args.sparse
+            or args.incremental
+            or args.index
+            or args.stream
+            or args.compress
+            or args.format != "elf"
+            or args.io != "mmap"
+            or args.resume
+            or args.max_bandwidth
+            or args.adaptive
+            or args.numa
+        ):
+            die("--precopy only supports full coredumps")
+        generate_precopy_coredump(vm, slots, args.jobs)
+        return
+
+    throttle = None
+    if args.max_bandwidth or args.adaptive:
+        max_bandwidth = None
+        if args.max_bandwidth:
+            max_bandwidth = args.max_bandwidth * 1024 * 1024
+        # the vCPUs run in the hypervisor, not in a forked snapshot
+        run_delay = RunDelay(vm.pid) if args.adaptive else None
+        throttle = Throttle(max_bandwidth, run_delay)
+        print(f"Throttle: {throttle.describe()}", file=sys.stderr)
+    try:
+        if args.fork:
+            with fork_snapshot(vm, slots) as child:
+                dump_memory(args, child, slots, core_path, throttle)
+        else:
+            dump_memory(args, vm.pid, slots, core_path, throttle)
+    finally:
+        if throttle is not None:
+            print(f"Throttle: {throttle.describe()}", file=sys.stderr)
+            throttle.close()
+
+
+def guest_kernel(args: argparse.Namespace, vm: Hypervisor) -> KernelSymbols:
     slots = vm.get_maps()
-    generate_coredump(vm.pid, slots)
+    if args.cpu >= vm.cpu_count():
+        die(f"VM has only {vm.cpu_count()} vCPUs")
+    with vm.attach() as tracee:
+        sregs = tracee.get_sregs(args.cpu)
+    cache = None if args.no_cache else args.cache_dir
+    with GuestMemory(vm.pid, slots) as memory:
+        try:
+            walker = PageTableWalker.from_sregs(CachedGuestMemory(memory), sregs)
+            kernel = kernel_symbols(walker, cache)
+        except (ValueError, KallsymsError) as err:
+            die(f"Cannot find guest kernel symbols: {err}")
+    source = "cache" if kernel.cached else "guest memory"
+    print(
+        f"Kernel at 0x{kernel.base:x} (KASLR slide 0x{kernel.slide:x}), build id {kernel.build_id}, {len(kernel.symbols)} symbols from {source}",
+        file=sys.stderr,
+    )
+    return kernel
+
+
+def kallsyms_vm(args: argparse.Namespace, vm: Hypervisor) -> None:
+    kernel = guest_kernel(args, vm)
+    if args.output:
+        with open(args.output, "w") as f:
+            kernel.write(f)
+    else:
+        kernel.write(sys.stdout)
+
+
+def profile_vm(args: argparse.Namespace, vm: Hypervisor) -> None:
+    if args.frequency <= 0:
+        die("--frequency must be positive")
+    symbolizer = None if args.no_symbols else Symbolizer(guest_kernel(args, vm))
+    print(
+        f"Sampling guest RIP at {args.frequency} Hz per vCPU for {args.duration}s, press Ctrl-C to stop early",
+        file=sys.stderr,
+    )
+    samples = sample_guest_rip(vm.pid, args.duration, args.frequency)
+    print(f"{sum(samples.values())} samples", file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as f:
+            write_folded(f, samples, symbolizer)
+    else:
+        write_folded(sys.stdout, samples, symbolizer)
+
+
+def top_vm(args: argparse.Namespace, vm: Hypervisor) -> None:
+    if args.interval <= 0:
+        die("--interval must be positive")
+    with ExitTracer(vm.pid) as tracer:
+        previous = tracer.snapshot()
+        last = time.monotonic()
+        iterations = 0
+        try:
+            while args.count is None or iterations < args.count:
+                time.sleep(args.interval)
+                stats = tracer.snapshot()
+                now = time.monotonic()
+                if args.clear:
+                    # move to the top left corner and clear the screen
+                    sys.stdout.write("\033[H\033[2J")
+                else:
+                    sys.stdout.write("\n")
+                render_top(sys.stdout, stats - previous, now - last, args.limit)
+                sys.stdout.flush()
+                previous, last = stats, now
+                iterations += 1
+        except KeyboardInterrupt:
+            pass
+
+
+def inventory(args: argparse.Namespace) -> None:
+    start = time.monotonic()
+    hvs = find_hypervisors()
+    if not hvs:
+        die("No kvm instances found")
+    try:
+        result = get_all_maps(hvs, workers=args.workers)
+    except ValueError as err:
+        die(str(err))
+    for hv in hvs:
+        slots = result.maps.get(hv.pid)
+        if slots is None:
+            print(f"{hv.pid}: {result.errors[hv.pid]}", file=sys.stderr)
+            continue
+        size = sum(slot.size for slot in slots)
+        print(
+            f"{hv.pid}: {hv.cpu_count()} vCPUs, {len(slots)} memslots, {size // (1024 * 1024)} MiB"
+        )
+        for slot in slots:
+            print(
+                f"  0x{slot.physical_start:x}-0x{slot.physical_start + slot.size:x} at 0x{slot.start:x}"
+            )
+    print(
+        f"Inspected {len(result.maps)}/{len(hvs)} VMs in {time.monotonic() - start:.2f}s",
+        file=sys.stderr,
+    )
+
+
+def describe_slot(slot: Optional[Slot]) -> str:
+    if slot is None:
+        return "none"
+    return f"0x{slot.physical_start:x}-0x{slot.physical_start + slot.size:x} at 0x{slot.userspace_addr:x} flags 0x{slot.flags:x}"
+
+
+def print_change(change: SlotChange) -> None:
+    slot = change.new or change.old
+    assert slot is not None
+    print(
+        f"{change.pid}: slot {slot.as_id}:{slot.id} {describe_slot(change.old)} -> {describe_slot(change.new)}",
+        flush=True,
+    )
+
+
+def track_memslots(args: argparse.Namespace) -> None:
+    hvs = []
+    for pid in args.pids:
+        try:
+            hv = get_hypervisor(pid)
+        except GuestError as err:
+            die(f"Cannot access VM {pid}: {err}")
+        if hv is None:
+            die(f"No kvm instance found for pid {pid}")
+        hvs.append(hv)
+    with MemslotTracker(hvs) as tracker:
+        for pid, error in tracker.errors.items():
+            print(f"{pid}: {error}", file=sys.stderr)
+        for pid in tracker.tables:
+            for slot in tracker.slots(pid):
+                print(f"{pid}: slot {slot.as_id}:{slot.id} {describe_slot(slot)}")
+        sys.stdout.flush()
+        tracker.subscribe(print_change)
+        try:
+            while True:
+                tracker.poll(timeout=1.0)
+        except KeyboardInterrupt:
+            pass
+
+
+def apply_delta_file(args: argparse.Namespace) -> None:
+    with open(args.core, "r+b") as core_file, open(args.delta, "rb") as delta_file:
+        try:
+            apply_delta(core_file, delta_file)
+        except LayoutError as err:
+            die(f"Cannot apply {args.delta}: {err}")
+
+
+def add_kallsyms_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--cpu", type=int, default=0, help="vCPU whose page tables are used"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=cache_dir(),
+        help="directory of symbols cached by kernel build id (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="always read symbols from guest memory"
+    )
 
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Inspect KVM-based VMs.")
+    parser.add_argument(
+        "--memslots",
+        choices=MEMSLOT_SOURCES,
+        default="auto",
+        help="read memslots with BPF or derive them from /proc (QEMU on x86_64 only). auto uses /proc for inspect, kallsyms and profile once it matched BPF (default: %(default)s)",
+    )
     subparsers = parser.add_subparsers(
         title="subcommands", description="valid subcommands"
     )
     inspect_parser = subparsers.add_parser("inspect")
-    inspect_parser.set_defaults(func=inspect_vm)
+    inspect_parser.set_defaults(func=inspect_vm, guess_memslots=True)
     inspect_parser.add_argument("pid", type=int)
 
     coredump_parser = subparsers.add_parser("coredump")
     coredump_parser.set_defaults(func=coredump_vm)
     coredump_parser.add_argument("pid", type=int)
+    coredump_parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of threads copying guest memory",
+    )
+    coredump_parser.add_argument(
+        "--sparse",
+        action="store_true",
+        help="skip guest pages never touched by the hypervisor and zero pages",
+    )
+    snapshot_group = coredump_parser.add_mutually_exclusive_group()
+    snapshot_group.add_argument(
+        "--fork",
+        action="store_true",
+        help="copy memory from a forked copy-on-write snapshot of the hypervisor",
+    )
+    snapshot_group.add_argument(
+        "--precopy",
+        action="store_true",
+        help="copy memory while the VM runs and re-copy pages in KVM's dirty log",
+    )
+    coredump_parser.add_argument(
+        "--index",
+        action="store_true",
+        help="also write a page hash index for later incremental coredumps",
+    )
+    coredump_parser.add_argument(
+        "--incremental",
+        metavar="BASE",
+        help="only write pages that changed since BASE (a core file or its index) to core.<pid>.delta",
+    )
+    coredump_parser.add_argument(
+        "--stream",
+        metavar="DEST",
+        help="stream the core to stdout (-) or a Unix socket instead of writing core.<pid>",
+    )
+    coredump_parser.add_argument(
+        "--compress",
+        choices=sorted(set(COMPRESSORS) | set(KDUMP_COMPRESSORS)),
+        help="compression of --stream (default: none) or of kdump pages (default: zlib)",
+    )
+    coredump_parser.add_argument(
+        "--io",
+        choices=["mmap", "uncached", "direct"],
+        default="mmap",
+        help="write through a shared mapping (fastest), or preallocate and drop written data from the page cache (uncached), or bypass it with O_DIRECT (direct)",
+    )
+    coredump_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="only copy the parts missing from core.<pid> according to core.<pid>.journal",
+    )
+    coredump_parser.add_argument(
+        "--max-bandwidth",
+        type=int,
+        metavar="MIB",
+        help="copy at most MIB MiB/s from the hypervisor",
+    )
+    coredump_parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="slow down copying when the run delay of the vCPU threads rises",
+    )
+    coredump_parser.add_argument(
+        "--numa",
+        action="store_true",
+        help="copy each memslot with workers pinned to the NUMA node backing it",
+    )
+    coredump_parser.add_argument(
+        "--format",
+        choices=["elf", "kdump"],
+        default="elf",
+        help="write an ELF core or a kdump-compressed dump as read by crash(8)",
+    )
+
+    kallsyms_parser = subparsers.add_parser(
+        "kallsyms", help="locate the guest kernel and print its symbols"
+    )
+    kallsyms_parser.set_defaults(func=kallsyms_vm, guess_memslots=True)
+    kallsyms_parser.add_argument("pid", type=int)
+    kallsyms_parser.add_argument(
+        "--output", metavar="FILE", help="write the symbols to FILE instead of stdout"
+    )
+    add_kallsyms_arguments(kallsyms_parser)
+
+    profile_parser = subparsers.add_parser(
+        "profile",
+        help="sample the guest instruction pointer and write folded stacks for flamegraphs",
+    )
+    profile_parser.set_defaults(func=profile_vm, guess_memslots=True)
+    profile_parser.add_argument("pid", type=int)
+    profile_parser.add_argument(
+        "--frequency",
+        type=int,
+        default=DEFAULT_FREQUENCY,
+        help="samples per second and vCPU (default: %(default)s)",
+    )
+    profile_parser.add_argument(
+        "--duration",
+        type=float,
+        default=10,
+        help="seconds to sample (default: %(default)s)",
+    )
+    profile_parser.add_argument(
+        "--output", metavar="FILE", help="write the samples to FILE instead of stdout"
+    )
+    profile_parser.add_argument(
+        "--no-symbols",
+        action="store_true",
+        help="write guest addresses instead of kernel symbols",
+    )
+    add_kallsyms_arguments(profile_parser)
+
+    top_parser = subparsers.add_parser(
+        "top", help="show VM exits by reason, vCPU, I/O port and MMIO address"
+    )
+    top_parser.set_defaults(func=top_vm)
+    top_parser.add_argument("pid", type=int)
+    top_parser.add_argument(
+        "--interval",
+        type=float,
+        default=1.0,
+        help="seconds between updates (default: %(default)s)",
+    )
+    top_parser.add_argument(
+        "--count", type=int, help="exit after COUNT updates instead of Ctrl-C"
+    )
+    top_parser.add_argument(
+        "--limit",
+        type=int,
+        default=10,
+        help="rows per table (default: %(default)s)",
+    )
+    top_parser.add_argument(
+        "--no-clear",
+        dest="clear",
+        action="store_false",
+        help="append updates instead of redrawing the screen",
+    )
+
+    inventory_parser = subparsers.add_parser(
+        "inventory", help="list the memslots of all VMs on the host"
+    )
+    inventory_parser.set_defaults(host_func=inventory)
+    inventory_parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="VMs stopped at the same time to read their memslots (default: %(default)s)",
+    )
+
+    track_parser = subparsers.add_parser(
+        "track", help="print memslot changes of VMs as they happen"
+    )
+    track_parser.set_defaults(host_func=track_memslots)
+    track_parser.add_argument("pids", type=int, nargs="+", metavar="pid")
+
+    apply_parser = subparsers.add_parser(
+        "apply-delta", help="replay an incremental coredump onto its base"
+    )
+    apply_parser.set_defaults(offline_func=apply_delta_file)
+    apply_parser.add_argument("core")
+    apply_parser.add_argument("delta")
 
     return parser.parse_args()
 
@@ -45,12 +515,25 @@ def parse_args() -> argparse.Namespace:
 def main() -> None:
     args = parse_args()
 
+    # subcommands that do not need a running VM
+    if "offline_func" in args:
+        args.offline_func(args)
+        return
+    # subcommands that inspect all VMs on the host
+    if "host_func" in args:
+        args.host_func(args)
+        return
+
     try:
         hv = get_hypervisor(args.pid)
     except GuestError as err:
         die(f"Cannot access VM: {err}")
     if hv is None:
         die(f"No kvm instance found for pid {args.pid}")
+    hv.memslot_source = args.memslots
+    # other subcommands write files that depend on the exact memslots
+    if args.memslots == "auto" and "guess_memslots" not in args:
+        hv.memslot_source = "bpf"
     args.func(args, hv)
 
 
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+from dataclasses import dataclass
+from typing import Any, List, Tuple
+
+from .guestmem import GuestMemory
+from .memcache import CachedGuestMemory
+from .pagetable import (
+    CR3_ADDR_MASK,
+    EFER_NXE,
+    PAGE_SHIFT,
+    PTE_ADDR_MASK,
+    PTE_NX,
+    PTE_PRESENT,
+    PTE_PS,
+    PTE_RW,
+    PTE_US,
+    TABLE_BITS,
+    PageTableWalker,
+)
+
+try:
+    import numpy as np
+
+    HAVE_NUMPY = True
+except ImportError:
+    HAVE_NUMPY = False
+
+ENTRIES = 1 << TABLE_BITS
+TABLE_SIZE = ENTRIES * 8
+# page-table pages read with one readv, bounds memory use on large guests
+TABLE_BATCH = 4096
+
+# bits of MappedRanges.flags
+MAP_WRITE = 1
+MAP_USER = 2
+MAP_EXEC = 4
+
+
+@dataclass
+class MappedRanges:
+    """
+    Mapped guest-virtual ranges sorted by address, one array element per
+    range: gva, gpa and size are uint64, flags are MAP_* bits as uint8.
+    """
+
+    gva: Any
+    gpa: Any
+    size: Any
+    flags: Any
+
+    def __len__(self) -> int:
+        return len(self.gva)
+
+    def __iter__(self) -> Any:
+        return zip(
+            self.gva.tolist(),
+            self.gpa.tolist(),
+            self.size.tolist(),
+            self.flags.tolist(),
+        )
+
+
+def _empty() -> Tuple[Any, Any, Any, Any]:
+    return (
+        np.empty(0, np.uint64),
+        np.empty(0, np.uint64),
+        np.empty(0, np.uint64),
+        np.empty(0, np.uint8),
+    )
+
+
+def coalesce(gva: Any, gpa: Any, size: Any, flags: Any) -> Tuple[Any, Any, Any, Any]:
+    """
+    Merges ranges that are contiguous in both address spaces and have the
+    same flags. The ranges have to be sorted by gva.
+    """
+    if len(gva) == 0:
+        return gva, gpa, size, flags
+    end = gva[:-1] + size[:-1]
+    contiguous = (
+        (end == gva[1:])
+        & (gpa[:-1] + size[:-1] == gpa[1:])
+        & (flags[:-1] == flags[1:])
+        # the last page of the address space wraps around
+        & (end != 0)
+    )
+    starts = np.flatnonzero(np.concatenate(([True], ~contiguous)))
+    return gva[starts], gpa[starts], np.add.reduceat(size, starts), flags[starts]
+
+
+def _in_memory(memory: GuestMemory, tables: Any) -> Any:
+    """
+    Returns a mask of the tables inside a memslot. Entries pointing outside of
+    guest RAM (i.e. MMIO) would fail the whole readv.
+    """
+    starts = np.frombuffer(memory.starts, dtype=np.uint64)
+    stops = np.frombuffer(memory.stops, dtype=np.uint64)
+    if len(starts) == 0:
+        return np.zeros(len(tables), dtype=bool)
+    i = np.searchsorted(starts, tables, side="right") - 1
+    valid = i >= 0
+    i = np.maximum(i, 0)
+    return valid & (tables + TABLE_SIZE <= stops[i])
+
+
+def _read_tables(memory: GuestMemory, tables: Any) -> Any:
+    data = b"".join(memory.readv([(int(t), TABLE_SIZE) for t in tables]))
+    return np.frombuffer(data, dtype="<u8").reshape(-1, ENTRIES)
+
+
+def address_space(walker: PageTableWalker) -> MappedRanges:
+    """
+    Returns all mapped ranges of the address space of walker.cr3.
+    The hierarchy is walked level by level: the page-table pages of a level
+    are read in batches with a single readv and all their entries are decoded
+    at once with numpy. Leaves are coalesced into contiguous runs.
+    """
+    if not HAVE_NUMPY:
+        raise RuntimeError("enumerating address spaces requires numpy")
+    memory = walker.memory
+    if isinstance(memory, CachedGuestMemory):
+        # bulk reads would only evict the pages of single-address lookups
+        memory = memory.memory
+    nx = bool(walker.efer & EFER_NXE)
+    all_flags = MAP_WRITE | MAP_USER | MAP_EXEC
+    address_mask = (1 << walker.address_bits) - 1
+    # gva bits above the address width, set for the upper half
+    sign_bits = np.uint64(((1 << 64) - 1) & ~address_mask)
+    half = np.uint64(1 << (walker.address_bits - 1))
+
+    tables = np.array([walker.cr3 & CR3_ADDR_MASK], dtype=np.uint64)
+    bases = np.zeros(1, dtype=np.uint64)
+    parent_flags = np.full(1, all_flags, dtype=np.uint8)
+    leaves: List[Tuple[Any, Any, Any, Any]] = []
+    index_gva = np.arange(ENTRIES, dtype=np.uint64)
+
+    for level in range(walker.levels - 1, -1, -1):
+        shift = PAGE_SHIFT + TABLE_BITS * level
+        page_size = np.uint64(1 << shift)
+        next_tables = []
+        next_bases = []
+        next_flags = []
+        valid = _in_memory(memory, tables)
+        tables, bases, parent_flags = tables[valid], bases[valid], parent_flags[valid]
+        for first in range(0, len(tables), TABLE_BATCH):
+            last = first + TABLE_BATCH
+            entries = _read_tables(memory, tables[first:last])
+            gva = bases[first:last, None] + (index_gva << np.uint64(shift))[None, :]
+            if level == walker.levels - 1:
+                gva = np.where(gva & half != 0, gva | sign_bits, gva)
+            flags = np.broadcast_to(parent_flags[first:last, None], entries.shape)
+            flags = flags & np.where(entries & PTE_RW != 0, all_flags, ~MAP_WRITE)
+            flags = flags & np.where(entries & PTE_US != 0, all_flags, ~MAP_USER)
+            if nx:
+                flags = flags & np.where(entries & PTE_NX != 0, ~MAP_EXEC, all_flags)
+            flags = flags.astype(np.uint8)
+
+            present = entries & PTE_PRESENT != 0
+            if level == 0:
+                leaf = present
+            elif level in (1, 2):
+                leaf = present & (entries & PTE_PS != 0)
+            else:
+                leaf = np.zeros_like(present)
+            address = entries & np.uint64(PTE_ADDR_MASK)
+            leaves.append(
+                coalesce(
+                    gva[leaf],
+                    address[leaf] & ~(page_size - np.uint64(1)),
+                    np.full(int(leaf.sum()), page_size, dtype=np.uint64),
+                    flags[leaf],
+                )
+            )
+            table = present & ~leaf
+            next_tables.append(address[table])
+            next_bases.append(gva[table])
+            next_flags.append(flags[table])
+        if not next_tables:
+            break
+        tables = np.concatenate(next_tables)
+        bases = np.concatenate(next_bases)
+        parent_flags = np.concatenate(next_flags)
+
+    gva, gpa, size, flags = (
+        np.concatenate(arrays) for arrays in zip(_empty(), *leaves)
+    )
+    order = np.argsort(gva, kind="stable")
+    return MappedRanges(*coalesce(gva[order], gpa[order], size[order], flags[order]))
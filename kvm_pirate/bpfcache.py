@@ -0,0 +1,600 @@
+#!/usr/bin/env python3
+
+import contextlib
+import ctypes
+import enum
+import errno
+import fcntl
+import hashlib
+import importlib.util
+import json
+import mmap
+import os
+import re
+import resource
+import select
+import struct
+from dataclasses import asdict, dataclass
+from types import TracebackType
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Type, Union
+
+from .libc import libc
+from .syscalls import SYSCALL_NAMES
+
+BPF_MAP_CREATE = 0
+BPF_MAP_LOOKUP_ELEM = 1
+BPF_MAP_UPDATE_ELEM = 2
+BPF_MAP_GET_NEXT_KEY = 4
+BPF_PROG_LOAD = 5
+
+BPF_PROG_TYPE_KPROBE = 2
+BPF_MAP_TYPE_PERCPU_ARRAY = 6
+BPF_MAP_TYPE_PERCPU_HASH = 5
+BPF_MAP_TYPE_RINGBUF = 27
+
+# bits in the length of ring buffer record headers
+BPF_RINGBUF_BUSY_BIT = 1 << 31
+BPF_RINGBUF_DISCARD_BIT = 1 << 30
+BPF_RINGBUF_HDR_SZ = 8
+
+# BPF_LD | BPF_IMM | BPF_DW, takes two instruction slots
+BPF_LD_IMM64 = 0x18
+BPF_PSEUDO_MAP_FD = 1
+
+PERF_FLAG_FD_CLOEXEC = 1 << 3
+PERF_EVENT_IOC_ENABLE = 0x2400
+PERF_EVENT_IOC_SET_BPF = 0x40042408
+# perf_event_attr.config bit of the kprobe PMU
+KPROBE_RETPROBE = 1
+KPROBE_PMU_TYPE = "/sys/bus/event_source/devices/kprobe/type"
+
+LOG_SIZE = 1 << 20
+CACHE_VERSION = 2
+
+
+class bpf_map_create_attr(ctypes.Structure):
+    _fields_ = [
+        ("map_type", ctypes.c_uint32),
+        ("key_size", ctypes.c_uint32),
+        ("value_size", ctypes.c_uint32),
+        ("max_entries", ctypes.c_uint32),
+        ("map_flags", ctypes.c_uint32),
+    ]
+
+
+class bpf_map_elem_attr(ctypes.Structure):
+    _fields_ = [
+        ("map_fd", ctypes.c_uint32),
+        ("key", ctypes.c_uint64),
+        # next_key for BPF_MAP_GET_NEXT_KEY
+        ("value", ctypes.c_uint64),
+        ("flags", ctypes.c_uint64),
+    ]
+
+
+class bpf_prog_load_attr(ctypes.Structure):
+    _fields_ = [
+        ("prog_type", ctypes.c_uint32),
+        ("insn_cnt", ctypes.c_uint32),
+        ("insns", ctypes.c_uint64),
+        ("license", ctypes.c_uint64),
+        ("log_level", ctypes.c_uint32),
+        ("log_size", ctypes.c_uint32),
+        ("log_buf", ctypes.c_uint64),
+        ("kern_version", ctypes.c_uint32),
+        ("prog_flags", ctypes.c_uint32),
+    ]
+
+
+class perf_event_attr(ctypes.Structure):
+    _fields_ = [
+        ("type", ctypes.c_uint32),
+        ("size", ctypes.c_uint32),
+        ("config", ctypes.c_uint64),
+        ("sample_period", ctypes.c_uint64),
+        ("sample_type", ctypes.c_uint64),
+        ("read_format", ctypes.c_uint64),
+        ("flags", ctypes.c_uint64),
+        ("wakeup_events", ctypes.c_uint32),
+        ("bp_type", ctypes.c_uint32),
+        # kprobe_func for kprobe events
+        ("config1", ctypes.c_uint64),
+        ("config2", ctypes.c_uint64),
+    ]
+
+
+def _syscall(name: str, *args: Any) -> int:
+    ret = libc.syscall(SYSCALL_NAMES[name], *args)
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, f"{name}: {os.strerror(err)}")
+    return int(ret)
+
+
+def _bpf(cmd: int, attr: ctypes.Structure) -> int:
+    return _syscall("bpf", cmd, ctypes.byref(attr), ctypes.c_uint(ctypes.sizeof(attr)))
+
+
+def possible_cpus() -> int:
+    """
+    Per-CPU maps have one value for each possible, not only online, CPU.
+    """
+    with open("/sys/devices/system/cpu/possible") as f:
+        count = 0
+        for cpus in f.read().strip().split(","):
+            first, _, last = cpus.partition("-")
+            count += int(last or first) - int(first) + 1
+        return count
+
+
+def bcc_version() -> str:
+    """
+    Returns the version of the installed bcc without importing it, as
+    importing bcc already loads LLVM.
+    """
+    spec = importlib.util.find_spec("bcc")
+    if spec is None or spec.origin is None:
+        return "none"
+    try:
+        with open(os.path.join(os.path.dirname(spec.origin), "version.py")) as f:
+            match = re.search(r"__version__\s*=\s*['\"]([^'\"]+)", f.read())
+    except OSError:
+        return "unknown"
+    return match.group(1) if match else "unknown"
+
+
+def cache_dir() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "kvm-pirate", "bpf")
+
+
+class CacheDir(enum.Enum):
+    """
+    Stands for cache_dir() in cache arguments, so the directory is looked up
+    when a program is loaded rather than when a module is imported.
+    """
+
+    DEFAULT = "default"
+
+
+# a directory, CacheDir.DEFAULT or None to always compile
+Cache = Union[str, None, CacheDir]
+
+
+def cache_key(text: str, cflags: Sequence[str]) -> str:
+    """
+    Compiled programs depend on the kernel headers, the compiler in bcc and
+    the source.
+    """
+    h = hashlib.sha256()
+    for part in [str(CACHE_VERSION), os.uname().release, bcc_version(), text]:
+        h.update(part.encode())
+        h.update(b"\0")
+    for flag in cflags:
+        h.update(flag.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+@dataclass
+class MapSpec:
+    name: str
+    map_type: int
+    key_size: int
+    value_size: int
+    max_entries: int
+    flags: int
+    # file descriptor of the map in the compiled instructions
+    fd: int
+
+
+@dataclass
+class CompiledProgram:
+    prog_type: int
+    license: str
+    kern_version: int
+    # function name -> instructions
+    functions: Dict[str, bytes]
+    maps: List[MapSpec]
+
+    def save(self, path: str) -> None:
+        data = asdict(self)
+        data["functions"] = {
+            name: insns.hex() for name, insns in self.functions.items()
+        }
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "CompiledProgram":
+        with open(path) as f:
+            data = json.load(f)
+        data["functions"] = {
+            name: bytes.fromhex(insns) for name, insns in data["functions"].items()
+        }
+        data["maps"] = [MapSpec(**spec) for spec in data["maps"]]
+        return cls(**data)
+
+
+def compile_kprobes(
+    text: str, cflags: Sequence[str], functions: Sequence[str]
+) -> CompiledProgram:
+    """
+    Compiles kprobe programs with bcc and returns the instructions of each
+    function and the maps they use.
+    """
+    from bcc import BPF
+    from bcc.libbcc import lib
+
+    lib.bpf_table_name.restype = ctypes.c_char_p
+    lib.bpf_module_license.restype = ctypes.c_char_p
+    lib.bpf_module_kern_version.restype = ctypes.c_uint
+
+    bpf = BPF(text=text, cflags=list(cflags))
+    try:
+        module = bpf.module
+        maps = []
+        for i in range(lib.bpf_num_tables(module)):
+            maps.append(
+                MapSpec(
+                    name=lib.bpf_table_name(module, i).decode(),
+                    map_type=lib.bpf_table_type_id(module, i),
+                    key_size=lib.bpf_table_key_size_id(module, i),
+                    value_size=lib.bpf_table_leaf_size_id(module, i),
+                    max_entries=lib.bpf_table_max_entries_id(module, i),
+                    flags=lib.bpf_table_flags_id(module, i),
+                    fd=lib.bpf_table_fd_id(module, i),
+                )
+            )
+        return CompiledProgram(
+            prog_type=BPF_PROG_TYPE_KPROBE,
+            license=lib.bpf_module_license(module).decode(),
+            kern_version=lib.bpf_module_kern_version(module),
+            functions={name: bpf.dump_func(name) for name in functions},
+            maps=maps,
+        )
+    finally:
+        bpf.cleanup()
+
+
+def relocate(insns: bytes, fds: Dict[int, int]) -> bytes:
+    """
+    Replaces the map file descriptors of the compiling process in map loads
+    with the ones of our maps.
+    """
+    out = bytearray(insns)
+    i = 0
+    while i < len(out):
+        code, regs, off, imm = struct.unpack_from("<BBhi", out, i)
+        if code == BPF_LD_IMM64:
+            if regs >> 4 == BPF_PSEUDO_MAP_FD:
+                struct.pack_into("<BBhi", out, i, code, regs, off, fds[imm])
+            i += 8
+        i += 8
+    return bytes(out)
+
+
+def _raise_memlock() -> None:
+    # maps are charged against RLIMIT_MEMLOCK before Linux 5.11
+    try:
+        resource.setrlimit(
+            resource.RLIMIT_MEMLOCK, (resource.RLIM_INFINITY, resource.RLIM_INFINITY)
+        )
+    except (ValueError, OSError):
+        pass
+
+
+class RingBuffer:
+    """
+    Consumer side of a BPF ring buffer map (Linux 5.8+). The kernel maps the
+    data pages twice in a row, so records that wrap around are contiguous
+    and are decoded straight from the mapping.
+    """
+
+    def __init__(self, fd: int, size: int) -> None:
+        page = mmap.PAGESIZE
+        self.mask = size - 1
+        self.consumer = mmap.mmap(
+            fd, page, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE
+        )
+        try:
+            # producer position page, followed by the data pages
+            self.producer = mmap.mmap(
+                fd, page + 2 * size, mmap.MAP_SHARED, mmap.PROT_READ, offset=page
+            )
+        except BaseException:
+            self.consumer.close()
+            raise
+        self.data = memoryview(self.producer)[page:]
+        self.poller = select.poll()
+        self.poller.register(fd, select.POLLIN)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits up to timeout seconds until records are available.
+        """
+        if self._available():
+            return True
+        ms = None if timeout is None else int(timeout * 1000)
+        return bool(self.poller.poll(ms))
+
+    def _available(self) -> bool:
+        producer = struct.unpack_from("<Q", self.producer, 0)[0]
+        consumer = struct.unpack_from("<Q", self.consumer, 0)[0]
+        return bool(producer != consumer)
+
+    def read_fixed(self, record: struct.Struct) -> List[Tuple[Any, ...]]:
+        """
+        Decodes all committed records, which all have the layout of record,
+        with one iter_unpack over the ring and releases them. The format of
+        record has to start with "<" and match the C struct without padding.
+        """
+        header_size = BPF_RINGBUF_HDR_SZ + record.size
+        stride = (header_size + 7) & ~7
+        # header, record and the padding to the next record
+        full = struct.Struct(
+            "<II" + record.format.lstrip("<") + "x" * (stride - header_size)
+        )
+        consumer = struct.unpack_from("<Q", self.consumer, 0)[0]
+        producer = struct.unpack_from("<Q", self.producer, 0)[0]
+        start = consumer & self.mask
+        end = start + (producer - consumer) // stride * stride
+        records = []
+        with self.data[start:end] as view:
+            for fields in full.iter_unpack(view):
+                length = fields[0]
+                if length & BPF_RINGBUF_BUSY_BIT:
+                    # reserved, but not submitted yet
+                    break
+                size = length & ~(BPF_RINGBUF_BUSY_BIT | BPF_RINGBUF_DISCARD_BIT)
+                if size != record.size:
+                    raise ValueError(f"record of {size} bytes, expected {record.size}")
+                consumer += stride
+                if not length & BPF_RINGBUF_DISCARD_BIT:
+                    records.append(fields[2:])
+        struct.pack_into("<Q", self.consumer, 0, consumer)
+        return records
+
+    def close(self) -> None:
+        self.data.release()
+        self.producer.close()
+        self.consumer.close()
+
+
+class LoadedProgram:
+    """
+    Compiled programs loaded with plain bpf(2) calls, i.e. without bcc and
+    LLVM. Maps are accessed by name.
+    """
+
+    def __init__(self, compiled: CompiledProgram) -> None:
+        _raise_memlock()
+        self.compiled = compiled
+        self.maps: Dict[str, MapSpec] = {}
+        self.map_fds: Dict[str, int] = {}
+        self.fds: List[int] = []
+        self.prog_fds: Dict[str, int] = {}
+        self.ring_buffers: List[RingBuffer] = []
+        try:
+            relocations = {}
+            for spec in compiled.maps:
+                attr = bpf_map_create_attr(
+                    spec.map_type,
+                    spec.key_size,
+                    spec.value_size,
+                    spec.max_entries,
+                    spec.flags,
+                )
+                fd = _bpf(BPF_MAP_CREATE, attr)
+                self.fds.append(fd)
+                self.maps[spec.name] = spec
+                self.map_fds[spec.name] = fd
+                relocations[spec.fd] = fd
+            for name, insns in compiled.functions.items():
+                self.prog_fds[name] = self._load(relocate(insns, relocations))
+        except BaseException:
+            self.close()
+            raise
+
+    def _load(self, insns: bytes) -> int:
+        insn_buf = ctypes.create_string_buffer(insns, len(insns))
+        license = ctypes.create_string_buffer(self.compiled.license.encode())
+        log = ctypes.create_string_buffer(LOG_SIZE)
+        attr = bpf_prog_load_attr(
+            prog_type=self.compiled.prog_type,
+            insn_cnt=len(insns) // 8,
+            insns=ctypes.addressof(insn_buf),
+            license=ctypes.addressof(license),
+            log_level=1,
+            log_size=LOG_SIZE,
+            log_buf=ctypes.addressof(log),
+            kern_version=self.compiled.kern_version,
+        )
+        try:
+            fd = _bpf(BPF_PROG_LOAD, attr)
+        except OSError as e:
+            verifier = log.value.decode(errors="replace")
+            raise OSError(e.errno, f"{e.strerror}\n{verifier}") from e
+        self.fds.append(fd)
+        return fd
+
+    def _attach(self, event: str, fn_name: str, config: int) -> None:
+        with open(KPROBE_PMU_TYPE) as f:
+            pmu_type = int(f.read())
+        name = ctypes.create_string_buffer(event.encode())
+        attr = perf_event_attr(
+            type=pmu_type,
+            size=ctypes.sizeof(perf_event_attr),
+            config=config,
+            config1=ctypes.addressof(name),
+        )
+        fd = _syscall(
+            "perf_event_open", ctypes.byref(attr), -1, 0, -1, PERF_FLAG_FD_CLOEXEC
+        )
+        self.fds.append(fd)
+        fcntl.ioctl(fd, PERF_EVENT_IOC_SET_BPF, self.prog_fds[fn_name])
+        fcntl.ioctl(fd, PERF_EVENT_IOC_ENABLE, 0)
+
+    def attach_kprobe(self, event: str, fn_name: str) -> None:
+        """
+        Attaches fn_name to the kernel function event with the kprobe PMU
+        (Linux 4.17+), so no tracefs is needed.
+        """
+        self._attach(event, fn_name, 0)
+
+    def attach_kretprobe(self, event: str, fn_name: str) -> None:
+        self._attach(event, fn_name, KPROBE_RETPROBE)
+
+    def lookup(self, name: str, key: bytes) -> List[bytes]:
+        """
+        Returns the value of key in the map, one value per possible CPU for
+        per-CPU maps.
+        """
+        spec = self.maps[name]
+        percpu = spec.map_type in (BPF_MAP_TYPE_PERCPU_ARRAY, BPF_MAP_TYPE_PERCPU_HASH)
+        # per-CPU values are padded to 8 bytes
+        stride = (spec.value_size + 7) & ~7 if percpu else spec.value_size
+        cpus = possible_cpus() if percpu else 1
+        key_buf = ctypes.create_string_buffer(key, spec.key_size)
+        value = ctypes.create_string_buffer(stride * cpus)
+        attr = bpf_map_elem_attr(
+            map_fd=self.map_fds[name],
+            key=ctypes.addressof(key_buf),
+            value=ctypes.addressof(value),
+        )
+        _bpf(BPF_MAP_LOOKUP_ELEM, attr)
+        values = []
+        for start in range(0, stride * cpus, stride):
+            end = start + spec.value_size
+            values.append(value.raw[start:end])
+        return values
+
+    def update(self, name: str, key: bytes, value: bytes) -> None:
+        spec = self.maps[name]
+        key_buf = ctypes.create_string_buffer(key, spec.key_size)
+        value_buf = ctypes.create_string_buffer(value, spec.value_size)
+        attr = bpf_map_elem_attr(
+            map_fd=self.map_fds[name],
+            key=ctypes.addressof(key_buf),
+            value=ctypes.addressof(value_buf),
+        )
+        _bpf(BPF_MAP_UPDATE_ELEM, attr)
+
+    def keys(self, name: str) -> Iterator[bytes]:
+        spec = self.maps[name]
+        key = ctypes.create_string_buffer(spec.key_size)
+        next_key = ctypes.create_string_buffer(spec.key_size)
+        # without a key, the first key is returned
+        attr = bpf_map_elem_attr(
+            map_fd=self.map_fds[name], key=0, value=ctypes.addressof(next_key)
+        )
+        while True:
+            try:
+                _bpf(BPF_MAP_GET_NEXT_KEY, attr)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    return
+                raise
+            yield next_key.raw
+            ctypes.memmove(key, next_key, spec.key_size)
+            attr.key = ctypes.addressof(key)
+
+    def items(self, name: str) -> List[Tuple[bytes, List[bytes]]]:
+        """
+        Returns all entries of a hash map. Entries deleted while iterating
+        are skipped.
+        """
+        items = []
+        for key in self.keys(name):
+            try:
+                items.append((key, self.lookup(name, key)))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return items
+
+    def ring_buffer(self, name: str) -> RingBuffer:
+        spec = self.maps[name]
+        assert spec.map_type == BPF_MAP_TYPE_RINGBUF
+        ring = RingBuffer(self.map_fds[name], spec.max_entries)
+        self.ring_buffers.append(ring)
+        return ring
+
+    def close(self) -> None:
+        for ring in self.ring_buffers:
+            ring.close()
+        self.ring_buffers.clear()
+        for fd in reversed(self.fds):
+            os.close(fd)
+        self.fds.clear()
+
+    def __enter__(self) -> "LoadedProgram":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+
+def _load_attached(
+    compiled: CompiledProgram,
+    kprobes: Sequence[Tuple[str, str]],
+    kretprobes: Sequence[Tuple[str, str]],
+) -> LoadedProgram:
+    prog = LoadedProgram(compiled)
+    try:
+        for event, fn_name in kprobes:
+            prog.attach_kprobe(event, fn_name)
+        for event, fn_name in kretprobes:
+            prog.attach_kretprobe(event, fn_name)
+    except BaseException:
+        prog.close()
+        raise
+    return prog
+
+
+def load_kprobes(
+    text: str,
+    cflags: Sequence[str],
+    functions: Sequence[str],
+    directory: Cache = None,
+    kprobes: Sequence[Tuple[str, str]] = (),
+    kretprobes: Sequence[Tuple[str, str]] = (),
+) -> LoadedProgram:
+    """
+    Loads kprobe programs compiled by bcc and attaches them to the
+    (kernel function, program function) pairs in kprobes and kretprobes.
+    With a cache directory, the compiled programs are saved there and later
+    runs load them without compiling. Parameters that change between runs
+    (i.e. pids) should be passed in maps rather than cflags to share the
+    cached programs.
+    """
+    if directory is CacheDir.DEFAULT:
+        directory = cache_dir()
+    if directory is None:
+        compiled = compile_kprobes(text, cflags, functions)
+        return _load_attached(compiled, kprobes, kretprobes)
+    path = os.path.join(directory, f"{cache_key(text, cflags)}.json")
+    try:
+        compiled = CompiledProgram.load(path)
+    except (OSError, ValueError, TypeError, KeyError):
+        pass
+    else:
+        try:
+            return _load_attached(compiled, kprobes, kretprobes)
+        except OSError:
+            # the kernel may reject a program that was compiled for the same
+            # release, i.e. after a config or BTF change
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+    compiled = compile_kprobes(text, cflags, functions)
+    prog = _load_attached(compiled, kprobes, kretprobes)
+    compiled.save(path)
+    return prog
@@ -2,14 +2,61 @@
 
 import sys
 import ctypes
+import dataclasses
+import errno
+import fcntl
+import os
 import resource
 import mmap
-from typing import IO, List, NoReturn
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import IO, Generator, List, NoReturn, Optional, Tuple
 
+from . import proc
 from .elf import ELFARCH, ELFCLASS, ELFDATA2, Ehdr, Phdr, Shdr
-from .elf.consts import ELFMAG0, ELFMAG1, ELFMAG2, ELFMAG3, ET_CORE, EV_CURRENT, PT_LOAD
+from .elf.consts import (
+    ELFMAG0,
+    ELFMAG1,
+    ELFMAG2,
+    ELFMAG3,
+    ET_CORE,
+    EV_CURRENT,
+    PN_XNUM,
+    PT_LOAD,
+    SHN_UNDEF,
+    SHT_NULL,
+)
+from .hugepage import advise_hugepages, layout_align
+from .journal import Journal
+from .numa import numa_groups
+from .pageindex import PageIndex
+from .libc import (
+    FALLOC_FL_KEEP_SIZE,
+    FALLOC_FL_PUNCH_HOLE,
+    SYNC_FILE_RANGE_WAIT_AFTER,
+    SYNC_FILE_RANGE_WAIT_BEFORE,
+    SYNC_FILE_RANGE_WRITE,
+    libc,
+)
 from .proc import KvmMapping
-from .libc import libc, iovec
+from .throttle import Throttle
+from .vmcopy import (
+    DEFAULT_CHUNK_SIZE,
+    BatchGroup,
+    Chunk,
+    Progress,
+    WorkerStats,
+    copy_groups,
+    read_chunks,
+    run_groups,
+    split_chunks,
+)
+
+# granularity in which we look for zero pages before checking each page
+ZERO_BLOCK_SIZE = 2 * 1024 * 1024
+_ZERO_BLOCK = bytes(ZERO_BLOCK_SIZE)
 
 
 def die(msg: str) -> NoReturn:
@@ -21,7 +68,15 @@ def page_align(v: int) -> int:
     return (v + resource.getpagesize() - 1) & ~(resource.getpagesize() - 1)
 
 
-def write_corefile(pid: int, core_file: IO[bytes], slots: List[KvmMapping]) -> None:
+def core_headers(slots: List[KvmMapping]) -> Tuple[bytearray, int]:
+    """
+    Returns the ELF header, program headers and, if there are more than
+    PN_XNUM segments, the section header holding the real segment count.
+    The second value is the file offset of the first segment, which is aligned
+    to the huge page size backing the slots (see hugepage.layout_align).
+    Later segments follow back-to-back, so p_align is the base page size:
+    p_offset and p_vaddr of a huge page slot do not agree modulo its page size.
+    """
     ehdr = Ehdr()
     ehdr.e_ident[0] = ELFMAG0
     ehdr.e_ident[1] = ELFMAG1
@@ -35,11 +90,28 @@ def write_corefile(pid: int, core_file: IO[bytes], slots: List[KvmMapping]) -> N
     ehdr.e_phoff = ctypes.sizeof(Ehdr)
     ehdr.e_ehsize = ctypes.sizeof(Ehdr)
     ehdr.e_phentsize = ctypes.sizeof(Phdr)
-    ehdr.e_phnum = len(slots)
     ehdr.e_shentsize = ctypes.sizeof(Shdr)
 
-    section_headers = (Phdr * ehdr.e_phnum)()
-    offset = page_align(ctypes.sizeof(Ehdr) + ctypes.sizeof(section_headers))
+    section_headers = (Phdr * len(slots))()
+    headers_size = ctypes.sizeof(Ehdr) + ctypes.sizeof(section_headers)
+    extnum = None
+    if len(slots) >= PN_XNUM:
+        # same as the kernel's fill_extnum_info()
+        ehdr.e_phnum = PN_XNUM
+        ehdr.e_shoff = headers_size
+        ehdr.e_shnum = 1
+        ehdr.e_shstrndx = SHN_UNDEF
+        extnum = Shdr()
+        extnum.sh_type = SHT_NULL
+        extnum.sh_size = ehdr.e_shnum
+        extnum.sh_link = ehdr.e_shstrndx
+        extnum.sh_info = len(slots)
+        headers_size += ctypes.sizeof(Shdr)
+    else:
+        ehdr.e_phnum = len(slots)
+
+    align = layout_align(slots)
+    offset = (headers_size + align - 1) // align * align
     core_size = offset
     for ph, slot in zip(section_headers, slots):
         # print(f"slot {slot.physical_start:x}: {slot.start:x}-{slot.stop:x}")
@@ -54,30 +126,97 @@ def write_corefile(pid: int, core_file: IO[bytes], slots: List[KvmMapping]) -> N
         ph.p_align = resource.getpagesize()
         core_size += slot.size
 
-    src_iovecs = (iovec * len(slots))()
-    dst_iovec = iovec()
+    headers = bytearray(ehdr)
+    headers += bytearray(section_headers)
+    if extnum is not None:
+        headers += bytearray(extnum)
+    return headers, offset
+
+
+def populated_slots(pid: int, slots: List[KvmMapping]) -> List[KvmMapping]:
+    """
+    Splits memslots into the parts that were faulted in by the hypervisor.
+    """
+    populated = []
+    with proc.openpid(pid) as pid_fd:
+        for slot in slots:
+            for start, stop in pid_fd.populated_ranges(slot.start, slot.stop):
+                populated.append(
+                    dataclasses.replace(
+                        slot,
+                        start=start,
+                        stop=stop,
+                        physical_start=slot.physical_start + start - slot.start,
+                    )
+                )
+    return populated
+
+
+def _is_zero(data: bytes) -> bool:
+    if len(data) == ZERO_BLOCK_SIZE:
+        return data == _ZERO_BLOCK
+    return data == bytes(len(data))
+
+
+def zero_ranges(buf: mmap.mmap, chunk: Chunk) -> List[Tuple[int, int]]:
+    """
+    Returns the (start, stop) offsets of zero pages in chunk.
+    Large blocks are compared first, so all-zero areas are detected fast.
+    """
+    page_size = resource.getpagesize()
+    ranges: List[Tuple[int, int]] = []
+
+    def add(start: int, stop: int) -> None:
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], stop)
+        else:
+            ranges.append((start, stop))
+
+    pos = chunk.offset
+    end = chunk.offset + chunk.size
+    while pos < end:
+        block_end = min(pos + ZERO_BLOCK_SIZE, end)
+        if _is_zero(buf[pos:block_end]):
+            add(pos, block_end)
+        else:
+            for page in range(pos, block_end, page_size):
+                page_end = min(page + page_size, block_end)
+                if _is_zero(buf[page:page_end]):
+                    add(page, page_end)
+        pos = block_end
+    return ranges
+
+
+@contextmanager
+def mapped_corefile(
+    core_file: IO[bytes], slots: List[KvmMapping]
+) -> Generator[Tuple[mmap.mmap, int, int], None, None]:
+    """
+    Writes the headers to the core file and maps the area behind them.
+    Yields the mapping, its address and its file offset. The memslots are
+    placed back-to-back starting at offset 0 of the mapping.
+    """
+    assert len(slots) > 0
+    headers, offset = core_headers(slots)
+    core_size = offset + sum(slot.size for slot in slots)
 
     core_file.truncate(core_size)
-    core_file.write(bytearray(ehdr))
-    core_file.write(bytearray(section_headers))
+    core_file.write(headers)
     core_file.flush()
 
     buf = mmap.mmap(
         core_file.fileno(),
         core_size - offset,
         mmap.MAP_SHARED,
-        mmap.PROT_WRITE,
+        mmap.PROT_READ | mmap.PROT_WRITE,
         offset=offset,
     )
+    if any(slot.page_size > mmap.PAGESIZE for slot in slots):
+        advise_hugepages(buf)
     try:
         c_void = ctypes.c_void_p.from_buffer(buf)  # type: ignore
         ptr = ctypes.addressof(c_void)
-        dst_iovec.iov_base = ptr
-        dst_iovec.iov_len = core_size - offset
-        for iov, slot in zip(src_iovecs, slots):
-            iov.iov_base = slot.start
-            iov.iov_len = slot.size
-        libc.process_vm_readv(pid, dst_iovec, 1, src_iovecs, len(src_iovecs), 0)
+        yield buf, ptr, offset
     finally:
         # gc references to buf so we can close it
         del ptr
@@ -85,10 +224,377 @@ def write_corefile(pid: int, core_file: IO[bytes], slots: List[KvmMapping]) -> N
         buf.close()
 
 
+def print_copy_stats(
+    stats: List[WorkerStats], elapsed: float, jobs: int, file: IO[str] = sys.stdout
+) -> None:
+    for worker in stats:
+        print(worker, file=file)
+    total = sum(worker.bytes for worker in stats)
+    print(
+        f"Copied {total // (1024 * 1024)} MiB in {elapsed:.2f}s with {jobs} workers",
+        file=file,
+    )
+
+
+def core_index(slots: List[KvmMapping]) -> PageIndex:
+    """
+    Returns an empty page index for a core file of the memslots.
+    """
+    _, offset = core_headers(slots)
+    segments = []
+    for slot in slots:
+        segments.append((slot.physical_start, slot.size, offset))
+        offset += slot.size
+    return PageIndex(resource.getpagesize(), segments)
+
+
+@contextmanager
+def core_journal(
+    path: Optional[str], slots: List[KvmMapping], chunk_size: int, resume: bool
+) -> Generator[Optional[Journal], None, None]:
+    """
+    Opens the journal of a core file, it is removed once the core is complete.
+    """
+    if path is None:
+        yield None
+        return
+    layout = core_index(slots).layout
+    if resume:
+        journal = Journal.resume(path, layout)
+    else:
+        journal = Journal.create(path, layout, chunk_size)
+    try:
+        yield journal
+    except BaseException:
+        journal.close()
+        raise
+    journal.remove()
+
+
+def pending_groups(
+    pid: int,
+    slots: List[KvmMapping],
+    chunk_size: int,
+    jobs: int,
+    journal: Optional[Journal],
+    numa: bool,
+) -> Tuple[List[BatchGroup], Progress]:
+    """
+    Returns the batches not yet recorded in the journal, grouped by NUMA node
+    if numa is set, and a progress meter that accounts the others as done.
+    """
+    if numa:
+        groups = numa_groups(pid, slots, 0, chunk_size, jobs)
+        for group in groups:
+            size = sum(c.size for batch in group.batches for c in batch)
+            cpus = "unpinned" if group.cpus is None else f"{len(group.cpus)} CPUs"
+            print(
+                f"NUMA {group.name}: {size // (1024 * 1024)} MiB, {group.jobs} workers, {cpus}"
+            )
+    else:
+        groups = [BatchGroup(split_chunks(slots, 0, chunk_size), jobs)]
+    total = sum(slot.size for slot in slots)
+    todo = 0
+    for group in groups:
+        if journal is not None:
+            group.batches = journal.pending(group.batches)
+        todo += sum(c.size for batch in group.batches for c in batch)
+    return groups, Progress(total, total - todo)
+
+
+def write_corefile(
+    pid: int,
+    core_file: IO[bytes],
+    slots: List[KvmMapping],
+    jobs: int = 1,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    sparse: bool = False,
+    index: bool = False,
+    journal_path: Optional[str] = None,
+    resume: bool = False,
+    throttle: Optional[Throttle] = None,
+    numa: bool = False,
+) -> Optional[PageIndex]:
+    """
+    Writes guest memory of all memslots as PT_LOAD segments to core_file.
+    If index is set, returns the hashes of all written pages.
+    Completed batches are recorded in the journal at journal_path,
+    with resume only the batches missing from it are copied.
+    With numa, each memslot is copied by workers on the node backing it.
+    """
+    if sparse:
+        slots = populated_slots(pid, slots)
+    page_index = core_index(slots) if index else None
+    if not slots:
+        core_file.write(core_headers(slots)[0])
+        return page_index
+
+    with core_journal(
+        journal_path, slots, chunk_size, resume
+    ) as journal, mapped_corefile(core_file, slots) as (buf, ptr, offset):
+        freed = 0
+        lock = threading.Lock()
+        groups, progress = pending_groups(pid, slots, chunk_size, jobs, journal, numa)
+
+        def on_batch(batch: List[Chunk]) -> None:
+            nonlocal freed
+            mode = FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE
+            for chunk in batch:
+                if page_index is not None:
+                    first = chunk.offset
+                    last = first + chunk.size
+                    page_index.update(first, buf[first:last])
+                if not sparse:
+                    continue
+                # zero pages become holes in the core file
+                for start, stop in zero_ranges(buf, chunk):
+                    length = stop - start
+                    libc.fallocate(core_file.fileno(), mode, offset + start, length)
+                    with lock:
+                        freed += length
+            if journal is not None:
+                journal.complete(batch)
+            progress.update(sum(chunk.size for chunk in batch))
+
+        start = time.monotonic()
+        stats = copy_groups(pid, ptr, groups, on_batch, throttle)
+        progress.finish()
+        print_copy_stats(stats, time.monotonic() - start, jobs)
+        if sparse:
+            print(
+                f"Sparse: {len(slots)} segments, {freed // (1024 * 1024)} MiB of zero pages skipped"
+            )
+    return page_index
+
+
+# each worker holds two buffers of this size
+UNCACHED_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def preallocate(fd: int, size: int) -> None:
+    """
+    Allocates the blocks of the file upfront, so the filesystem can lay it out
+    in few extents and does not allocate while we write.
+    """
+    try:
+        libc.fallocate(fd, 0, 0, size)
+    except OSError as err:
+        if err.errno != errno.EOPNOTSUPP:
+            raise
+        os.ftruncate(fd, size)
+
+
+def drop_cache(fd: int, offset: int, size: int) -> None:
+    """
+    Writes back the range and removes it from the page cache.
+    DONTNEED skips dirty pages, so they have to be written first.
+    """
+    flags = SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE
+    flags |= SYNC_FILE_RANGE_WAIT_AFTER
+    libc.sync_file_range(fd, offset, size, flags)
+    os.posix_fadvise(fd, offset, size, os.POSIX_FADV_DONTNEED)
+
+
+def set_direct_io(fd: int) -> bool:
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_DIRECT)
+    except OSError as err:
+        if err.errno != errno.EINVAL:
+            raise
+        return False
+    return True
+
+
+class _Buffer:
+    """
+    Page-aligned buffer as needed by O_DIRECT.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.mem = mmap.mmap(-1, size)
+        # fewer TLB misses while copying into and writing out of the buffer
+        advise_hugepages(self.mem)
+        self._c_char = ctypes.c_char.from_buffer(self.mem)
+        self.addr = ctypes.addressof(self._c_char)
+        self.write: Optional["Future[None]"] = None
+
+    def close(self) -> None:
+        del self._c_char
+        self.mem.close()
+
+
+def write_corefile_uncached(
+    pid: int,
+    core_file: IO[bytes],
+    slots: List[KvmMapping],
+    jobs: int = 1,
+    chunk_size: int = UNCACHED_CHUNK_SIZE,
+    direct: bool = False,
+    sparse: bool = False,
+    index: bool = False,
+    journal_path: Optional[str] = None,
+    resume: bool = False,
+    throttle: Optional[Throttle] = None,
+    numa: bool = False,
+) -> Optional[PageIndex]:
+    """
+    Writes the same core file as write_corefile without filling the page cache.
+    The file is preallocated and written in page-aligned chunks with pwrite.
+    Written ranges are dropped from the page cache, or bypass it with O_DIRECT.
+    Each worker double buffers: it copies the next chunk from the hypervisor
+    while the previous one is still being written.
+    """
+    if sparse:
+        slots = populated_slots(pid, slots)
+    page_index = core_index(slots) if index else None
+    headers, offset = core_headers(slots)
+    core_size = offset + sum(slot.size for slot in slots)
+    fd = core_file.fileno()
+    if not sparse:
+        preallocate(fd, core_size)
+    else:
+        os.ftruncate(fd, core_size)
+    os.pwrite(fd, headers, 0)
+    drop_cache(fd, 0, offset)
+
+    if direct and not set_direct_io(fd):
+        print("Warning: filesystem does not support O_DIRECT", file=sys.stderr)
+        direct = False
+
+    local = threading.local()
+    buffers: List[_Buffer] = []
+    lock = threading.Lock()
+
+    def write(buf: _Buffer, batch: List[Chunk], size: int) -> None:
+        pos = batch[0].offset
+        if page_index is not None:
+            page_index.update(pos, buf.mem[:size])
+        ranges: List[Tuple[int, int]] = [(0, size)]
+        if sparse:
+            # leave zero pages as holes
+            ranges = []
+            last = 0
+            for start, stop in zero_ranges(buf.mem, Chunk(0, 0, size)):
+                if start > last:
+                    ranges.append((last, start))
+                last = stop
+            if last < size:
+                ranges.append((last, size))
+        view = memoryview(buf.mem)
+        for start, stop in ranges:
+            done = start
+            while done < stop:
+                done += os.pwrite(fd, view[done:stop], offset + pos + done)
+        view.release()
+        if not direct:
+            drop_cache(fd, offset + pos, size)
+        if journal is not None:
+            journal.complete(batch)
+        progress.update(size)
+
+    with core_journal(
+        journal_path, slots, chunk_size, resume
+    ) as journal, ThreadPoolExecutor(max_workers=max(jobs, 1)) as writer:
+        groups, progress = pending_groups(pid, slots, chunk_size, jobs, journal, numa)
+
+        def work(batch: List[Chunk]) -> int:
+            if not hasattr(local, "buffers"):
+                local.buffers = [_Buffer(chunk_size), _Buffer(chunk_size)]
+                local.next = 0
+                with lock:
+                    buffers.extend(local.buffers)
+            buf = local.buffers[local.next]
+            local.next ^= 1
+            # wait until the buffer was written before reusing it
+            if buf.write is not None:
+                buf.write.result()
+            pos = batch[0].offset
+            size = sum(chunk.size for chunk in batch)
+            n = read_chunks(pid, buf.addr - pos, batch, throttle)
+            buf.write = writer.submit(write, buf, batch, size)
+            return n
+
+        start = time.monotonic()
+        try:
+            stats = run_groups(work, groups)
+            for buf in buffers:
+                if buf.write is not None:
+                    buf.write.result()
+            progress.finish()
+        finally:
+            for buf in buffers:
+                if buf.write is not None:
+                    buf.write.exception()
+                buf.close()
+        elapsed = time.monotonic() - start
+    print_copy_stats(stats, elapsed, jobs)
+    mode = "O_DIRECT" if direct else "fadvise"
+    print(f"Wrote {core_size // (1024 * 1024)} MiB with {mode} in {elapsed:.2f}s")
+    return page_index
+
+
 # This is not a memory-consitant snapshot because the VM still runs while copying the memory!
 # However we are interested in where the kernel text is for now.
-def generate_coredump(pid: int, maps: List[KvmMapping]) -> None:
-    core_path = f"core.{pid}"
-    print(f"Write {core_path}")
-    with open(core_path, "wb+") as core_file:
-        write_corefile(pid, core_file, maps)
+# Pass the pid of a snapshot.fork_snapshot() child for a consistent copy of private memory.
+def generate_coredump(
+    pid: int,
+    maps: List[KvmMapping],
+    jobs: int = 1,
+    sparse: bool = False,
+    core_path: Optional[str] = None,
+    index: bool = False,
+    io: str = "mmap",
+    resume: bool = False,
+    throttle: Optional[Throttle] = None,
+    numa: bool = False,
+) -> None:
+    """
+    io is "mmap" to write through a shared mapping of the core, "uncached" or
+    "direct" to use write_corefile_uncached without or with O_DIRECT.
+    Progress is recorded in <core_path>.journal until the core is complete,
+    resume continues an interrupted dump from there.
+    """
+    if core_path is None:
+        core_path = f"core.{pid}"
+    journal_path = f"{core_path}.journal"
+    print(f"{'Resume' if resume else 'Write'} {core_path}")
+    # hashes of a resumed core are only complete after reading it back
+    write_index = index and not resume
+    try:
+        with open(core_path, "r+b" if resume else "wb+") as core_file:
+            if io == "mmap":
+                page_index = write_corefile(
+                    pid,
+                    core_file,
+                    maps,
+                    jobs,
+                    sparse=sparse,
+                    index=write_index,
+                    journal_path=journal_path,
+                    resume=resume,
+                    throttle=throttle,
+                    numa=numa,
+                )
+            else:
+                page_index = write_corefile_uncached(
+                    pid,
+                    core_file,
+                    maps,
+                    jobs,
+                    direct=io == "direct",
+                    sparse=sparse,
+                    index=write_index,
+                    journal_path=journal_path,
+                    resume=resume,
+                    throttle=throttle,
+                    numa=numa,
+                )
+            if index and resume:
+                page_index = PageIndex.from_core(core_file, resource.getpagesize())
+    except KeyboardInterrupt:
+        die(f"Interrupted, continue the dump with --resume ({journal_path})")
+    if page_index is not None:
+        print(f"Write {core_path}.index")
+        with open(f"{core_path}.index", "wb") as index_file:
+            page_index.save(index_file)
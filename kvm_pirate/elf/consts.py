@@ -148,6 +148,9 @@ STT_HIOS = 12
 STT_LOPROC = 13
 STT_HIPROC = 15
 
+# Extended program header numbering, see e_phnum
+PN_XNUM = 0xFFFF
+
 # Segment types
 PT_NULL = 0
 PT_LOAD = 1
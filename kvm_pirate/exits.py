@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+import dataclasses
+from dataclasses import dataclass, field
+from typing import IO, Counter, Dict, List, Tuple
+
+# kvm_exit.isa
+ISA_VMX = 1
+ISA_SVM = 2
+
+# the upper bits of VMX exit reasons are flags, i.e. for failed VM entries
+VMX_BASIC_REASON_MASK = 0xFFFF
+
+VMX_EXIT_REASONS = {
+    0: "EXCEPTION_NMI",
+    1: "EXTERNAL_INTERRUPT",
+    2: "TRIPLE_FAULT",
+    3: "INIT_SIGNAL",
+    4: "SIPI_SIGNAL",
+    7: "INTERRUPT_WINDOW",
+    8: "NMI_WINDOW",
+    9: "TASK_SWITCH",
+    10: "CPUID",
+    12: "HLT",
+    13: "INVD",
+    14: "INVLPG",
+    15: "RDPMC",
+    16: "RDTSC",
+    18: "VMCALL",
+    19: "VMCLEAR",
+    20: "VMLAUNCH",
+    21: "VMPTRLD",
+    22: "VMPTRST",
+    23: "VMREAD",
+    24: "VMRESUME",
+    25: "VMWRITE",
+    26: "VMOFF",
+    27: "VMON",
+    28: "CR_ACCESS",
+    29: "DR_ACCESS",
+    30: "IO_INSTRUCTION",
+    31: "MSR_READ",
+    32: "MSR_WRITE",
+    33: "INVALID_STATE",
+    34: "MSR_LOAD_FAIL",
+    36: "MWAIT_INSTRUCTION",
+    37: "MONITOR_TRAP_FLAG",
+    39: "MONITOR_INSTRUCTION",
+    40: "PAUSE_INSTRUCTION",
+    41: "MCE_DURING_VMENTRY",
+    43: "TPR_BELOW_THRESHOLD",
+    44: "APIC_ACCESS",
+    45: "EOI_INDUCED",
+    46: "GDTR_IDTR",
+    47: "LDTR_TR",
+    48: "EPT_VIOLATION",
+    49: "EPT_MISCONFIG",
+    50: "INVEPT",
+    51: "RDTSCP",
+    52: "PREEMPTION_TIMER",
+    53: "INVVPID",
+    54: "WBINVD",
+    55: "XSETBV",
+    56: "APIC_WRITE",
+    57: "RDRAND",
+    58: "INVPCID",
+    59: "VMFUNC",
+    60: "ENCLS",
+    61: "RDSEED",
+    62: "PML_FULL",
+    63: "XSAVES",
+    64: "XRSTORS",
+    67: "UMWAIT",
+    68: "TPAUSE",
+    74: "BUS_LOCK",
+    75: "NOTIFY",
+}
+
+SVM_EXIT_REASONS = {
+    0x060: "INTR",
+    0x061: "NMI",
+    0x062: "SMI",
+    0x063: "INIT",
+    0x064: "VINTR",
+    0x065: "CR0_SEL_WRITE",
+    0x066: "IDTR_READ",
+    0x067: "GDTR_READ",
+    0x068: "LDTR_READ",
+    0x069: "TR_READ",
+    0x06A: "IDTR_WRITE",
+    0x06B: "GDTR_WRITE",
+    0x06C: "LDTR_WRITE",
+    0x06D: "TR_WRITE",
+    0x06E: "RDTSC",
+    0x06F: "RDPMC",
+    0x070: "PUSHF",
+    0x071: "POPF",
+    0x072: "CPUID",
+    0x073: "RSM",
+    0x074: "IRET",
+    0x075: "SWINT",
+    0x076: "INVD",
+    0x077: "PAUSE",
+    0x078: "HLT",
+    0x079: "INVLPG",
+    0x07A: "INVLPGA",
+    0x07B: "IOIO",
+    0x07C: "MSR",
+    0x07D: "TASK_SWITCH",
+    0x07E: "FERR_FREEZE",
+    0x07F: "SHUTDOWN",
+    0x080: "VMRUN",
+    0x081: "VMMCALL",
+    0x082: "VMLOAD",
+    0x083: "VMSAVE",
+    0x084: "STGI",
+    0x085: "CLGI",
+    0x086: "SKINIT",
+    0x087: "RDTSCP",
+    0x088: "ICEBP",
+    0x089: "WBINVD",
+    0x08A: "MONITOR",
+    0x08B: "MWAIT",
+    0x08C: "MWAIT_COND",
+    0x08D: "XSETBV",
+    0x08E: "RDPRU",
+    0x08F: "EFER_WRITE_TRAP",
+    0x0A3: "INVPCID",
+    0x400: "NPF",
+    0x401: "AVIC_INCOMPLETE_IPI",
+    0x402: "AVIC_UNACCELERATED_ACCESS",
+    0x403: "VMGEXIT",
+}
+
+# kvm_mmio.type
+MMIO_TYPES = {0: "read-unsatisfied", 1: "read", 2: "write"}
+
+
+def exit_reason_name(isa: int, reason: int) -> str:
+    if isa == ISA_VMX:
+        basic = reason & VMX_BASIC_REASON_MASK
+        return VMX_EXIT_REASONS.get(basic, f"VMX_{basic}")
+    if isa == ISA_SVM:
+        if reason < 0x20:
+            return f"{'WRITE' if reason & 0x10 else 'READ'}_CR{reason & 0xF}"
+        if reason < 0x40:
+            return f"{'WRITE' if reason & 0x10 else 'READ'}_DR{reason & 0xF}"
+        if reason < 0x60:
+            return f"EXCP_{reason - 0x40}"
+        if 0x90 <= reason < 0xA0:
+            return f"CR{reason - 0x90}_WRITE_TRAP"
+        return SVM_EXIT_REASONS.get(reason, f"SVM_0x{reason:x}")
+    return f"0x{reason:x}"
+
+
+@dataclass
+class ExitStats:
+    """
+    Counters of the VM exits of a hypervisor as read from the BPF maps.
+    All counters are cumulative, subtracting an older snapshot gives the
+    counts of the interval between them.
+    """
+
+    # (vcpu, isa, reason) -> exits
+    exits: Counter[Tuple[int, int, int]] = field(default_factory=Counter)
+    # (isa, reason) -> nanoseconds from the exit to the next entry
+    exit_time: Counter[Tuple[int, int]] = field(default_factory=Counter)
+    # (isa, reason, log2 of nanoseconds) -> exits
+    latency: Counter[Tuple[int, int, int]] = field(default_factory=Counter)
+    # (port, rw) -> accesses
+    pio: Counter[Tuple[int, int]] = field(default_factory=Counter)
+    # (gpa, type) -> accesses
+    mmio: Counter[Tuple[int, int]] = field(default_factory=Counter)
+    # nr -> hypercalls
+    hypercalls: Counter[int] = field(default_factory=Counter)
+
+    def __sub__(self, other: "ExitStats") -> "ExitStats":
+        return ExitStats(
+            **{
+                f.name: getattr(self, f.name) - getattr(other, f.name)
+                for f in dataclasses.fields(self)
+            }
+        )
+
+
+def format_ns(ns: float) -> str:
+    for unit, scale in (("s", 10**9), ("ms", 10**6), ("us", 10**3)):
+        if ns >= scale:
+            return f"{ns / scale:.1f}{unit}"
+    return f"{ns:.0f}ns"
+
+
+def _log2_histogram(buckets: Dict[int, int], width: int = 30) -> List[str]:
+    """
+    Renders log2 buckets as computed by bpf_log2l: bucket n counts values
+    from 2**(n-1) to 2**n - 1.
+    """
+    if not buckets:
+        return []
+    top = max(buckets.values())
+    lines = []
+    for n in range(min(buckets), max(buckets) + 1):
+        count = buckets.get(n, 0)
+        low = 0 if n == 0 else 1 << (n - 1)
+        bar = "*" * (count * width // top)
+        lines.append(f"  {format_ns(low):>8} : {count:<10} |{bar:<{width}}|")
+    return lines
+
+
+def render_top(
+    out: IO[str], stats: ExitStats, interval: float, limit: int = 10
+) -> None:
+    """
+    Writes a top-like summary of the exits in stats, which were counted
+    during interval seconds: exits per reason and vCPU, the busiest
+    I/O ports, MMIO addresses and hypercalls and the exit latency
+    distribution of the most frequent reasons.
+    """
+    total = sum(stats.exits.values())
+    out.write(f"{total / interval:.0f} exits/s\n\n")
+
+    reasons: Counter[Tuple[int, int]] = Counter()
+    vcpus: Counter[int] = Counter()
+    for (vcpu, isa, reason), count in stats.exits.items():
+        reasons[(isa, reason)] += count
+        vcpus[vcpu] += count
+
+    out.write(f"{'REASON':<28}{'EXITS/s':>12}{'AVG LATENCY':>14}{'TIME':>8}\n")
+    for (isa, reason), count in reasons.most_common(limit):
+        exit_time = stats.exit_time[(isa, reason)]
+        share = exit_time / (interval * 10**9) * 100
+        out.write(
+            f"{exit_reason_name(isa, reason):<28}{count / interval:>12.0f}"
+            f"{format_ns(exit_time / count):>14}{share:>7.1f}%\n"
+        )
+
+    out.write(f"\n{'VCPU':<28}{'EXITS/s':>12}\n")
+    for vcpu, count in sorted(vcpus.items()):
+        out.write(f"{vcpu:<28}{count / interval:>12.0f}\n")
+
+    if stats.pio:
+        out.write(f"\n{'PORT':<28}{'ACCESSES/s':>12}\n")
+        for (port, rw), count in stats.pio.most_common(limit):
+            port_name = f"0x{port:x} {'write' if rw else 'read'}"
+            out.write(f"{port_name:<28}{count / interval:>12.0f}\n")
+
+    if stats.mmio:
+        out.write(f"\n{'MMIO ADDRESS':<28}{'ACCESSES/s':>12}\n")
+        for (gpa, mmio_type), count in stats.mmio.most_common(limit):
+            address = f"0x{gpa:x} {MMIO_TYPES.get(mmio_type, str(mmio_type))}"
+            out.write(f"{address:<28}{count / interval:>12.0f}\n")
+
+    if stats.hypercalls:
+        out.write(f"\n{'HYPERCALL':<28}{'CALLS/s':>12}\n")
+        for nr, count in stats.hypercalls.most_common(limit):
+            out.write(f"{nr:<28}{count / interval:>12.0f}\n")
+
+    for isa, reason in [key for key, _ in reasons.most_common(3)]:
+        buckets = {
+            n: count
+            for (i, r, n), count in stats.latency.items()
+            if (i, r) == (isa, reason)
+        }
+        if buckets:
+            out.write(f"\nlatency of {exit_reason_name(isa, reason)}:\n")
+            out.write("\n".join(_log2_histogram(buckets)) + "\n")
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+import bisect
+import ctypes
+import mmap
+import os
+from array import array
+from types import TracebackType
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Type
+
+from . import proc
+from .libc import pidfd_getfd
+from .proc import KvmMapping, Mapping
+from .vmcopy import Chunk, batch_chunks, read_chunks, write_chunks
+
+
+def find_backing_fd(pid_fd: proc.Pid, mapping: Mapping) -> Optional[int]:
+    """
+    Returns the number of a file descriptor in the process that refers to
+    the file behind mapping, i.e. the memfd or hugetlbfs file of guest RAM.
+    """
+    if mapping.inode == 0:
+        return None
+    dev = os.makedev(mapping.major_dev, mapping.minor_dev)
+    for entry in pid_fd.fds():
+        try:
+            st = os.stat(entry.path)
+        except OSError:
+            # closed in the meantime
+            continue
+        if st.st_ino == mapping.inode and st.st_dev == dev:
+            return int(entry.name)
+    return None
+
+
+def map_backing_file(
+    pid: int, pid_fd: proc.Pid, mapping: Mapping, writable: bool = False
+) -> Optional[mmap.mmap]:
+    """
+    Maps the file behind a shared mapping of the hypervisor into our process
+    by duplicating its file descriptor with pidfd_getfd. Returns None for
+    private or anonymous mappings, whose memory is not in any file.
+    """
+    if not mapping.flags & mmap.MAP_SHARED:
+        return None
+    target_fd = find_backing_fd(pid_fd, mapping)
+    if target_fd is None:
+        return None
+    try:
+        pidfd = os.pidfd_open(pid)
+        try:
+            fd = pidfd_getfd(pidfd, target_fd)
+        finally:
+            os.close(pidfd)
+    except OSError:
+        # i.e. kernels before 5.6 or no ptrace permission
+        return None
+    prot = mmap.PROT_READ
+    if writable:
+        prot |= mmap.PROT_WRITE
+    try:
+        return mmap.mmap(fd, mapping.size, mmap.MAP_SHARED, prot, offset=mapping.offset)
+    except (OSError, ValueError):
+        # i.e. the fd was opened read-only or the file shrunk
+        return None
+    finally:
+        os.close(fd)
+
+
+class GuestRam:
+    """
+    Guest RAM of a hypervisor, one entry per memslot. Slots in shared file
+    mappings (memfd, hugetlbfs or shm files) are mapped into our process, so
+    reads are plain loads. Other slots are read with process_vm_readv.
+    """
+
+    def __init__(
+        self,
+        pid: int,
+        slots: List[KvmMapping],
+        writable: bool = False,
+        direct: bool = True,
+    ) -> None:
+        self.pid = pid
+        self.slots = slots
+        self.files: Dict[int, mmap.mmap] = {}
+        self.views: List[Optional[memoryview]] = [None] * len(slots)
+        if not direct:
+            return
+        with proc.openpid(pid) as pid_fd:
+            for i, slot in enumerate(slots):
+                hv_mapping = slot.hv_mapping
+                if hv_mapping.start not in self.files:
+                    mapped = map_backing_file(pid, pid_fd, hv_mapping, writable)
+                    if mapped is None:
+                        continue
+                    self.files[hv_mapping.start] = mapped
+                start = slot.start - hv_mapping.start
+                end = start + slot.size
+                self.views[i] = memoryview(self.files[hv_mapping.start])[start:end]
+
+    @property
+    def mapped(self) -> int:
+        """
+        Number of slots that are accessed without syscalls.
+        """
+        return sum(view is not None for view in self.views)
+
+    def view(self, slot: int) -> Optional[memoryview]:
+        return self.views[slot]
+
+    def _check(self, slot: int, offset: int, size: int) -> None:
+        if offset < 0 or size < 0 or offset + size > self.slots[slot].size:
+            raise ValueError(
+                f"0x{offset:x}+0x{size:x} is outside of memslot {slot} (0x{self.slots[slot].size:x} bytes)"
+            )
+
+    def read(self, slot: int, offset: int, size: int) -> bytes:
+        self._check(slot, offset, size)
+        view = self.views[slot]
+        if view is not None:
+            end = offset + size
+            return view[offset:end].tobytes()
+        buf = ctypes.create_string_buffer(size)
+        chunk = Chunk(self.slots[slot].start + offset, 0, size)
+        read_chunks(self.pid, ctypes.addressof(buf), [chunk])
+        return buf.raw
+
+    def write(self, slot: int, offset: int, data: bytes) -> None:
+        self._check(slot, offset, len(data))
+        view = self.views[slot]
+        if view is not None and not view.readonly:
+            end = offset + len(data)
+            view[offset:end] = data
+            return
+        buf = ctypes.create_string_buffer(data, len(data))
+        chunk = Chunk(self.slots[slot].start + offset, 0, len(data))
+        write_chunks(self.pid, ctypes.addressof(buf), [chunk])
+
+    def close(self) -> None:
+        # views have to be released before their mapping can be closed
+        for view in self.views:
+            if view is not None:
+                view.release()
+        self.views = [None] * len(self.slots)
+        for mapped in self.files.values():
+            mapped.close()
+        self.files.clear()
+
+    def __enter__(self) -> "GuestRam":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+
+class AddressError(Exception):
+    pass
+
+
+def physical_slots(slots: List[KvmMapping]) -> List[KvmMapping]:
+    """
+    Returns the memslots ordered by guest-physical address. Slots overlapping
+    a previous one (i.e. SMRAM in the SMM address space) are left out.
+    """
+    ordered: List[KvmMapping] = []
+    for slot in sorted(slots, key=lambda s: s.physical_start):
+        if (
+            ordered
+            and slot.physical_start < ordered[-1].physical_start + ordered[-1].size
+        ):
+            continue
+        ordered.append(slot)
+    return ordered
+
+
+def _coalesce(chunks: List[Chunk]) -> List[Chunk]:
+    """
+    Merges chunks that are adjacent in both address spaces into one iovec.
+    """
+    merged: List[Chunk] = []
+    for chunk in chunks:
+        if merged:
+            last = merged[-1]
+            if (
+                last.src + last.size == chunk.src
+                and last.offset + last.size == chunk.offset
+            ):
+                merged[-1] = Chunk(last.src, last.offset, last.size + chunk.size)
+                continue
+        merged.append(chunk)
+    return merged
+
+
+class GuestMemory:
+    """
+    Reads and writes guest memory by guest-physical address (gpa). Memslots
+    are looked up with bisect in sorted arrays of their start and stop
+    addresses. Accesses may span adjacent memslots, but not holes between them.
+    readv and writev transfer all ranges of slots that are not mapped
+    directly (see GuestRam) with as few process_vm_readv/writev calls as
+    IOV_MAX allows.
+    """
+
+    def __init__(
+        self,
+        pid: int,
+        slots: List[KvmMapping],
+        writable: bool = False,
+        direct: bool = True,
+    ) -> None:
+        self.pid = pid
+        self.slots = physical_slots(slots)
+        self.starts = array("Q", (slot.physical_start for slot in self.slots))
+        self.stops = array(
+            "Q", (slot.physical_start + slot.size for slot in self.slots)
+        )
+        self.ram = GuestRam(pid, self.slots, writable, direct)
+
+    def slot_index(self, gpa: int) -> int:
+        i = bisect.bisect_right(self.starts, gpa) - 1
+        if i < 0 or gpa >= self.stops[i]:
+            raise AddressError(
+                f"guest-physical address 0x{gpa:x} is not in any memslot"
+            )
+        return i
+
+    def _pieces(self, gpa: int, size: int) -> Iterator[Tuple[int, int, int]]:
+        """
+        Splits a range into (slot, offset in slot, size) pieces.
+        """
+        while size > 0:
+            i = self.slot_index(gpa)
+            offset = gpa - self.starts[i]
+            n = min(size, self.stops[i] - gpa)
+            yield i, offset, n
+            gpa += n
+            size -= n
+
+    def readv(self, ranges: Sequence[Tuple[int, int]]) -> List[bytes]:
+        """
+        Reads many (gpa, size) ranges at once.
+        """
+        total = sum(size for _, size in ranges)
+        data = bytearray(total)
+        buf = (ctypes.c_char * total).from_buffer(data)
+        chunks = []
+        pos = 0
+        for gpa, size in ranges:
+            for i, offset, n in self._pieces(gpa, size):
+                view = self.ram.view(i)
+                if view is not None:
+                    end = offset + n
+                    stop = pos + n
+                    data[pos:stop] = view[offset:end]
+                else:
+                    chunks.append(Chunk(self.slots[i].start + offset, pos, n))
+                pos += n
+        for batch in batch_chunks(_coalesce(chunks)):
+            read_chunks(self.pid, ctypes.addressof(buf), batch)
+        del buf
+
+        result = []
+        pos = 0
+        for _, size in ranges:
+            end = pos + size
+            result.append(bytes(data[pos:end]))
+            pos = end
+        return result
+
+    def read(self, gpa: int, size: int) -> bytes:
+        return self.readv([(gpa, size)])[0]
+
+    def writev(self, writes: Sequence[Tuple[int, bytes]]) -> None:
+        """
+        Writes many (gpa, data) pairs at once.
+        """
+        data = b"".join(payload for _, payload in writes)
+        buf = ctypes.create_string_buffer(data, len(data))
+        chunks = []
+        pos = 0
+        for gpa, payload in writes:
+            for i, offset, n in self._pieces(gpa, len(payload)):
+                view = self.ram.view(i)
+                if view is not None and not view.readonly:
+                    end = offset + n
+                    stop = pos + n
+                    view[offset:end] = data[pos:stop]
+                else:
+                    chunks.append(Chunk(self.slots[i].start + offset, pos, n))
+                pos += n
+        for batch in batch_chunks(_coalesce(chunks)):
+            write_chunks(self.pid, ctypes.addressof(buf), batch)
+
+    def write(self, gpa: int, data: bytes) -> None:
+        self.writev([(gpa, data)])
+
+    def close(self) -> None:
+        self.ram.close()
+
+    def __enter__(self) -> "GuestMemory":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import dataclasses
+import mmap
+import resource
+import struct
+from typing import Dict, List, Optional, Set
+
+from . import proc
+from .proc import PAGEMAP_ENTRY_SIZE, KvmMapping
+
+# see Documentation/admin-guide/mm/pagemap.rst
+KPF_HUGE = 17
+KPF_THP = 22
+PAGEMAP_PFN_MASK = (1 << 55) - 1
+PAGEMAP_PAGE_PRESENT = 1 << 63
+THP_SIZE_PATH = "/sys/kernel/mm/transparent_hugepage/hpage_pmd_size"
+# segments in the core are not aligned beyond this, larger alignments would
+# only add holes to the file
+MAX_LAYOUT_ALIGN = 2 * 1024 * 1024
+# how far into a slot we look for a resident page to check in kpageflags
+KPAGEFLAGS_PROBE_SIZE = 64 * 1024 * 1024
+
+
+def _kb(value: str) -> int:
+    # "2048 kB"
+    return int(value.split()[0]) * 1024
+
+
+def thp_size() -> int:
+    try:
+        with open(THP_SIZE_PATH) as f:
+            return int(f.read())
+    except OSError:
+        return 2 * 1024 * 1024
+
+
+def default_hugetlb_size() -> int:
+    with open("/proc/meminfo") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key == "Hugepagesize":
+                return _kb(value)
+    return thp_size()
+
+
+def hugetlbfs_mounts() -> Set[str]:
+    mounts = set()
+    with open("/proc/mounts") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > 2 and fields[2] == "hugetlbfs":
+                mounts.add(fields[1])
+    return mounts
+
+
+def is_hugetlbfs_path(pathname: str, mounts: Set[str]) -> bool:
+    """
+    Anonymous MAP_HUGETLB mappings show up as "/anon_hugepage", files on
+    hugetlbfs mounts with their path. memfd_create(MFD_HUGETLB) looks like any
+    other memfd, only smaps' KernelPageSize tells them apart.
+    """
+    if pathname.startswith("/anon_hugepage"):
+        return True
+    return any(pathname.startswith(mount.rstrip("/") + "/") for mount in mounts)
+
+
+def kpageflags(pid_fd: proc.Pid, addr: int) -> Optional[int]:
+    """
+    Returns the /proc/kpageflags bits of the page at addr in the process.
+    Returns None if the page is not resident or we lack CAP_SYS_ADMIN,
+    in which case the kernel hides page frame numbers.
+    """
+    page_size = resource.getpagesize()
+    try:
+        with open(pid_fd.entry("pagemap"), "rb", buffering=0) as f:
+            f.seek(addr // page_size * PAGEMAP_ENTRY_SIZE)
+            (entry,) = struct.unpack("=Q", f.read(PAGEMAP_ENTRY_SIZE))
+        pfn = entry & PAGEMAP_PFN_MASK
+        if not entry & PAGEMAP_PAGE_PRESENT or pfn == 0:
+            return None
+        with open("/proc/kpageflags", "rb", buffering=0) as f:
+            f.seek(pfn * 8)
+            (flags,) = struct.unpack("=Q", f.read(8))
+        return int(flags)
+    except (OSError, struct.error):
+        return None
+
+
+def backing_page_size(
+    pid_fd: proc.Pid,
+    slot: KvmMapping,
+    smaps: Dict[str, str],
+    mounts: Set[str],
+) -> int:
+    """
+    Returns the size of the pages backing a memslot: the hugetlbfs page size,
+    the PMD size if transparent huge pages are in use, or the base page size.
+    """
+    page_size = resource.getpagesize()
+    if "KernelPageSize" in smaps:
+        kernel_page_size = _kb(smaps["KernelPageSize"])
+        if kernel_page_size > page_size:
+            return kernel_page_size
+    elif is_hugetlbfs_path(slot.hv_mapping.pathname, mounts):
+        return default_hugetlb_size()
+
+    # anonymous, shmem/memfd and file THP
+    for key in ("AnonHugePages", "ShmemPmdMapped", "FilePmdMapped"):
+        if _kb(smaps.get(key, "0 kB")) > 0:
+            return thp_size()
+    # smaps does not account THPs of private file mappings, so check
+    # the first resident page
+    stop = min(slot.stop, slot.start + KPAGEFLAGS_PROBE_SIZE)
+    ranges = pid_fd.populated_ranges(slot.start, stop)
+    if ranges:
+        flags = kpageflags(pid_fd, ranges[0][0])
+        if flags is not None and flags & (1 << KPF_THP | 1 << KPF_HUGE):
+            return thp_size()
+    return page_size
+
+
+def detect_page_sizes(pid: int, slots: List[KvmMapping]) -> List[KvmMapping]:
+    """
+    Returns the memslots with page_size set to the size of their backing pages.
+    """
+    mounts = hugetlbfs_mounts()
+    with proc.openpid(pid) as pid_fd:
+        smaps = pid_fd.smaps()
+        return [
+            dataclasses.replace(
+                slot,
+                page_size=backing_page_size(
+                    pid_fd, slot, smaps.get(slot.hv_mapping.start, {}), mounts
+                ),
+            )
+            for slot in slots
+        ]
+
+
+def layout_align(slots: List[KvmMapping]) -> int:
+    """
+    Returns the alignment of the first segment in a core file,
+    the largest page size of the slots up to MAX_LAYOUT_ALIGN.
+    """
+    page_size = max((slot.page_size for slot in slots), default=mmap.PAGESIZE)
+    return max(min(page_size, MAX_LAYOUT_ALIGN), mmap.PAGESIZE)
+
+
+def copy_align(slots: List[KvmMapping], chunk_size: int) -> int:
+    """
+    Returns the boundary in the hypervisor's address space at which batches
+    are split: the largest huge page size of the slots, but at most chunk_size.
+    Without huge pages, batches are split anywhere.
+    """
+    page_size = max((slot.page_size for slot in slots), default=mmap.PAGESIZE)
+    if page_size <= mmap.PAGESIZE:
+        return 1
+    return min(page_size, chunk_size)
+
+
+def advise_hugepages(buf: mmap.mmap) -> bool:
+    """
+    Asks for transparent huge pages to back buf. This is a hint: it fails on
+    kernels without THP and filesystems without large folios.
+    """
+    advice = getattr(mmap, "MADV_HUGEPAGE", None)
+    if advice is None:
+        return False
+    try:
+        buf.madvise(advice)
+    except OSError:
+        return False
+    return True
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import ctypes
+import mmap
+import os
+import resource
+import threading
+import time
+from typing import IO, List, Optional
+
+from .coredump import core_index, print_copy_stats
+from .pageindex import INDEX_MAGIC, LayoutError, PageIndex, core_segments
+from .proc import KvmMapping
+from .throttle import Throttle
+from .vmcopy import DEFAULT_CHUNK_SIZE, Chunk, read_chunks, run_batches, split_chunks
+
+DELTA_MAGIC = b"KVMPDLT1"
+
+
+class DeltaHeader(ctypes.LittleEndianStructure):
+    _fields_ = [
+        ("magic", ctypes.c_char * 8),
+        # PageIndex.layout of the core the delta applies to
+        ("layout", ctypes.c_char * 16),
+    ]
+
+
+class DeltaRecord(ctypes.LittleEndianStructure):
+    # followed by size bytes of data
+    _fields_ = [
+        ("offset", ctypes.c_uint64),
+        ("size", ctypes.c_uint64),
+    ]
+
+
+def load_index(path: str) -> PageIndex:
+    """
+    Loads a page index, path is either the index or a core file.
+    For core files we use <path>.index if it exists, or hash the core.
+    """
+    if os.path.exists(f"{path}.index"):
+        path = f"{path}.index"
+    with open(path, "rb") as f:
+        if f.read(len(INDEX_MAGIC)) == INDEX_MAGIC:
+            f.seek(0)
+            return PageIndex.load(f)
+        return PageIndex.from_core(f, resource.getpagesize())
+
+
+def write_delta(
+    pid: int,
+    delta_file: IO[bytes],
+    slots: List[KvmMapping],
+    base: PageIndex,
+    jobs: int = 1,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    throttle: Optional[Throttle] = None,
+) -> PageIndex:
+    """
+    Writes all pages that differ from the base index to delta_file.
+    Returns the index of the new snapshot, which is the base for the next delta.
+    """
+    index = core_index(slots)
+    if index.layout != base.layout or index.page_size != base.page_size:
+        raise LayoutError("memslots do not match the base snapshot")
+    index.hashes[:] = base.hashes
+
+    delta_file.write(bytes(DeltaHeader(DELTA_MAGIC, index.layout)))
+    lock = threading.Lock()
+    changed = 0
+
+    def work(batch: List[Chunk]) -> int:
+        nonlocal changed
+        # batches are contiguous in the core
+        pos = batch[0].offset
+        buf = ctypes.create_string_buffer(sum(chunk.size for chunk in batch))
+        n = read_chunks(pid, ctypes.addressof(buf) - pos, batch, throttle)
+        view = memoryview(buf).cast("B")
+        for start, stop in index.update(pos, view):
+            first = start - pos
+            last = stop - pos
+            record = DeltaRecord(index.data_offset + start, stop - start)
+            with lock:
+                delta_file.write(bytes(record))
+                delta_file.write(view[first:last])
+                changed += stop - start
+        return n
+
+    batches = split_chunks(slots, 0, chunk_size)
+    start = time.monotonic()
+    stats = run_batches(work, batches, jobs)
+    print_copy_stats(stats, time.monotonic() - start, jobs)
+    print(f"Delta: {changed // (1024 * 1024)} MiB changed")
+    return index
+
+
+def _pwrite_all(fd: int, data: bytes, offset: int) -> None:
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def apply_delta(core_file: IO[bytes], delta_file: IO[bytes]) -> None:
+    """
+    Replays a delta onto the core it was taken against.
+    """
+    with mmap.mmap(core_file.fileno(), 0, mmap.MAP_SHARED, mmap.PROT_READ) as core:
+        segments = core_segments(core)
+    page_size = resource.getpagesize()
+    layout = PageIndex(page_size, segments).layout
+    header = DeltaHeader.from_buffer_copy(delta_file.read(ctypes.sizeof(DeltaHeader)))
+    if header.magic != DELTA_MAGIC:
+        raise LayoutError("not a delta file")
+    if header.layout != layout:
+        raise LayoutError("delta was not taken against this core")
+
+    fd = core_file.fileno()
+    while True:
+        data = delta_file.read(ctypes.sizeof(DeltaRecord))
+        if not data:
+            break
+        if len(data) < ctypes.sizeof(DeltaRecord):
+            raise LayoutError("truncated delta file")
+        record = DeltaRecord.from_buffer_copy(data)
+        done = 0
+        while done < record.size:
+            block = delta_file.read(min(record.size - done, DEFAULT_CHUNK_SIZE))
+            if not block:
+                raise LayoutError("truncated delta file")
+            _pwrite_all(fd, block, record.offset + done)
+            done += len(block)
+
+
+def generate_delta(
+    pid: int,
+    maps: List[KvmMapping],
+    base_path: str,
+    jobs: int = 1,
+    core_path: Optional[str] = None,
+    throttle: Optional[Throttle] = None,
+) -> None:
+    if core_path is None:
+        core_path = f"core.{pid}"
+    base = load_index(base_path)
+    delta_path = f"{core_path}.delta"
+    print(f"Write {delta_path}")
+    with open(delta_path, "wb") as delta_file:
+        index = write_delta(pid, delta_file, maps, base, jobs, throttle=throttle)
+    print(f"Write {delta_path}.index")
+    with open(f"{delta_path}.index", "wb") as index_file:
+        index.save(index_file)
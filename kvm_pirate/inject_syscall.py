@@ -4,9 +4,11 @@ import ctypes
 import os
 import signal
 from contextlib import contextmanager
+from mmap import MAP_ANONYMOUS, MAP_PRIVATE, PROT_READ, PROT_WRITE
 from typing import Any, Generator
 
 from . import cpu, ptrace
+from .libc import iovec, libc
 from .syscalls import SYSCALL_NAMES, SYSCALL_TEXT
 
 
@@ -32,6 +34,10 @@ class Process:
         if os.WIFSTOPPED(status) and os.WEXITSTATUS(status) & ~0x80 == signal.SIGTRAP:
             ptrace.syscall(self.pid)
             _, status = os.waitpid(self.pid, 0)
+            # ptrace event stops (i.e. PTRACE_EVENT_FORK) come before the syscall exit
+            while os.WIFSTOPPED(status) and status >> 16 != 0:
+                ptrace.syscall(self.pid)
+                _, status = os.waitpid(self.pid, 0)
 
         if os.WIFSTOPPED(status):
             result = ptrace.getregs(self.pid)
@@ -57,6 +63,61 @@ class Process:
             self.syscall(SYSCALL_NAMES["ioctl"], fd, request, arg)
         ).value
 
+    def _checked_syscall(self, name: str, *args: Any) -> int:
+        res = ctypes.c_long(self.syscall(SYSCALL_NAMES[name], *args)).value
+        if res < 0:
+            raise SyscallError(-res, f"{name} failed: {os.strerror(-res)}")
+        return res
+
+    def madvise(self, addr: int, length: int, advice: int) -> None:
+        self._checked_syscall("madvise", addr, length, advice)
+
+    def mmap(self, length: int) -> int:
+        """
+        Maps anonymous memory in the process, i.e. for ioctl arguments
+        """
+        # 32-bit architectures only take a struct pointer in the old mmap call
+        name = "mmap2" if "mmap2" in SYSCALL_NAMES else "mmap"
+        prot = PROT_READ | PROT_WRITE
+        flags = MAP_PRIVATE | MAP_ANONYMOUS
+        return self._checked_syscall(name, 0, length, prot, flags, -1, 0)
+
+    def munmap(self, addr: int, length: int) -> None:
+        self._checked_syscall("munmap", addr, length)
+
+    def read(self, addr: int, length: int) -> bytes:
+        buf = ctypes.create_string_buffer(length)
+        local = iovec(ctypes.addressof(buf), length)
+        remote = iovec(addr, length)
+        n = libc.process_vm_readv(self.pid, local, 1, remote, 1, 0)
+        assert n == length, f"short read: {n} != {length}"
+        return buf.raw
+
+    def write(self, addr: int, data: bytes) -> None:
+        buf = ctypes.create_string_buffer(data, len(data))
+        local = iovec(ctypes.addressof(buf), len(data))
+        remote = iovec(addr, len(data))
+        n = libc.process_vm_writev(self.pid, local, 1, remote, 1, 0)
+        assert n == len(data), f"short write: {n} != {len(data)}"
+
+    def fork(self) -> int:
+        """
+        Forks the process and returns the pid of the child.
+        The child is traced by us and stays stopped until it is killed or detached.
+        It has no exit signal, so the process is not interrupted by SIGCHLD, but
+        it has to be reaped with ptrace.WALL.
+        """
+        ptrace.setoptions(self.pid, ptrace.PTRACE_O_TRACECLONE)
+        try:
+            # fork() does not exist on all architectures, clone() does
+            res = self._checked_syscall("clone", 0, 0, 0, 0, 0)
+        finally:
+            ptrace.setoptions(self.pid, 0)
+        # the auto-attached child starts with a SIGSTOP
+        _, status = os.waitpid(res, 0)
+        assert os.WIFSTOPPED(status), "Could not attach to forked child"
+        return res
+
 
 @contextmanager
 def save_regs(pid: int) -> Generator[cpu.user_regs_struct, None, None]:
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import bisect
+import ctypes
+import os
+import threading
+from typing import List, Tuple
+
+from .pageindex import LayoutError
+from .vmcopy import Chunk
+
+JOURNAL_MAGIC = b"KVMPJRN1"
+
+
+class JournalHeader(ctypes.LittleEndianStructure):
+    _fields_ = [
+        ("magic", ctypes.c_char * 8),
+        # PageIndex.layout of the core file
+        ("layout", ctypes.c_char * 16),
+        # chunk size of the dump that created the journal, records are byte
+        # ranges, so a dump can be resumed with a different one
+        ("chunk_size", ctypes.c_uint64),
+    ]
+
+
+class JournalRecord(ctypes.LittleEndianStructure):
+    # a range of the core file that was written
+    _fields_ = [
+        ("offset", ctypes.c_uint64),
+        ("size", ctypes.c_uint64),
+    ]
+
+
+class Journal:
+    """
+    Sidecar file of a core file that records the ranges of completely written
+    batches. Records of a batch are appended with a single write, so a killed
+    dump leaves at most the batches in flight unrecorded.
+    """
+
+    def __init__(self, path: str, fd: int, done: List[Tuple[int, int]]) -> None:
+        self.path = path
+        self.fd = fd
+        # sorted and merged (start, stop) ranges
+        self.done = done
+        self.starts = [start for start, _ in done]
+        self.lock = threading.Lock()
+
+    @classmethod
+    def create(cls, path: str, layout: bytes, chunk_size: int) -> "Journal":
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND)
+        os.write(fd, bytes(JournalHeader(JOURNAL_MAGIC, layout, chunk_size)))
+        return cls(path, fd, [])
+
+    @classmethod
+    def resume(cls, path: str, layout: bytes) -> "Journal":
+        with open(path, "rb") as f:
+            data = f.read()
+        header_size = ctypes.sizeof(JournalHeader)
+        if len(data) < header_size:
+            raise LayoutError(f"{path} is truncated")
+        header = JournalHeader.from_buffer_copy(data)
+        if header.magic != JOURNAL_MAGIC:
+            raise LayoutError(f"{path} is not a journal")
+        if header.layout != layout:
+            raise LayoutError(f"{path} was written for different memslots")
+        # ignore a partially written record at the end
+        count = (len(data) - header_size) // ctypes.sizeof(JournalRecord)
+        records = (JournalRecord * count).from_buffer_copy(data, header_size)
+        os.truncate(path, header_size + ctypes.sizeof(records))
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        done: List[Tuple[int, int]] = []
+        for start, size in sorted((r.offset, r.size) for r in records):
+            if done and done[-1][1] >= start:
+                done[-1] = (done[-1][0], max(done[-1][1], start + size))
+            else:
+                done.append((start, start + size))
+        return cls(path, fd, done)
+
+    def _written(self, chunk: Chunk) -> bool:
+        i = bisect.bisect_right(self.starts, chunk.offset) - 1
+        return i >= 0 and self.done[i][1] >= chunk.offset + chunk.size
+
+    def pending(self, batches: List[List[Chunk]]) -> List[List[Chunk]]:
+        """
+        Returns the batches that were not completely written before.
+        """
+        return [b for b in batches if not all(self._written(c) for c in b)]
+
+    def complete(self, batch: List[Chunk]) -> None:
+        records = (JournalRecord * len(batch))()
+        for record, chunk in zip(records, batch):
+            record.offset = chunk.offset
+            record.size = chunk.size
+        with self.lock:
+            os.write(self.fd, bytes(records))
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    def remove(self) -> None:
+        self.close()
+        os.unlink(self.path)
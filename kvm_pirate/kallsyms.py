@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+
+import bisect
+import os
+import struct
+from dataclasses import dataclass
+from typing import IO, Iterator, List, Optional, Tuple
+
+from .guestmem import AddressError
+from .pagetable import PageFault, PageTableWalker
+
+# canonical kernel addresses have the top bit set with 4- and 5-level paging
+KERNEL_SPACE_START = 1 << 63
+# x86-64 kernel text mapping, KASLR places the kernel anywhere in here
+KERNEL_MAP_START = 0xFFFF_FFFF_8000_0000
+KERNEL_MAP_END = 0xFFFF_FFFF_C000_0000
+# __START_KERNEL with CONFIG_PHYSICAL_START=0x1000000
+DEFAULT_KERNEL_BASE = 0xFFFF_FFFF_8100_0000
+# CONFIG_PHYSICAL_ALIGN
+KERNEL_ALIGN = 2 * 1024 * 1024
+# with page table isolation, the user page tables follow the kernel ones
+PTI_USER_PGTABLE_BIT = 1 << 12
+# the kernel image is read in pieces of this size
+READ_SIZE = 16 * 1024 * 1024
+
+# Elf64_Nhdr of NT_GNU_BUILD_ID with a 20 byte sha1 build id
+BUILD_ID_NOTE = struct.pack("<III", 4, 20, 3) + b"GNU\0"
+BUILD_ID_SIZE = 20
+# kallsyms_token_table holds single characters as tokens for themselves
+TOKEN_DIGITS = b"".join(b"%d\0" % i for i in range(10))
+TOKENS = 256
+# scripts/kallsyms.c aligns each table to 8 bytes
+KALLSYMS_ALIGN = 8
+# the last block of 256 names in kallsyms_names (KSYM_NAME_LEN is 512)
+MAX_NAMES_BLOCK = 256 * 514
+
+CACHE_HEADER = "# kvm-pirate kallsyms"
+
+
+class KallsymsError(Exception):
+    pass
+
+
+@dataclass
+class KernelSymbols:
+    base: int
+    build_id: str
+    # (address, type, name) in the order of kallsyms
+    symbols: List[Tuple[int, str, str]]
+    # offset of the build id note from base
+    note_offset: int
+    cached: bool = False
+
+    @property
+    def slide(self) -> int:
+        return self.base - DEFAULT_KERNEL_BASE
+
+    def write(self, f: IO[str]) -> None:
+        """
+        Writes the symbols in the format of /proc/kallsyms.
+        """
+        for address, symbol_type, name in self.symbols:
+            f.write(f"{address:016x} {symbol_type} {name}\n")
+
+
+def _align(v: int, alignment: int = KALLSYMS_ALIGN) -> int:
+    return (v + alignment - 1) & ~(alignment - 1)
+
+
+def _is_mapped(walker: PageTableWalker, gva: int) -> bool:
+    try:
+        walker.lookup(gva)
+        return True
+    except PageFault:
+        return False
+
+
+def find_kernel(walker: PageTableWalker) -> Tuple[int, int]:
+    """
+    Returns the base address and size of the kernel image, which is the
+    first mapped range in the kernel text mapping. With page table isolation
+    the vCPU may run with the user page tables, so the kernel ones are tried
+    as well.
+    """
+    for cr3 in (walker.cr3, walker.cr3 & ~PTI_USER_PGTABLE_BIT):
+        walker.set_cr3(cr3)
+        for base in range(KERNEL_MAP_START, KERNEL_MAP_END, KERNEL_ALIGN):
+            if _is_mapped(walker, base):
+                end = base + KERNEL_ALIGN
+                while end < KERNEL_MAP_END and _is_mapped(walker, end):
+                    end += KERNEL_ALIGN
+                return base, end - base
+    raise KallsymsError("no kernel found in the kernel text mapping")
+
+
+def read_image(walker: PageTableWalker, base: int, size: int) -> bytes:
+    """
+    Reads the kernel image. Pages the kernel unmapped (i.e. freed init
+    memory or the gaps between text and rodata) read as zeros.
+    """
+    image = bytearray(size)
+    for offset in range(0, size, READ_SIZE):
+        n = min(READ_SIZE, size - offset)
+        end = offset + n
+        try:
+            image[offset:end] = walker.read(base + offset, n)
+            continue
+        except (PageFault, AddressError):
+            pass
+        for page in range(offset, end, 4096):
+            try:
+                stop = page + 4096
+                image[page:stop] = walker.read(base + page, 4096)
+            except (PageFault, AddressError):
+                continue
+    return bytes(image)
+
+
+def find_build_id(image: bytes) -> Tuple[str, int]:
+    """
+    Returns the build id from the .notes section of the kernel and its offset.
+    """
+    offset = image.find(BUILD_ID_NOTE)
+    if offset == -1:
+        raise KallsymsError("kernel has no build id")
+    start = offset + len(BUILD_ID_NOTE)
+    end = start + BUILD_ID_SIZE
+    return image[start:end].hex(), offset
+
+
+def _u32(image: bytes, offset: int) -> int:
+    return int(struct.unpack_from("<I", image, offset)[0])
+
+
+def _u64(image: bytes, offset: int) -> int:
+    return int(struct.unpack_from("<Q", image, offset)[0])
+
+
+def find_token_table(image: bytes) -> Tuple[int, List[bytes], int]:
+    """
+    Returns the offset of kallsyms_token_table, its tokens and the offset of
+    kallsyms_token_index, which holds the offset of each token and is used
+    to verify a match.
+    """
+    pos = image.find(TOKEN_DIGITS)
+    while pos != -1:
+        start = pos
+        for _ in range(ord("0")):
+            start = image.rfind(b"\0", 0, start - 1) + 1
+        if start % KALLSYMS_ALIGN == 0:
+            tokens = []
+            end = start
+            for _ in range(TOKENS):
+                next_end = image.find(b"\0", end)
+                if next_end == -1:
+                    break
+                tokens.append(bytes(image[end:next_end]))
+                end = next_end + 1
+            index = _align(end)
+            offsets = struct.unpack_from(f"<{TOKENS}H", image, index)
+            expected, pos_in_table = [], 0
+            for token in tokens:
+                expected.append(pos_in_table)
+                pos_in_table += len(token) + 1
+            if len(tokens) == TOKENS and list(offsets) == expected:
+                return start, tokens, index
+        pos = image.find(TOKEN_DIGITS, pos + 1)
+    raise KallsymsError("kallsyms_token_table not found")
+
+
+def find_markers(image: bytes, token_table: int) -> Iterator[Tuple[int, List[int]]]:
+    """
+    Yields possible offsets of kallsyms_markers and their markers, the offsets
+    of every 256th name in kallsyms_names. Markers are 32-bit since Linux 6.2,
+    pointer-sized before, and may be followed by padding.
+    """
+    for size in (4, 8):
+        for padding in (0, 4):
+            end = token_table - padding
+            if padding and _u32(image, end) != 0:
+                continue
+            markers: List[int] = []
+            pos = end - size
+            while pos >= 0:
+                value = _u32(image, pos) if size == 4 else _u64(image, pos)
+                # each name takes at least two bytes
+                if markers and value > markers[-1] - 2 * 256:
+                    break
+                markers.append(value)
+                if value == 0:
+                    if pos % KALLSYMS_ALIGN == 0:
+                        yield pos, markers[::-1]
+                    break
+                pos -= size
+
+
+def _entry_length(image: bytes, pos: int) -> Tuple[int, int]:
+    # names longer than 127 tokens have a two byte length since Linux 6.1
+    length = image[pos]
+    if length & 0x80:
+        return (length & 0x7F) | (image[pos + 1] << 7), 2
+    return length, 1
+
+
+def _walk_names(image: bytes, names: int, count: int, markers: List[int]) -> int:
+    """
+    Returns the end of count names starting at names, or -1 if they do not
+    match the markers.
+    """
+    pos = names
+    for i in range(count):
+        if i % 256 == 0 and markers[i // 256] != pos - names:
+            return -1
+        length, header = _entry_length(image, pos)
+        if length == 0:
+            return -1
+        pos += header + length
+    return pos
+
+
+def find_names(
+    image: bytes, markers_offset: int, markers: List[int]
+) -> Tuple[int, int]:
+    """
+    Returns the offset of kallsyms_names and the number of symbols, stored
+    in kallsyms_num_syms right before the names.
+    """
+    last = markers_offset - markers[-1]
+    first = max(last - MAX_NAMES_BLOCK, 0)
+    for names in range(last - last % KALLSYMS_ALIGN, first, -KALLSYMS_ALIGN):
+        count = _u32(image, names - KALLSYMS_ALIGN)
+        if count == 0 or (count + 255) // 256 != len(markers):
+            continue
+        end = _walk_names(image, names, count, markers)
+        if end != -1 and _align(end) == markers_offset:
+            return names, count
+    raise KallsymsError("kallsyms_names not found")
+
+
+def _decode_addresses(
+    image: bytes, offsets: int, count: int, relative_base: int
+) -> List[int]:
+    values = struct.unpack_from(f"<{count}i", image, offsets)
+    if any(value < 0 for value in values):
+        # CONFIG_KALLSYMS_ABSOLUTE_PERCPU: positive offsets are absolute,
+        # negative ones relative to relative_base - 1
+        return [v if v >= 0 else relative_base - 1 - v for v in values]
+    return [relative_base + v for v in values]
+
+
+def find_addresses(
+    image: bytes, base: int, token_index: int, names: int, count: int
+) -> List[int]:
+    """
+    Returns the addresses of the symbols from kallsyms_offsets and
+    kallsyms_relative_base, which follow kallsyms_token_index since
+    Linux 6.4 and precede kallsyms_num_syms before.
+    """
+    offsets_size = _align(4 * count)
+    num_syms = names - KALLSYMS_ALIGN
+    candidates = [
+        _align(token_index + 2 * TOKENS),
+        num_syms - KALLSYMS_ALIGN - offsets_size,
+    ]
+    for offsets in candidates:
+        relative_base_offset = offsets + offsets_size
+        if offsets < 0 or relative_base_offset + 8 > len(image):
+            continue
+        relative_base = _u64(image, relative_base_offset)
+        if KERNEL_MAP_START <= relative_base < KERNEL_MAP_END:
+            return _decode_addresses(image, offsets, count, relative_base)
+    raise KallsymsError(f"kallsyms_offsets not found near 0x{base:x}")
+
+
+def parse_kallsyms(image: bytes, base: int) -> List[Tuple[int, str, str]]:
+    """
+    Reconstructs the symbol table from the compressed kallsyms tables in the
+    kernel image. Only base-relative kallsyms (Linux 4.6 and later) are
+    supported.
+    """
+    token_table, tokens, token_index = find_token_table(image)
+    for markers_offset, markers in find_markers(image, token_table):
+        try:
+            names, count = find_names(image, markers_offset, markers)
+            break
+        except KallsymsError:
+            continue
+    else:
+        raise KallsymsError("kallsyms_markers not found")
+    addresses = find_addresses(image, base, token_index, names, count)
+
+    symbols = []
+    pos = names
+    for address in addresses:
+        length, header = _entry_length(image, pos)
+        start = pos + header
+        pos = start + length
+        name = b"".join(tokens[t] for t in image[start:pos]).decode(errors="replace")
+        symbols.append((address, name[0], name[1:]))
+    return symbols
+
+
+def cache_dir() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "kvm-pirate", "kallsyms")
+
+
+def save_cache(directory: str, kernel: KernelSymbols) -> None:
+    """
+    Saves the symbols relative to the kernel base, so the cache also applies
+    to the same kernel loaded with a different KASLR slide.
+    Absolute (percpu) symbols are saved as they are.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{kernel.build_id}.kallsyms")
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(f"{CACHE_HEADER} note=0x{kernel.note_offset:x}\n")
+        for address, symbol_type, name in kernel.symbols:
+            if address >= kernel.base:
+                f.write(f"r {address - kernel.base:x} {symbol_type} {name}\n")
+            else:
+                f.write(f"a {address:x} {symbol_type} {name}\n")
+    os.replace(tmp, path)
+
+
+def load_cache(
+    directory: str, walker: PageTableWalker, base: int
+) -> Optional[KernelSymbols]:
+    """
+    Returns the cached symbols of the running kernel. The build id of each
+    cached kernel is compared with the note at its offset in the running one,
+    so the kernel image does not have to be read.
+    """
+    try:
+        entries = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return None
+    for entry in entries:
+        build_id, ext = os.path.splitext(entry)
+        if ext != ".kallsyms":
+            continue
+        path = os.path.join(directory, entry)
+        with open(path) as f:
+            header = f.readline()
+            if not header.startswith(CACHE_HEADER):
+                continue
+            note_offset = int(header.split("note=")[1], 16)
+            try:
+                note = walker.read(
+                    base + note_offset, len(BUILD_ID_NOTE) + BUILD_ID_SIZE
+                )
+            except (PageFault, AddressError):
+                continue
+            header_size = len(BUILD_ID_NOTE)
+            if (
+                note[:header_size] != BUILD_ID_NOTE
+                or note[header_size:].hex() != build_id
+            ):
+                continue
+            symbols = []
+            for line in f:
+                kind, value, symbol_type, name = line.rstrip("\n").split(" ", 3)
+                address = int(value, 16)
+                if kind == "r":
+                    address += base
+                symbols.append((address, symbol_type, name))
+        return KernelSymbols(base, build_id, symbols, note_offset, cached=True)
+    return None
+
+
+def kernel_symbols(
+    walker: PageTableWalker, cache: Optional[str] = None
+) -> KernelSymbols:
+    """
+    Locates the guest kernel and its symbols. If cache is a directory,
+    symbols are looked up in and saved to it.
+    """
+    base, size = find_kernel(walker)
+    if cache is not None:
+        cached = load_cache(cache, walker, base)
+        if cached is not None:
+            return cached
+    image = read_image(walker, base, size)
+    build_id, note_offset = find_build_id(image)
+    kernel = KernelSymbols(base, build_id, parse_kallsyms(image, base), note_offset)
+    if cache is not None:
+        save_cache(cache, kernel)
+    return kernel
+
+
+class Symbolizer:
+    """
+    Maps guest kernel addresses to the symbol containing them.
+    """
+
+    def __init__(self, kernel: KernelSymbols) -> None:
+        text = sorted(
+            (address, name)
+            for address, _, name in kernel.symbols
+            if address >= kernel.base
+        )
+        self.addresses = [address for address, _ in text]
+        self.names = [name for _, name in text]
+
+    def symbolize(self, address: int, offset: bool = False) -> str:
+        """
+        Returns "[user]" for user space, the address for kernel addresses
+        outside of the kernel image (i.e. modules) and the symbol name,
+        optionally with the offset into it, otherwise.
+        """
+        if address < KERNEL_SPACE_START:
+            return "[user]"
+        i = bisect.bisect_right(self.addresses, address) - 1
+        # the last symbol marks the end of the image (_end)
+        if i < 0 or i == len(self.addresses) - 1:
+            return f"0x{address:x}"
+        if offset:
+            return f"{self.names[i]}+0x{address - self.addresses[i]:x}"
+        return self.names[i]
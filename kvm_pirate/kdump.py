@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+import ctypes
+import os
+import resource
+import sys
+import time
+import zlib
+from typing import IO, Callable, Dict, List, Optional, Tuple
+
+from .coredump import populated_slots, print_copy_stats
+from .hugepage import copy_align
+from .proc import KvmMapping
+from .throttle import Throttle
+from .vmcopy import DEFAULT_CHUNK_SIZE, Chunk, WorkerStats, batch_chunks, read_ordered
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# see makedumpfile's diskdump_mod.h
+KDUMP_SIGNATURE = b"KDUMP   "
+KDUMP_HEADER_VERSION = 6
+DUMP_DH_COMPRESSED_ZLIB = 0x1
+DUMP_DH_COMPRESSED_ZSTD = 0x20
+# dump level that tells crash excluded pages are zero
+DL_EXCLUDE_ZERO = 0x1
+NEW_UTS_LEN = 64
+
+
+class NewUtsname(ctypes.Structure):
+    _fields_ = [
+        ("sysname", ctypes.c_char * (NEW_UTS_LEN + 1)),
+        ("nodename", ctypes.c_char * (NEW_UTS_LEN + 1)),
+        ("release", ctypes.c_char * (NEW_UTS_LEN + 1)),
+        ("version", ctypes.c_char * (NEW_UTS_LEN + 1)),
+        ("machine", ctypes.c_char * (NEW_UTS_LEN + 1)),
+        ("domainname", ctypes.c_char * (NEW_UTS_LEN + 1)),
+    ]
+
+
+class Timeval(ctypes.Structure):
+    _fields_ = [
+        ("tv_sec", ctypes.c_long),
+        ("tv_usec", ctypes.c_long),
+    ]
+
+
+class DiskDumpHeader(ctypes.Structure):
+    _fields_ = [
+        ("signature", ctypes.c_char * 8),
+        ("header_version", ctypes.c_int),
+        ("utsname", NewUtsname),
+        ("timestamp", Timeval),
+        ("status", ctypes.c_uint),
+        # in bytes
+        ("block_size", ctypes.c_int),
+        # the remaining sizes are in blocks
+        ("sub_hdr_size", ctypes.c_int),
+        ("bitmap_blocks", ctypes.c_uint),
+        ("max_mapnr", ctypes.c_uint),
+        ("total_ram_blocks", ctypes.c_uint),
+        ("device_blocks", ctypes.c_uint),
+        ("written_blocks", ctypes.c_uint),
+        ("current_cpu", ctypes.c_uint),
+        ("nr_cpus", ctypes.c_int),
+    ]
+
+
+class KdumpSubHeader(ctypes.Structure):
+    _fields_ = [
+        ("phys_base", ctypes.c_ulong),
+        ("dump_level", ctypes.c_int),
+        ("split", ctypes.c_int),
+        ("start_pfn", ctypes.c_ulong),
+        ("end_pfn", ctypes.c_ulong),
+        ("offset_vmcoreinfo", ctypes.c_long),
+        ("size_vmcoreinfo", ctypes.c_ulong),
+        ("offset_note", ctypes.c_long),
+        ("size_note", ctypes.c_ulong),
+        ("offset_eraseinfo", ctypes.c_long),
+        ("size_eraseinfo", ctypes.c_ulong),
+        ("start_pfn_64", ctypes.c_ulonglong),
+        ("end_pfn_64", ctypes.c_ulonglong),
+        ("max_mapnr_64", ctypes.c_ulonglong),
+    ]
+
+
+class PageDesc(ctypes.Structure):
+    _fields_ = [
+        # file offset of the page data
+        ("offset", ctypes.c_long),
+        ("size", ctypes.c_uint),
+        ("flags", ctypes.c_uint),
+        ("page_flags", ctypes.c_ulonglong),
+    ]
+
+
+def _zlib(page: bytes) -> bytes:
+    # makedumpfile also trades ratio for speed
+    return zlib.compress(page, 1)
+
+
+def _zstd(page: bytes) -> bytes:
+    return zstandard.ZstdCompressor(level=1).compress(page)  # type: ignore
+
+
+# name -> (compress, page descriptor flag)
+KDUMP_COMPRESSORS: Dict[str, Tuple[Callable[[bytes], bytes], int]] = {
+    "none": (bytes, 0),
+    "zlib": (_zlib, DUMP_DH_COMPRESSED_ZLIB),
+}
+if zstandard is not None:
+    KDUMP_COMPRESSORS["zstd"] = (_zstd, DUMP_DH_COMPRESSED_ZSTD)
+
+
+def set_bits(bitmap: bytearray, first: int, last: int) -> None:
+    """
+    Sets bits first to last - 1, bit n is bit n % 8 of byte n // 8.
+    """
+    while first < last and first % 8 != 0:
+        bitmap[first // 8] |= 1 << (first % 8)
+        first += 1
+    full = last - last % 8
+    if first < full:
+        start = first // 8
+        end = full // 8
+        bitmap[start:end] = b"\xff" * (end - start)
+        first = full
+    while first < last:
+        bitmap[first // 8] |= 1 << (first % 8)
+        first += 1
+
+
+def _blocks(size: int, block_size: int) -> int:
+    return (size + block_size - 1) // block_size
+
+
+def kdump_slots(slots: List[KvmMapping]) -> List[KvmMapping]:
+    """
+    Returns the memslots ordered by guest-physical address. Slots overlapping
+    a previous one (i.e. SMRAM in the SMM address space) are skipped, because
+    each page frame has only a single page in a kdump.
+    """
+    ordered: List[KvmMapping] = []
+    for slot in sorted(slots, key=lambda s: s.physical_start):
+        if ordered:
+            last = ordered[-1]
+            if slot.physical_start < last.physical_start + last.size:
+                print(
+                    f"Warning: skip memslot at 0x{slot.physical_start:x}, it overlaps 0x{last.physical_start:x}",
+                    file=sys.stderr,
+                )
+                continue
+        ordered.append(slot)
+    return ordered
+
+
+def write_kdump(
+    pid: int,
+    f: IO[bytes],
+    slots: List[KvmMapping],
+    jobs: int = 1,
+    compression: str = "zlib",
+    sparse: bool = False,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    throttle: Optional[Throttle] = None,
+) -> List[WorkerStats]:
+    """
+    Writes guest memory in the kdump-compressed format of makedumpfile, which
+    crash(8) reads. Pages are indexed by their guest-physical page frame number.
+    The first bitmap holds all pages in memslots, the second one the pages
+    written to the dump: zero pages are left out and each page is compressed
+    on its own.
+    """
+    compress, compressed_flag = KDUMP_COMPRESSORS[compression]
+    page_size = resource.getpagesize()
+    slots = kdump_slots(slots)
+    max_mapnr = 0
+    if slots:
+        max_mapnr = (slots[-1].physical_start + slots[-1].size) // page_size
+
+    bitmap_size = _blocks(_blocks(max_mapnr, 8), page_size) * page_size
+    valid = bytearray(bitmap_size)
+    dumpable = bytearray(bitmap_size)
+    valid_pages = 0
+    for slot in slots:
+        first = slot.physical_start // page_size
+        set_bits(valid, first, first + slot.size // page_size)
+        valid_pages += slot.size // page_size
+
+    # header, sub header, both bitmaps, page descriptors, page data
+    sub_hdr_size = 1
+    bitmap_blocks = 2 * bitmap_size // page_size
+    desc_offset = (1 + sub_hdr_size + bitmap_blocks) * page_size
+    # leaves room for a descriptor of every page, the unused rest is a hole
+    data_offset = _blocks(
+        desc_offset + valid_pages * ctypes.sizeof(PageDesc), page_size
+    )
+    data_offset *= page_size
+
+    zero_page = bytes(page_size)
+
+    def process(batch: List[Chunk], data: bytes) -> List[Tuple[int, bytes, int]]:
+        # (pfn, data, flags) of non-zero pages
+        pages = []
+        pos = 0
+        for chunk in batch:
+            pfn = chunk.offset // page_size
+            for page_start in range(pos, pos + chunk.size, page_size):
+                page_end = page_start + page_size
+                page = data[page_start:page_end]
+                if page != zero_page:
+                    compressed = compress(page)
+                    if len(compressed) < page_size:
+                        pages.append((pfn, compressed, compressed_flag))
+                    else:
+                        pages.append((pfn, page, 0))
+                pfn += 1
+            pos += chunk.size
+        return pages
+
+    read = slots
+    if sparse:
+        # pages never touched by the hypervisor are zero
+        read = populated_slots(pid, slots)
+    chunks = [Chunk(slot.start, slot.physical_start, slot.size) for slot in read]
+    stats: Dict[str, WorkerStats] = {}
+    fd = f.fileno()
+    data_pos = data_offset
+    batches = batch_chunks(chunks, chunk_size, copy_align(slots, chunk_size))
+    for pages in read_ordered(pid, batches, process, jobs, stats, throttle=throttle):
+        descs = (PageDesc * len(pages))()
+        pos = data_pos
+        for desc, (pfn, page, flags) in zip(descs, pages):
+            set_bits(dumpable, pfn, pfn + 1)
+            desc.offset = pos
+            desc.size = len(page)
+            desc.flags = flags
+            pos += len(page)
+        os.pwrite(fd, b"".join(page for _, page, _ in pages), data_pos)
+        data_pos = pos
+        os.pwrite(fd, bytes(descs), desc_offset)
+        desc_offset += ctypes.sizeof(descs)
+
+    header = DiskDumpHeader()
+    header.signature = KDUMP_SIGNATURE
+    header.header_version = KDUMP_HEADER_VERSION
+    uname = os.uname()
+    header.utsname.sysname = b"Linux"
+    header.utsname.machine = uname.machine.encode()
+    now = time.time()
+    header.timestamp.tv_sec = int(now)
+    header.timestamp.tv_usec = int(now % 1 * 1000000)
+    header.status = compressed_flag
+    header.block_size = page_size
+    header.sub_hdr_size = sub_hdr_size
+    header.bitmap_blocks = bitmap_blocks
+    header.max_mapnr = min(max_mapnr, 0xFFFFFFFF)
+    header.nr_cpus = 1
+
+    sub_header = KdumpSubHeader()
+    sub_header.dump_level = DL_EXCLUDE_ZERO
+    sub_header.end_pfn = max_mapnr
+    sub_header.end_pfn_64 = max_mapnr
+    sub_header.max_mapnr_64 = max_mapnr
+
+    os.pwrite(fd, bytes(header), 0)
+    os.pwrite(fd, bytes(sub_header), page_size)
+    os.pwrite(fd, bytes(valid) + bytes(dumpable), (1 + sub_hdr_size) * page_size)
+    if os.fstat(fd).st_size < data_offset:
+        os.ftruncate(fd, data_offset)
+    return sorted(stats.values(), key=lambda s: s.name)
+
+
+def generate_kdump(
+    pid: int,
+    maps: List[KvmMapping],
+    jobs: int = 1,
+    compression: str = "zlib",
+    sparse: bool = False,
+    core_path: Optional[str] = None,
+    throttle: Optional[Throttle] = None,
+) -> None:
+    if core_path is None:
+        core_path = f"core.{pid}"
+    print(f"Write {core_path} (kdump-compressed, {compression})")
+    start = time.monotonic()
+    with open(core_path, "wb") as f:
+        stats = write_kdump(pid, f, maps, jobs, compression, sparse, throttle=throttle)
+        size = os.fstat(f.fileno()).st_blocks * 512
+    print_copy_stats(stats, time.monotonic() - start, jobs)
+    total = sum(slot.size for slot in maps)
+    print(
+        f"Wrote {size // (1024 * 1024)} MiB for {total // (1024 * 1024)} MiB of memory"
+    )
@@ -3,10 +3,13 @@
 import ctypes
 import os
 import re
+import resource
+import sys
 from contextlib import contextmanager
 from typing import Any, Dict, Generator, List, Optional
 
-from . import inject_syscall, proc
+from . import inject_syscall, proc, procslots
+from .hugepage import detect_page_sizes
 from .kvm_memslots import get_maps
 from .proc import Mapping
 
@@ -35,6 +38,10 @@ GET_SUPPORTED_CPUID = 0xC008AE05
 CPUID_SIGNATURE = 0x40000000
 CPUID_FEATURES = 0x40000001
 SET_CPUID2 = 0x4008AE90
+GET_DIRTY_LOG = 0x4010AE42
+CLEAR_DIRTY_LOG = 0xC018AEC0
+MEM_LOG_DIRTY_PAGES = 0x1
+CAP_MANUAL_DIRTY_LOG_PROTECT2 = 168
 
 
 class GuestError(Exception):
@@ -51,6 +58,28 @@ class UserspaceMemoryRegion(ctypes.Structure):
     ]
 
 
+class DirtyLog(ctypes.Structure):
+    _fields_ = [
+        ("slot", ctypes.c_uint32),
+        ("padding1", ctypes.c_uint32),
+        ("dirty_bitmap", ctypes.c_uint64),
+    ]
+
+
+class ClearDirtyLog(ctypes.Structure):
+    _fields_ = [
+        ("slot", ctypes.c_uint32),
+        ("num_pages", ctypes.c_uint32),
+        ("first_page", ctypes.c_uint64),
+        ("dirty_bitmap", ctypes.c_uint64),
+    ]
+
+
+def dirty_bitmap_size(npages: int) -> int:
+    # the kernel uses an array of longs
+    return (npages + 63) // 64 * 8
+
+
 class Segment(ctypes.Structure):
     _fields_ = [
         ("base", ctypes.c_uint64),
@@ -127,6 +156,27 @@ class Tracee:
     def __init__(self, hypervisor: "Hypervisor", proc: inject_syscall.Process) -> None:
         self.hypervisor = hypervisor
         self.proc = proc
+        self.scratch_addr = 0
+        self.scratch_size = 0
+        self.manual_dirty_log_protect: Optional[bool] = None
+
+    def _scratch(self, size: int) -> int:
+        """
+        Returns memory in the tracee to pass ioctl arguments.
+        It stays mapped until release() is called.
+        """
+        if size > self.scratch_size:
+            self.release()
+            size = (size + resource.getpagesize() - 1) & ~(resource.getpagesize() - 1)
+            self.scratch_addr = self.proc.mmap(size)
+            self.scratch_size = size
+        return self.scratch_addr
+
+    def release(self) -> None:
+        if self.scratch_size != 0:
+            self.proc.munmap(self.scratch_addr, self.scratch_size)
+            self.scratch_addr = 0
+            self.scratch_size = 0
 
     def _vm_ioctl(self, request: int, arg: Any = 0) -> int:
         return self.proc.ioctl(self.hypervisor.vm_fd, request, arg)
@@ -148,13 +198,62 @@ class Tracee:
         except OSError as err:
             raise GuestError("Failed to check extension") from err
 
-    # XXX UserspaceMemoryRegion must be in tracee memory
     def set_user_memory_region(self, region: UserspaceMemoryRegion) -> None:
         try:
-            ptr = ctypes.cast(ctypes.byref(region), ctypes.c_void_p).value
-            self._vm_ioctl(SET_USER_MEMORY_REGION, ptr)
+            ptr = self._scratch(ctypes.sizeof(region))
+            self.proc.write(ptr, bytes(region))
+            res = self._vm_ioctl(SET_USER_MEMORY_REGION, ptr)
         except OSError as err:
             raise GuestError("Failed to set user memory region") from err
+        if res < 0:
+            raise GuestError(f"Failed to set user memory region: {os.strerror(-res)}")
+
+    def get_dirty_log(self, slot: int, npages: int) -> bytes:
+        """
+        Returns the dirty page bitmap of the memslot since the last call.
+        The scratch space holds the DirtyLog, the bitmap and the ClearDirtyLog
+        that passes the same bitmap back.
+        """
+        size = dirty_bitmap_size(npages)
+        log = DirtyLog()
+        log_size = ctypes.sizeof(log)
+        try:
+            ptr = self._scratch(log_size + size + ctypes.sizeof(ClearDirtyLog))
+            log.slot = slot
+            log.dirty_bitmap = ptr + log_size
+            self.proc.write(ptr, bytes(log))
+            res = self._vm_ioctl(GET_DIRTY_LOG, ptr)
+            if res < 0:
+                raise GuestError(f"Failed to get dirty log: {os.strerror(-res)}")
+            bitmap = self.proc.read(ptr + log_size, size)
+        except OSError as err:
+            raise GuestError("Failed to get dirty log") from err
+        self._clear_dirty_log(slot, npages, ptr + log_size + size, ptr + log_size)
+        return bitmap
+
+    def _clear_dirty_log(self, slot: int, npages: int, ptr: int, bitmap: int) -> None:
+        # If the hypervisor enabled KVM_CAP_MANUAL_DIRTY_LOG_PROTECT2 (QEMU
+        # does whenever the kernel supports it), GET_DIRTY_LOG no longer
+        # clears the bitmap and re-protects pages. Whether it is enabled
+        # cannot be queried. Without it, GET_DIRTY_LOG already re-protected
+        # the pages and clearing them again is redundant but harmless.
+        if self.manual_dirty_log_protect is None:
+            supported = self.check_extension(CAP_MANUAL_DIRTY_LOG_PROTECT2)
+            self.manual_dirty_log_protect = supported > 0
+        if not self.manual_dirty_log_protect:
+            return
+        log = ClearDirtyLog()
+        log.slot = slot
+        log.num_pages = npages
+        log.first_page = 0
+        log.dirty_bitmap = bitmap
+        self.proc.write(ptr, bytes(log))
+        try:
+            res = self._vm_ioctl(CLEAR_DIRTY_LOG, ptr)
+        except OSError as err:
+            raise GuestError("Failed to clear dirty log") from err
+        if res < 0:
+            raise GuestError(f"Failed to clear dirty log: {os.strerror(-res)}")
 
     def get_sregs(self, cpu: int) -> Sregs:
         sregs = Sregs()
@@ -165,6 +264,10 @@ class Tracee:
             raise GuestError("Failed to get special registers") from err
 
 
+# where Hypervisor.get_maps reads memslots from
+MEMSLOT_SOURCES = ("auto", "bpf", "proc")
+
+
 # TODO multiple vms
 class Hypervisor:
     def __init__(
@@ -174,17 +277,68 @@ class Hypervisor:
         self.vm_fd = vm_fd
         self.vcpu_fds = vcpu_fds
         self.mappings = mappings
+        self.memslot_source = "auto"
+        # how the memslots of the last get_maps call were found
+        self.memslots_from = ""
 
     @contextmanager
     def attach(self) -> Generator[Tracee, None, None]:
         with inject_syscall.attach(self.pid) as process:
-            yield Tracee(self, process)
+            tracee = Tracee(self, process)
+            try:
+                yield tracee
+            finally:
+                tracee.release()
 
     def cpu_count(self) -> int:
         return len(self.vcpu_fds)
 
     def get_maps(self) -> List[proc.KvmMapping]:
-        return get_maps(self)
+        return detect_page_sizes(self.pid, self._get_maps())
+
+    def _get_maps(self) -> List[proc.KvmMapping]:
+        """
+        Reads the memslots with BPF or derives them from /proc (see
+        procslots). In auto mode the guess is used once it matched the BPF
+        result for this process, or if BPF is not available. Guessed slots
+        only cover guest RAM and have no memslot id or flags, so callers
+        that depend on the exact memslots (i.e. pre-copy, resumed or
+        incremental coredumps) have to use bpf.
+        """
+        guessed = None
+        if self.memslot_source != "bpf":
+            guessed = procslots.guess_maps(self.pid, self.mappings)
+            if self.memslot_source == "proc":
+                if guessed is None:
+                    raise GuestError(
+                        f"Cannot derive the memslots of process {self.pid} from /proc"
+                    )
+                self.memslots_from = "/proc"
+                return guessed
+            cache = procslots.cache_dir()
+            if guessed is not None and procslots.is_verified(cache, self.pid, guessed):
+                self.memslots_from = "/proc (verified with BPF before)"
+                return guessed
+        try:
+            maps = get_maps(self)
+        except Exception:
+            # i.e. no bcc, no kernel headers or no CAP_SYS_ADMIN
+            if guessed is None:
+                raise
+            self.memslots_from = "/proc (BPF failed, not verified)"
+            return guessed
+        self.memslots_from = "BPF"
+        if guessed is None:
+            return maps
+        problems = procslots.verify(guessed, maps)
+        if problems:
+            print(
+                f"memslots derived from /proc do not match BPF: {'; '.join(problems)}",
+                file=sys.stderr,
+            )
+        else:
+            procslots.mark_verified(procslots.cache_dir(), self.pid, guessed)
+        return maps
 
     def exit(self) -> None:
         os.close(self.vm_fd)
@@ -235,3 +389,22 @@ def get_hypervisor(pid: int) -> Optional[Hypervisor]:
     return Hypervisor(
         pid=pid, vm_fd=vm_fds[0], vcpu_fds=list(vcpu_fds.values()), mappings=mappings
     )
+
+
+def find_hypervisors() -> List[Hypervisor]:
+    """
+    Returns all processes on the host with a KVM instance, skipping the ones
+    we cannot access.
+    """
+    hypervisors = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit() or int(name) == os.getpid():
+            continue
+        try:
+            hv = get_hypervisor(int(name))
+        except (OSError, GuestError):
+            # exited in the meantime, no permission or unsupported
+            continue
+        if hv is not None:
+            hypervisors.append(hv)
+    return hypervisors
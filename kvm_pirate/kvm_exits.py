@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+from types import TracebackType
+from typing import Optional, Type
+
+from .exits import ExitStats
+
+MAX_ENTRIES = 10240
+
+bpf_text = """
+struct exit_key_t {
+    u32 vcpu;
+    u32 isa;
+    u32 reason;
+};
+
+struct reason_key_t {
+    u32 isa;
+    u32 reason;
+};
+
+struct latency_key_t {
+    u32 isa;
+    u32 reason;
+    u64 slot;
+};
+
+struct inflight_t {
+    u64 ts;
+    u32 isa;
+    u32 reason;
+};
+
+struct pio_key_t {
+    u32 port;
+    u32 rw;
+};
+
+struct mmio_key_t {
+    u64 gpa;
+    u32 type;
+};
+
+BPF_HASH(exits, struct exit_key_t, u64, MAX_ENTRIES);
+BPF_HASH(exit_time, struct reason_key_t, u64, MAX_ENTRIES);
+BPF_HASH(latency, struct latency_key_t, u64, MAX_ENTRIES);
+BPF_HASH(pio, struct pio_key_t, u64, MAX_ENTRIES);
+BPF_HASH(mmio, struct mmio_key_t, u64, MAX_ENTRIES);
+BPF_HASH(hypercalls, u64, u64, MAX_ENTRIES);
+// vCPU thread -> exit that is currently handled
+BPF_HASH(inflight, u32, struct inflight_t, MAX_ENTRIES);
+
+static inline bool is_target(void) {
+    return bpf_get_current_pid_tgid() >> 32 == TARGET_PID;
+}
+
+TRACEPOINT_PROBE(kvm, kvm_exit) {
+    if (!is_target()) {
+        return 0;
+    }
+    struct exit_key_t key = {};
+    key.vcpu = args->vcpu_id;
+    key.isa = args->isa;
+    key.reason = args->exit_reason;
+    exits.increment(key);
+
+    u32 tid = bpf_get_current_pid_tgid();
+    struct inflight_t exit = {};
+    exit.ts = bpf_ktime_get_ns();
+    exit.isa = args->isa;
+    exit.reason = args->exit_reason;
+    inflight.update(&tid, &exit);
+    return 0;
+}
+
+TRACEPOINT_PROBE(kvm, kvm_entry) {
+    if (!is_target()) {
+        return 0;
+    }
+    u32 tid = bpf_get_current_pid_tgid();
+    struct inflight_t *exit = inflight.lookup(&tid);
+    if (!exit) {
+        return 0;
+    }
+    u64 delta = bpf_ktime_get_ns() - exit->ts;
+
+    struct reason_key_t reason = {};
+    reason.isa = exit->isa;
+    reason.reason = exit->reason;
+    exit_time.increment(reason, delta);
+
+    struct latency_key_t slot = {};
+    slot.isa = exit->isa;
+    slot.reason = exit->reason;
+    slot.slot = bpf_log2l(delta);
+    latency.increment(slot);
+
+    inflight.delete(&tid);
+    return 0;
+}
+
+TRACEPOINT_PROBE(kvm, kvm_pio) {
+    if (!is_target()) {
+        return 0;
+    }
+    struct pio_key_t key = {};
+    key.port = args->port;
+    key.rw = args->rw;
+    pio.increment(key);
+    return 0;
+}
+
+TRACEPOINT_PROBE(kvm, kvm_mmio) {
+    if (!is_target()) {
+        return 0;
+    }
+    struct mmio_key_t key = {};
+    key.gpa = args->gpa;
+    key.type = args->type;
+    mmio.increment(key);
+    return 0;
+}
+
+TRACEPOINT_PROBE(kvm, kvm_hypercall) {
+    if (!is_target()) {
+        return 0;
+    }
+    u64 nr = args->nr;
+    hypercalls.increment(nr);
+    return 0;
+}
+"""
+
+
+class ExitTracer:
+    """
+    Counts the VM exits of a hypervisor in BPF maps. Nothing is sent to
+    userspace per event, the maps are only read by snapshot, so tracing
+    stays cheap at high exit rates. The latency of an exit is the time from
+    kvm_exit to the next kvm_entry of the same vCPU thread, i.e. includes
+    exits handled by the hypervisor in userspace.
+    """
+
+    def __init__(self, pid: int) -> None:
+        from bcc import BPF
+
+        self.bpf = BPF(
+            text=bpf_text,
+            cflags=[f"-DTARGET_PID={pid}", f"-DMAX_ENTRIES={MAX_ENTRIES}"],
+        )
+
+    def snapshot(self) -> ExitStats:
+        stats = ExitStats()
+        for k, v in self.bpf["exits"].items():
+            stats.exits[(k.vcpu, k.isa, k.reason)] = v.value
+        for k, v in self.bpf["exit_time"].items():
+            stats.exit_time[(k.isa, k.reason)] = v.value
+        for k, v in self.bpf["latency"].items():
+            stats.latency[(k.isa, k.reason, k.slot)] = v.value
+        for k, v in self.bpf["pio"].items():
+            stats.pio[(k.port, k.rw)] = v.value
+        for k, v in self.bpf["mmio"].items():
+            stats.mmio[(k.gpa, k.type)] = v.value
+        for k, v in self.bpf["hypercalls"].items():
+            stats.hypercalls[k.value] = v.value
+        return stats
+
+    def close(self) -> None:
+        self.bpf.cleanup()
+
+    def __enter__(self) -> "ExitTracer":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
@@ -1,8 +1,13 @@
 import ctypes
 import resource
-from typing import Any, List, Type
-
-from bcc import BPF
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List
 
 try:
     # for mypy
@@ -11,16 +16,22 @@ except ImportError:
     pass
 
 from . import proc
+from .bpfcache import Cache, CacheDir, LoadedProgram, load_kprobes
 
-DEBUG = True
+# hypervisors that can be inspected at once
+MAX_TARGETS = 1024
+# hypervisors that are stopped concurrently to trigger the probe
+DEFAULT_WORKERS = 32
 
-bpf_text = """
+bpf_text = f"#define MAX_TARGETS {MAX_TARGETS}\n" + """
 #include <linux/kvm_host.h>
 
 struct memslot {
     gfn_t base_gfn;
     unsigned long npages;
     unsigned long userspace_addr;
+    u32 flags;
+    u32 id;
 };
 
 typedef struct {
@@ -29,14 +40,17 @@ typedef struct {
 } out_t;
 
 BPF_PERCPU_ARRAY(slots, out_t, 1);
-
-BPF_PERF_OUTPUT(memslots);
+// pids of the hypervisors to inspect, set from userspace, so the compiled
+// program can be cached
+BPF_HASH(targets, u32, u32, MAX_TARGETS);
+// pid -> memslots, only allocated for hypervisors that called the ioctl
+BPF_F_TABLE("hash", u32, out_t, results, MAX_TARGETS, BPF_F_NO_PREALLOC);
 
 void kvm_vm_ioctl(struct pt_regs *ctx, struct file *filp) {
     struct kvm *kvm = (struct kvm *)filp->private_data;
 
     u32 pid = bpf_get_current_pid_tgid() >> 32;
-    if (pid != TARGET_PID) {
+    if (!targets.lookup(&pid)) {
         return;
     }
 
@@ -56,8 +70,10 @@ void kvm_vm_ioctl(struct pt_regs *ctx, struct file *filp) {
       out_slot->base_gfn = in_slot->base_gfn;
       out_slot->npages = in_slot->npages;
       out_slot->userspace_addr = in_slot->userspace_addr;
+      out_slot->flags = in_slot->flags;
+      out_slot->id = in_slot->id;
     }
-    memslots.perf_submit(ctx, out, sizeof(*out));
+    results.update(&pid, out);
 }
 """
 
@@ -67,6 +83,8 @@ class MemSlot(ctypes.Structure):
         ("base_gfn", ctypes.c_uint64),
         ("npages", ctypes.c_ulong),
         ("userspace_addr", ctypes.c_ulong),
+        ("flags", ctypes.c_uint32),
+        ("id", ctypes.c_uint32),
     ]
 
     @property
@@ -95,62 +113,45 @@ class MemSlot(ctypes.Structure):
         )
 
 
-def event_structure(header: ctypes.c_size_t) -> Type[ctypes.Structure]:
-    assert header.value != 0
-    used_slots = header.value
-
-    class Event(ctypes.Structure):
-        _fields_ = [
-            ("used_slots", ctypes.c_size_t),
-            ("memslots", MemSlot * used_slots),
-        ]
-
-    return Event
-
+def bpf_prog(cache: Cache = None) -> LoadedProgram:
+    return load_kprobes(
+        bpf_text,
+        [],
+        ["kvm_vm_ioctl"],
+        cache,
+        kprobes=[("kvm_vm_ioctl", "kvm_vm_ioctl")],
+    )
 
-def bpf_prog(pid: int) -> BPF:
-    return BPF(text=bpf_text, cflags=[f"-DTARGET_PID={pid}"])
 
+def read_memslots(prog: LoadedProgram, pid: int) -> List[MemSlot]:
+    """
+    Returns the memslots the program recorded for the hypervisor.
+    """
+    (data,) = prog.lookup("results", struct.pack("I", pid))
+    used_slots = ctypes.c_size_t.from_buffer_copy(data).value
+    assert used_slots != 0
+    # the slots follow the size_t used_slots in out_t
+    offset = ctypes.sizeof(ctypes.c_size_t)
+    return list((MemSlot * used_slots).from_buffer_copy(data, offset))
 
-def get_maps(hv: "kvm.Hypervisor") -> List[proc.KvmMapping]:
-    # initialize BPF
 
-    bpf = bpf_prog(hv.pid)
-
-    memslots: List[MemSlot] = []
-
-    def get_memslot(cpu: int, data: Any, size: int) -> None:
-        header = ctypes.cast(data, ctypes.POINTER(ctypes.c_size_t)).contents
-        event_cls = event_structure(header)
-        event = ctypes.cast(data, ctypes.POINTER(event_cls)).contents
-        memslots.clear()
-        for memslot in event.memslots:
-            # we don't own the data here
-            copy = MemSlot()
-            ctypes.pointer(copy)[0] = memslot
-            memslots.append(copy)
-
-    try:
-        with hv.attach() as tracee:
-            bpf.attach_kprobe(event="kvm_vm_ioctl", fn_name="kvm_vm_ioctl")
-            bpf["memslots"].open_perf_buffer(get_memslot)
-            tracee.check_extension(0)
-        bpf.perf_buffer_poll()
-    finally:
-        # close perf reader
-        del bpf
+def kvm_mappings(
+    hv: "kvm.Hypervisor", memslots: List[MemSlot]
+) -> List[proc.KvmMapping]:
     assert len(memslots) > 0
 
     maps = []
     for memslot in memslots:
         mapping = proc.find_mapping(hv.mappings, memslot.start)
         assert mapping is not None
-        attrs = mapping.__dict__
+        attrs = dict(mapping.__dict__)
         attrs.update(
             physical_start=memslot.physical_start,
-            start=mapping.start,
+            start=memslot.start,
             stop=memslot.end,
             hv_mapping=mapping,
+            memslot_id=memslot.id,
+            memslot_flags=memslot.flags,
         )
         kvm_mapping = proc.KvmMapping(**attrs)
         assert kvm_mapping.start >= mapping.start
@@ -159,5 +160,84 @@ def get_maps(hv: "kvm.Hypervisor") -> List[proc.KvmMapping]:
     return maps
 
 
+def _trigger(hv: "kvm.Hypervisor") -> None:
+    # any VM ioctl calls kvm_vm_ioctl
+    with hv.attach() as tracee:
+        tracee.check_extension(0)
+
+
+@dataclass
+class Inventory:
+    maps: Dict[int, List[proc.KvmMapping]] = field(default_factory=dict)
+    # hypervisors that could not be inspected
+    errors: Dict[int, Exception] = field(default_factory=dict)
+
+
+def get_all_maps(
+    hvs: List["kvm.Hypervisor"],
+    cache: Cache = CacheDir.DEFAULT,
+    workers: int = DEFAULT_WORKERS,
+) -> Inventory:
+    """
+    Returns the memslots of many hypervisors with one program: all pids are
+    added to its target map and the ioctl is injected into up to workers
+    hypervisors at the same time. A hypervisor that fails does not stop
+    the others. The program is cached in cache, bpfcache.cache_dir() by
+    default, None always compiles it.
+    """
+    if len(hvs) > MAX_TARGETS:
+        raise ValueError(f"cannot inspect more than {MAX_TARGETS} hypervisors at once")
+    inventory = Inventory()
+    with bpf_prog(cache) as prog:
+        for hv in hvs:
+            prog.update("targets", struct.pack("I", hv.pid), struct.pack("I", 1))
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(hvs)))) as pool:
+            # ptrace requests have to come from the attaching thread, so each
+            # hypervisor is handled by a single worker
+            futures = [(hv, pool.submit(_trigger, hv)) for hv in hvs]
+            for hv, future in futures:
+                try:
+                    future.result()
+                    memslots = read_memslots(prog, hv.pid)
+                    inventory.maps[hv.pid] = kvm_mappings(hv, memslots)
+                except Exception as err:
+                    inventory.errors[hv.pid] = err
+    return inventory
+
+
+def get_maps(
+    hv: "kvm.Hypervisor", cache: Cache = CacheDir.DEFAULT
+) -> List[proc.KvmMapping]:
+    inventory = get_all_maps([hv], cache, workers=1)
+    error = inventory.errors.get(hv.pid)
+    if error is not None:
+        raise error
+    return inventory.maps[hv.pid]
+
+
+def _load_once(cache: str) -> None:
+    start = time.perf_counter()
+    bpf_prog(cache).close()
+    bcc = "bcc imported" if "bcc" in sys.modules else "bcc not imported"
+    print(f"{time.perf_counter() - start:.3f}s, {bcc}")
+
+
+def measure_startup() -> None:
+    """
+    Compares loading the program with an empty and a filled cache. Each load
+    runs in a new interpreter like a CLI invocation, so the cold load
+    includes importing bcc and LLVM.
+    """
+    with tempfile.TemporaryDirectory() as cache:
+        for run in ("cold (compile)", "warm (cached)"):
+            print(f"{run}: ", end="", flush=True)
+            subprocess.run(
+                [sys.executable, "-m", "kvm_pirate.kvm_memslots", cache], check=True
+            )
+
+
 if __name__ == "__main__":
-    bpf_prog(0)
+    if len(sys.argv) > 1:
+        _load_once(sys.argv[1])
+    else:
+        measure_startup()
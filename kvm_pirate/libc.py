@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import ctypes
+import os
 from typing import Tuple
 
 libc = ctypes.CDLL(None, use_errno=True)
@@ -10,7 +11,8 @@ def errcheck(
     ret: int, func: "ctypes._FuncPointer", args: Tuple["ctypes._CData", ...]
 ) -> int:
     if ret == -1:
-        raise OSError(ctypes.get_errno())
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
     return ret
 
 
@@ -36,4 +38,49 @@ libc.process_vm_readv.argtypes = [
     ctypes.c_ulong,
     ctypes.c_ulong,
 ]
-libc.ptrace.restype = ctypes.c_ssize_t
+libc.process_vm_readv.restype = ctypes.c_ssize_t
+
+libc.process_vm_writev.errcheck = errcheck  # type: ignore
+libc.process_vm_writev.argtypes = libc.process_vm_readv.argtypes
+libc.process_vm_writev.restype = ctypes.c_ssize_t
+
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+libc.fallocate.errcheck = errcheck  # type: ignore
+libc.fallocate.argtypes = [
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_long,
+    ctypes.c_long,
+]
+
+SYNC_FILE_RANGE_WAIT_BEFORE = 0x01
+SYNC_FILE_RANGE_WRITE = 0x02
+SYNC_FILE_RANGE_WAIT_AFTER = 0x04
+
+libc.sync_file_range.errcheck = errcheck  # type: ignore
+libc.sync_file_range.argtypes = [
+    ctypes.c_int,
+    ctypes.c_long,
+    ctypes.c_long,
+    ctypes.c_uint,
+]
+
+# same number on all architectures using the generic syscall table
+SYS_pidfd_getfd = 438
+
+libc.syscall.restype = ctypes.c_long
+
+
+def pidfd_getfd(pidfd: int, targetfd: int) -> int:
+    """
+    Duplicates the file descriptor targetfd of the process referred to by pidfd.
+    Requires the same permissions as ptrace.
+    """
+    fd = libc.syscall(SYS_pidfd_getfd, pidfd, targetfd, 0)
+    if fd == -1:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return int(fd)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from .guestmem import GuestMemory
+
+CACHE_PAGE_SIZE = 4096
+# 64 MiB of 4 KiB pages
+DEFAULT_CACHE_PAGES = 16384
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return self.hits / lookups
+
+    def __repr__(self) -> str:
+        return "%s(%d hits, %d misses, %d evictions, %.1f%% hit rate)" % (
+            self.__class__.__name__,
+            self.hits,
+            self.misses,
+            self.evictions,
+            self.hit_rate * 100,
+        )
+
+
+class CachedGuestMemory:
+    """
+    Keeps the most recently read guest pages of a GuestMemory in an LRU cache
+    of at most max_pages pages. Pages read before the last call to
+    next_generation (i.e. after the guest ran again) are read again on their
+    next access. Pages of directly mapped memslots are not cached, reading
+    them is already cheaper than a lookup.
+    """
+
+    def __init__(
+        self, memory: GuestMemory, max_pages: int = DEFAULT_CACHE_PAGES
+    ) -> None:
+        assert max_pages > 0
+        self.memory = memory
+        self.max_pages = max_pages
+        self.generation = 0
+        # page frame number -> (generation, data)
+        self.pages: "OrderedDict[int, Tuple[int, bytes]]" = OrderedDict()
+        self.stats = CacheStats()
+
+    def next_generation(self) -> int:
+        """
+        Invalidates all cached pages lazily, i.e. when the guest was resumed
+        since they were read.
+        """
+        self.generation += 1
+        return self.generation
+
+    def invalidate(self, gpa: Optional[int] = None, size: int = 1) -> None:
+        """
+        Drops the cached pages overlapping gpa to gpa + size, or all pages.
+        """
+        if gpa is None:
+            self.pages.clear()
+            return
+        first = gpa // CACHE_PAGE_SIZE
+        last = (gpa + size - 1) // CACHE_PAGE_SIZE
+        if last - first + 1 > len(self.pages):
+            for pfn in [p for p in self.pages if first <= p <= last]:
+                del self.pages[pfn]
+            return
+        for pfn in range(first, last + 1):
+            self.pages.pop(pfn, None)
+
+    def _lookup(self, pfn: int) -> Optional[bytes]:
+        entry = self.pages.get(pfn)
+        if entry is None or entry[0] != self.generation:
+            return None
+        self.pages.move_to_end(pfn)
+        return entry[1]
+
+    def _insert(self, pfn: int, data: bytes) -> None:
+        self.pages[pfn] = (self.generation, data)
+        self.pages.move_to_end(pfn)
+        while len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+            self.stats.evictions += 1
+
+    def _is_mapped(self, gpa: int) -> bool:
+        return self.memory.ram.view(self.memory.slot_index(gpa)) is not None
+
+    def readv(self, ranges: Sequence[Tuple[int, int]]) -> List[bytes]:
+        """
+        Like GuestMemory.readv, all missing pages are read with one readv.
+        """
+        pages: Dict[int, bytes] = {}
+        missing: List[int] = []
+        pending: Set[int] = set()
+        direct: List[Tuple[int, int]] = []
+        for gpa, size in ranges:
+            if size > 0 and self._is_mapped(gpa):
+                direct.append((gpa, size))
+                continue
+            first = gpa // CACHE_PAGE_SIZE
+            last = (gpa + size - 1) // CACHE_PAGE_SIZE
+            for pfn in range(first, last + 1):
+                if pfn in pages or pfn in pending:
+                    continue
+                data = self._lookup(pfn)
+                if data is None:
+                    missing.append(pfn)
+                    pending.add(pfn)
+                    self.stats.misses += 1
+                else:
+                    pages[pfn] = data
+                    self.stats.hits += 1
+
+        read = [(pfn * CACHE_PAGE_SIZE, CACHE_PAGE_SIZE) for pfn in missing]
+        for pfn, data in zip(missing, self.memory.readv(read)):
+            pages[pfn] = data
+            self._insert(pfn, data)
+        direct_data = iter(self.memory.readv(direct))
+
+        result = []
+        for gpa, size in ranges:
+            if size > 0 and self._is_mapped(gpa):
+                result.append(next(direct_data))
+                continue
+            first = gpa // CACHE_PAGE_SIZE
+            last = (gpa + size - 1) // CACHE_PAGE_SIZE
+            data = b"".join(pages[pfn] for pfn in range(first, last + 1))
+            start = gpa - first * CACHE_PAGE_SIZE
+            end = start + size
+            result.append(data[start:end])
+        return result
+
+    def read(self, gpa: int, size: int) -> bytes:
+        return self.readv([(gpa, size)])[0]
+
+    def writev(self, writes: Sequence[Tuple[int, bytes]]) -> None:
+        """
+        Writes through to guest memory and drops the written pages.
+        """
+        self.memory.writev(writes)
+        for gpa, data in writes:
+            self.invalidate(gpa, len(data))
+
+    def write(self, gpa: int, data: bytes) -> None:
+        self.writev([(gpa, data)])
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+import resource
+import struct
+from dataclasses import dataclass
+from types import TracebackType
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Type
+
+from . import proc
+from .bpfcache import Cache, CacheDir, load_kprobes
+from .hugepage import detect_page_sizes
+from .kvm_memslots import (
+    DEFAULT_WORKERS,
+    MAX_TARGETS,
+    Inventory,
+    MemSlot,
+    get_all_maps,
+    kvm_mappings,
+)
+
+try:
+    # for mypy
+    from . import kvm
+except ImportError:
+    pass
+
+# memslot ioctls of all address spaces go through this function
+SET_MEMORY_REGION_FUNCTION = "kvm_set_memory_region"
+# 256 KiB, room for about 5000 changes between two polls
+RING_PAGES = 64
+
+bpf_text = f"#define MAX_TARGETS {MAX_TARGETS}\n#define RING_PAGES {RING_PAGES}\n" + """
+#include <linux/kvm_host.h>
+
+struct slot_event_t {
+    u32 pid;
+    // address space id in the upper 16 bits, as in kvm_userspace_memory_region
+    u32 slot;
+    u64 guest_phys_addr;
+    // 0 for deleted slots
+    u64 memory_size;
+    u64 userspace_addr;
+    u32 flags;
+    u32 pad;
+};
+
+BPF_HASH(targets, u32, u32, MAX_TARGETS);
+// thread -> memslot update in progress
+BPF_HASH(pending, u32, struct kvm_userspace_memory_region, MAX_TARGETS);
+BPF_RINGBUF_OUTPUT(events, RING_PAGES);
+// events that did not fit into the ring buffer
+BPF_ARRAY(lost, u64, 1);
+
+int set_memory_region(struct pt_regs *ctx, struct kvm *kvm,
+                      const struct kvm_userspace_memory_region *mem) {
+    u64 pid_tgid = bpf_get_current_pid_tgid();
+    u32 pid = pid_tgid >> 32;
+    if (!targets.lookup(&pid)) {
+        return 0;
+    }
+    u32 tid = pid_tgid;
+    struct kvm_userspace_memory_region region = {};
+    bpf_probe_read(&region, sizeof(region), mem);
+    pending.update(&tid, &region);
+    return 0;
+}
+
+int set_memory_region_return(struct pt_regs *ctx) {
+    u64 pid_tgid = bpf_get_current_pid_tgid();
+    u32 tid = pid_tgid;
+    struct kvm_userspace_memory_region *region = pending.lookup(&tid);
+    if (!region) {
+        return 0;
+    }
+    // failed updates leave the slots as they were
+    if (PT_REGS_RC(ctx) == 0) {
+        struct slot_event_t *event = events.ringbuf_reserve(sizeof(*event));
+        if (event) {
+            event->pid = pid_tgid >> 32;
+            event->slot = region->slot;
+            event->guest_phys_addr = region->guest_phys_addr;
+            event->memory_size = region->memory_size;
+            event->userspace_addr = region->userspace_addr;
+            event->flags = region->flags;
+            event->pad = 0;
+            events.ringbuf_submit(event, 0);
+        } else {
+            u32 idx = 0;
+            lost.increment(idx);
+        }
+    }
+    pending.delete(&tid);
+    return 0;
+}
+"""
+
+# struct slot_event_t
+SLOT_EVENT = struct.Struct("<IIQQQII")
+
+
+@dataclass(frozen=True)
+class Slot:
+    as_id: int
+    id: int
+    physical_start: int
+    size: int
+    userspace_addr: int
+    flags: int
+
+
+@dataclass(frozen=True)
+class SlotChange:
+    pid: int
+    # None for new slots
+    old: Optional[Slot]
+    # None for deleted slots
+    new: Optional[Slot]
+
+
+SlotTable = Dict[Tuple[int, int], Slot]
+
+
+def apply_events(
+    tables: Dict[int, SlotTable], events: Iterable[Tuple[Any, ...]]
+) -> List[SlotChange]:
+    """
+    Applies decoded slot events in order to the slot tables of the tracked
+    pids and returns the slots that differ. Events that are already in the
+    tables (i.e. from before the initial snapshot) are no change.
+    """
+    changes = []
+    for pid, slot_id, gpa, size, userspace_addr, flags, _ in events:
+        table = tables.get(pid)
+        if table is None:
+            continue
+        as_id = slot_id >> 16
+        slot_id &= 0xFFFF
+        old = table.get((as_id, slot_id))
+        new = None
+        if size != 0:
+            new = Slot(as_id, slot_id, gpa, size, userspace_addr, flags)
+        if old == new:
+            continue
+        if new is None:
+            del table[(as_id, slot_id)]
+        else:
+            table[(as_id, slot_id)] = new
+        changes.append(SlotChange(pid, old, new))
+    return changes
+
+
+def diff_tables(pid: int, old: SlotTable, new: SlotTable) -> List[SlotChange]:
+    changes = []
+    for key in sorted(old.keys() | new.keys()):
+        if old.get(key) != new.get(key):
+            changes.append(SlotChange(pid, old.get(key), new.get(key)))
+    return changes
+
+
+def snapshot_tables(inventory: Inventory) -> Dict[int, SlotTable]:
+    tables = {}
+    for pid, maps in inventory.maps.items():
+        table: SlotTable = {}
+        for m in maps:
+            # always read from the kernel by get_all_maps
+            assert m.memslot_id is not None
+            table[(0, m.memslot_id)] = Slot(
+                0, m.memslot_id, m.physical_start, m.size, m.start, m.memslot_flags
+            )
+        tables[pid] = table
+    return tables
+
+
+class MemslotTracker:
+    """
+    Keeps the memslot tables of hypervisors up to date. A kprobe on the
+    memslot update path writes every successful change into a BPF ring
+    buffer with a fixed record layout, poll decodes all pending records at
+    once, applies them to the tables and passes them to the subscribers.
+    The hypervisors are stopped only for the initial tables, or again if
+    the ring buffer overflowed.
+    """
+
+    def __init__(
+        self,
+        hvs: List["kvm.Hypervisor"],
+        cache: Cache = CacheDir.DEFAULT,
+        workers: int = DEFAULT_WORKERS,
+    ) -> None:
+        self.hvs = {hv.pid: hv for hv in hvs}
+        self.cache = cache
+        self.workers = workers
+        self.subscribers: List[Callable[[SlotChange], None]] = []
+        self.lost = 0
+        self.prog = load_kprobes(
+            bpf_text,
+            [],
+            ["set_memory_region", "set_memory_region_return"],
+            cache,
+            kprobes=[(SET_MEMORY_REGION_FUNCTION, "set_memory_region")],
+            kretprobes=[(SET_MEMORY_REGION_FUNCTION, "set_memory_region_return")],
+        )
+        try:
+            self.ring = self.prog.ring_buffer("events")
+            for hv in hvs:
+                self.prog.update("targets", struct.pack("I", hv.pid), b"\1")
+            # changes after the probes were attached are in the ring buffer,
+            # so none is lost between the snapshot and the first poll
+            inventory = get_all_maps(hvs, cache, workers)
+        except BaseException:
+            self.prog.close()
+            raise
+        self.errors = inventory.errors
+        self.tables = snapshot_tables(inventory)
+        self.mappings: Dict[int, List[proc.KvmMapping]] = {}
+        self.poll()
+
+    def subscribe(self, callback: Callable[[SlotChange], None]) -> None:
+        self.subscribers.append(callback)
+
+    def _lost(self) -> int:
+        (value,) = self.prog.lookup("lost", struct.pack("I", 0))
+        return int(struct.unpack("Q", value)[0])
+
+    def _resync(self) -> List[SlotChange]:
+        """
+        Reads all tables again after events were lost.
+        """
+        hvs = [self.hvs[pid] for pid in self.tables]
+        tables = snapshot_tables(get_all_maps(hvs, self.cache, self.workers))
+        changes = []
+        for pid, table in tables.items():
+            changes.extend(diff_tables(pid, self.tables[pid], table))
+            self.tables[pid] = table
+        return changes
+
+    def poll(self, timeout: float = 0) -> List[SlotChange]:
+        """
+        Applies the memslot changes since the last poll, waiting up to
+        timeout seconds for the first one.
+        """
+        if timeout > 0:
+            self.ring.wait(timeout)
+        changes = apply_events(self.tables, self.ring.read_fixed(SLOT_EVENT))
+        lost = self._lost()
+        if lost != self.lost:
+            self.lost = lost
+            changes.extend(self._resync())
+        for change in changes:
+            self.mappings.pop(change.pid, None)
+        for change in changes:
+            for callback in self.subscribers:
+                callback(change)
+        return changes
+
+    def slots(self, pid: int) -> List[Slot]:
+        return sorted(self.tables[pid].values(), key=lambda s: (s.as_id, s.id))
+
+    def get_maps(self, pid: int) -> List[proc.KvmMapping]:
+        """
+        Returns the memslots of address space 0 like Hypervisor.get_maps, as
+        of the last poll.
+        """
+        maps = self.mappings.get(pid)
+        if maps is not None:
+            return maps
+        page_size = resource.getpagesize()
+        memslots = [
+            MemSlot(
+                base_gfn=slot.physical_start // page_size,
+                npages=slot.size // page_size,
+                userspace_addr=slot.userspace_addr,
+                flags=slot.flags,
+                id=slot.id,
+            )
+            for slot in self.slots(pid)
+            if slot.as_id == 0
+        ]
+        hv = self.hvs[pid]
+        # hotplugged memory is mapped after the hypervisor was found
+        with proc.openpid(pid) as pid_fd:
+            hv.mappings = pid_fd.maps()
+        maps = detect_page_sizes(pid, kvm_mappings(hv, memslots))
+        self.mappings[pid] = maps
+        return maps
+
+    def close(self) -> None:
+        self.prog.close()
+
+    def __enter__(self) -> "MemslotTracker":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
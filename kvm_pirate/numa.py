@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import os
+import re
+from typing import Dict, List, Optional, Set
+
+from . import proc
+from .hugepage import copy_align
+from .proc import KvmMapping
+from .vmcopy import BatchGroup, Chunk, batch_chunks, slot_offsets
+
+NODE_ROOT = "/sys/devices/system/node"
+
+
+def parse_cpulist(cpulist: str) -> Set[int]:
+    """
+    Parses lists like "0-3,8-11" as found in sysfs.
+    """
+    cpus: Set[int] = set()
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def node_cpus() -> Dict[int, Set[int]]:
+    """
+    Returns the CPUs of each NUMA node we are allowed to run on.
+    Nodes without such CPUs (i.e. memory-only nodes) are left out.
+    """
+    allowed = os.sched_getaffinity(0)
+    nodes: Dict[int, Set[int]] = {}
+    try:
+        entries = os.listdir(NODE_ROOT)
+    except FileNotFoundError:
+        return nodes
+    for entry in entries:
+        match = re.fullmatch(r"node(\d+)", entry)
+        if not match:
+            continue
+        with open(os.path.join(NODE_ROOT, entry, "cpulist")) as f:
+            cpus = parse_cpulist(f.read()) & allowed
+        if cpus:
+            nodes[int(match.group(1))] = cpus
+    return nodes
+
+
+def mapping_node(numa_map: Dict[str, str]) -> Optional[int]:
+    """
+    Returns the node holding most pages of a mapping. Mappings without pages
+    fall back to the first node of their memory policy (i.e. bind:1).
+    """
+    pages = {
+        int(key[1:]): int(value)
+        for key, value in numa_map.items()
+        if re.fullmatch(r"N\d+", key)
+    }
+    if pages:
+        return max(pages, key=lambda node: pages[node])
+    _, _, nodes = numa_map.get("policy", "").partition(":")
+    if nodes:
+        return min(parse_cpulist(nodes))
+    return None
+
+
+def slot_nodes(pid: int, slots: List[KvmMapping]) -> List[Optional[int]]:
+    """
+    Returns the node backing each memslot according to /proc/<pid>/numa_maps.
+    numa_maps has one line per mapping, so a slot is assigned as a whole.
+    """
+    with proc.openpid(pid) as pid_fd:
+        numa_maps = pid_fd.numa_maps()
+    return [mapping_node(numa_maps.get(slot.hv_mapping.start, {})) for slot in slots]
+
+
+def share_jobs(sizes: List[int], jobs: int) -> List[int]:
+    """
+    Splits jobs in proportion to sizes, with at least one job per size.
+    The shares add up to jobs if there are at least as many jobs as sizes.
+    """
+    spare = max(jobs - len(sizes), 0)
+    total = sum(sizes) or 1
+    exact = [spare * size / total for size in sizes]
+    shares = [int(e) for e in exact]
+    # hand out what is left by the largest remainders
+    by_remainder = sorted(
+        range(len(sizes)), key=lambda i: exact[i] - shares[i], reverse=True
+    )
+    for i in by_remainder[: spare - sum(shares)]:
+        shares[i] += 1
+    return [share + 1 for share in shares]
+
+
+def numa_groups(
+    pid: int, slots: List[KvmMapping], offset: int, chunk_size: int, jobs: int
+) -> List[BatchGroup]:
+    """
+    Like vmcopy.split_chunks, but groups the batches by the node backing
+    their memslot. The workers of a group are pinned to the CPUs of its node,
+    so buffers they allocate or fault in are node-local. The jobs are shared
+    out in proportion to the size of each group. Batches of different slots
+    are never merged, so each batch is on a single node and contiguous in the
+    destination. Slots on unknown nodes, and on the smallest nodes if there
+    are fewer jobs than nodes, are copied by unpinned workers.
+    """
+    cpus = node_cpus()
+    nodes: Dict[Optional[int], List[List[Chunk]]] = {}
+    offsets = slot_offsets(slots, offset)
+    align = copy_align(slots, chunk_size)
+    for slot, slot_offset, node in zip(slots, offsets, slot_nodes(pid, slots)):
+        if node not in cpus:
+            node = None
+        chunk = Chunk(slot.start, slot_offset, slot.size)
+        batches = batch_chunks([chunk], chunk_size, align)
+        nodes.setdefault(node, []).extend(batches)
+
+    def size(batches: List[List[Chunk]]) -> int:
+        return sum(chunk.size for batch in batches for chunk in batch)
+
+    # every group runs at least one worker
+    pinned = sorted(
+        (node for node in nodes if node is not None),
+        key=lambda node: size(nodes[node]),
+        reverse=True,
+    )
+    limit = max(jobs, 1)
+    if None in nodes or len(pinned) > limit:
+        # leave a worker for the unpinned group
+        limit -= 1
+    for node in pinned[limit:]:
+        nodes.setdefault(None, []).extend(nodes.pop(node))
+
+    order = sorted(nodes, key=lambda node: (node is None, node))
+    shares = share_jobs([size(nodes[node]) for node in order], jobs)
+    groups = []
+    for node, group_jobs in zip(order, shares):
+        if node is None:
+            groups.append(BatchGroup(nodes[node], group_jobs))
+        else:
+            groups.append(
+                BatchGroup(nodes[node], group_jobs, cpus[node], f"node{node}")
+            )
+    return groups
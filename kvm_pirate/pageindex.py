@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import ctypes
+import hashlib
+import mmap
+from typing import IO, List, Optional, Tuple, Union
+
+from .elf import Ehdr, Phdr, Shdr
+from .elf.consts import PN_XNUM, PT_LOAD
+
+INDEX_MAGIC = b"KVMPIDX1"
+# 64-bit is plenty to detect changes of the same page
+HASH_SIZE = 8
+
+
+class LayoutError(Exception):
+    pass
+
+
+class IndexHeader(ctypes.LittleEndianStructure):
+    _fields_ = [
+        ("magic", ctypes.c_char * 8),
+        ("page_size", ctypes.c_uint64),
+        ("segments", ctypes.c_uint64),
+    ]
+
+
+class IndexSegment(ctypes.LittleEndianStructure):
+    _fields_ = [
+        ("physical_start", ctypes.c_uint64),
+        ("size", ctypes.c_uint64),
+        ("offset", ctypes.c_uint64),
+    ]
+
+
+def page_hash(page: Union[bytes, memoryview]) -> bytes:
+    return hashlib.blake2b(page, digest_size=HASH_SIZE).digest()
+
+
+def core_segments(core: "mmap.mmap") -> List[Tuple[int, int, int]]:
+    """
+    Returns (physical_start, size, file offset) of the PT_LOAD segments
+    of a core file.
+    """
+    ehdr = Ehdr.from_buffer_copy(core)
+    phnum = ehdr.e_phnum
+    if phnum == PN_XNUM:
+        phnum = Shdr.from_buffer_copy(core, ehdr.e_shoff).sh_info
+    segments = []
+    for i in range(phnum):
+        ph = Phdr.from_buffer_copy(core, ehdr.e_phoff + i * ehdr.e_phentsize)
+        if ph.p_type == PT_LOAD:
+            segments.append((ph.p_paddr, ph.p_filesz, ph.p_offset))
+    return segments
+
+
+class PageIndex:
+    """
+    Hashes of all pages in a core file. The segments of our core files are
+    placed back-to-back, so a page is identified by its position in the
+    segment data, which is also the chunk offset used by vmcopy.split_chunks.
+    """
+
+    def __init__(
+        self,
+        page_size: int,
+        segments: List[Tuple[int, int, int]],
+        hashes: Optional[bytearray] = None,
+    ) -> None:
+        # (physical_start, size, file offset)
+        self.page_size = page_size
+        self.segments = segments
+        pos = segments[0][2] if segments else 0
+        for _, size, offset in segments:
+            if offset != pos or size % page_size != 0:
+                raise LayoutError("segments are not page-sized and back-to-back")
+            pos += size
+        self.size = pos - (segments[0][2] if segments else 0)
+        if hashes is None:
+            hashes = bytearray(self.size // page_size * HASH_SIZE)
+        assert len(hashes) == self.size // page_size * HASH_SIZE
+        self.hashes = hashes
+
+    @property
+    def data_offset(self) -> int:
+        return self.segments[0][2] if self.segments else 0
+
+    @property
+    def layout(self) -> bytes:
+        """
+        Digest over the segment table, equal for cores with the same layout.
+        """
+        return hashlib.blake2b(self._segment_table(), digest_size=16).digest()
+
+    def _segment_table(self) -> bytes:
+        table = (IndexSegment * len(self.segments))()
+        for entry, segment in zip(table, self.segments):
+            entry.physical_start, entry.size, entry.offset = segment
+        return bytes(table)
+
+    def update(self, pos: int, data: Union[bytes, memoryview]) -> List[Tuple[int, int]]:
+        """
+        Hashes the pages of data found at pos in the segment data.
+        Returns the (start, stop) positions of pages that changed.
+        """
+        assert pos % self.page_size == 0
+        changed: List[Tuple[int, int]] = []
+        view = memoryview(data)
+        for page_start in range(0, len(data), self.page_size):
+            page_end = min(page_start + self.page_size, len(data))
+            digest = page_hash(view[page_start:page_end])
+            first = (pos + page_start) // self.page_size * HASH_SIZE
+            last = first + HASH_SIZE
+            if self.hashes[first:last] == digest:
+                continue
+            self.hashes[first:last] = digest
+            start = pos + page_start
+            stop = pos + page_end
+            if changed and changed[-1][1] == start:
+                changed[-1] = (changed[-1][0], stop)
+            else:
+                changed.append((start, stop))
+        return changed
+
+    def save(self, f: IO[bytes]) -> None:
+        header = IndexHeader(INDEX_MAGIC, self.page_size, len(self.segments))
+        f.write(bytes(header))
+        f.write(self._segment_table())
+        f.write(self.hashes)
+
+    @classmethod
+    def load(cls, f: IO[bytes]) -> "PageIndex":
+        header = IndexHeader.from_buffer_copy(f.read(ctypes.sizeof(IndexHeader)))
+        if header.magic != INDEX_MAGIC:
+            raise LayoutError("not a page index")
+        table_type = IndexSegment * header.segments
+        table = table_type.from_buffer_copy(f.read(ctypes.sizeof(table_type)))
+        segments = [(s.physical_start, s.size, s.offset) for s in table]
+        return cls(header.page_size, segments, bytearray(f.read()))
+
+    @classmethod
+    def from_core(cls, f: IO[bytes], page_size: int) -> "PageIndex":
+        """
+        Hashes all pages of an existing core file.
+        """
+        with mmap.mmap(f.fileno(), 0, mmap.MAP_SHARED, mmap.PROT_READ) as core:
+            index = cls(page_size, core_segments(core))
+            start = index.data_offset
+            # bounds the size of each slice
+            step = 1024 * page_size
+            for pos in range(0, index.size, step):
+                first = start + pos
+                last = min(first + step, start + index.size)
+                index.update(pos, core[first:last])
+        return index
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import struct
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Tuple, Union
+
+from .guestmem import GuestMemory
+from .memcache import CacheStats, CachedGuestMemory
+
+try:
+    # for mypy
+    from . import kvm
+except ImportError:
+    pass
+
+MemoryReader = Union[GuestMemory, CachedGuestMemory]
+
+CR0_WP = 1 << 16
+CR0_PG = 1 << 31
+CR4_PAE = 1 << 5
+CR4_LA57 = 1 << 12
+EFER_LMA = 1 << 10
+EFER_NXE = 1 << 11
+
+PTE_PRESENT = 1 << 0
+PTE_RW = 1 << 1
+PTE_US = 1 << 2
+PTE_PS = 1 << 7
+PTE_NX = 1 << 63
+# bits 12-51 of an entry hold the physical address of the next table or page
+PTE_ADDR_MASK = 0x000F_FFFF_FFFF_F000
+
+PAGE_SHIFT = 12
+TABLE_BITS = 9
+# CR3 bits 0-11 hold the PCID or the PWT/PCD flags
+CR3_ADDR_MASK = PTE_ADDR_MASK
+TLB_ENTRIES = 4096
+
+
+class PageFault(Exception):
+    def __init__(self, gva: int, reason: str) -> None:
+        super().__init__(f"page fault at 0x{gva:x}: {reason}")
+        self.gva = gva
+        self.reason = reason
+
+
+@dataclass
+class Translation:
+    # guest-physical address of the page containing the translated address
+    page: int
+    page_size: int
+    writable: bool
+    user: bool
+    executable: bool
+
+    def gpa(self, gva: int) -> int:
+        return self.page + (gva & (self.page_size - 1))
+
+
+class PageTableWalker:
+    """
+    Translates guest-virtual to guest-physical addresses for x86-64 guests
+    with 4- or 5-level paging, including 2 MiB and 1 GiB pages.
+    Translations are kept in a software TLB of at most tlb_entries entries
+    keyed by (cr3, page), which is flushed when cr3 changes.
+    """
+
+    def __init__(
+        self,
+        memory: MemoryReader,
+        cr3: int,
+        cr4: int,
+        efer: int,
+        cr0: int = CR0_PG | CR0_WP,
+        tlb_entries: int = TLB_ENTRIES,
+    ) -> None:
+        if not cr0 & CR0_PG or not efer & EFER_LMA or not cr4 & CR4_PAE:
+            raise ValueError("only 64-bit paging is supported")
+        self.memory = memory
+        self.cr3 = cr3
+        self.cr0 = cr0
+        self.efer = efer
+        self.levels = 5 if cr4 & CR4_LA57 else 4
+        self.address_bits = PAGE_SHIFT + TABLE_BITS * self.levels
+        self.tlb_entries = tlb_entries
+        # (cr3, page size, virtual page number) -> translation
+        self.tlb: "OrderedDict[Tuple[int, int, int], Translation]" = OrderedDict()
+        self.stats = CacheStats()
+
+    @classmethod
+    def from_sregs(
+        cls, memory: MemoryReader, sregs: "kvm.Sregs", tlb_entries: int = TLB_ENTRIES
+    ) -> "PageTableWalker":
+        return cls(memory, sregs.cr3, sregs.cr4, sregs.efer, sregs.cr0, tlb_entries)
+
+    def set_cr3(self, cr3: int) -> None:
+        """
+        Switches to another address space, i.e. of another guest process.
+        """
+        if cr3 != self.cr3:
+            self.cr3 = cr3
+            self.flush()
+
+    def flush(self) -> None:
+        self.tlb.clear()
+
+    def _canonical(self, gva: int) -> bool:
+        upper = gva >> (self.address_bits - 1)
+        return upper == 0 or upper == (1 << (64 - self.address_bits + 1)) - 1
+
+    def _lookup(self, gva: int) -> Optional[Translation]:
+        for shift in (PAGE_SHIFT, PAGE_SHIFT + TABLE_BITS, PAGE_SHIFT + 2 * TABLE_BITS):
+            key = (self.cr3, 1 << shift, gva >> shift)
+            translation = self.tlb.get(key)
+            if translation is not None:
+                self.tlb.move_to_end(key)
+                return translation
+        return None
+
+    def _walk(self, gva: int) -> Translation:
+        table = self.cr3 & CR3_ADDR_MASK
+        writable = user = executable = True
+        for level in range(self.levels - 1, -1, -1):
+            shift = PAGE_SHIFT + TABLE_BITS * level
+            index = (gva >> shift) & ((1 << TABLE_BITS) - 1)
+            (entry,) = struct.unpack("<Q", self.memory.read(table + index * 8, 8))
+            if not entry & PTE_PRESENT:
+                raise PageFault(gva, f"not present at level {level + 1}")
+            writable = writable and bool(entry & PTE_RW)
+            user = user and bool(entry & PTE_US)
+            if self.efer & EFER_NXE and entry & PTE_NX:
+                executable = False
+            # PS is only valid in PDPT (1 GiB) and PD (2 MiB) entries
+            if level == 0 or (level in (1, 2) and entry & PTE_PS):
+                page_size = 1 << shift
+                page = entry & PTE_ADDR_MASK & ~(page_size - 1)
+                return Translation(page, page_size, writable, user, executable)
+            table = entry & PTE_ADDR_MASK
+        raise AssertionError("unreachable")
+
+    def lookup(self, gva: int) -> Translation:
+        """
+        Returns the translation of the page containing gva.
+        """
+        gva &= (1 << 64) - 1
+        if not self._canonical(gva):
+            raise PageFault(gva, "non-canonical address")
+        translation = self._lookup(gva)
+        if translation is not None:
+            self.stats.hits += 1
+            return translation
+        self.stats.misses += 1
+        translation = self._walk(gva)
+        key = (self.cr3, translation.page_size, gva // translation.page_size)
+        self.tlb[key] = translation
+        if len(self.tlb) > self.tlb_entries:
+            self.tlb.popitem(last=False)
+            self.stats.evictions += 1
+        return translation
+
+    def translate(
+        self, gva: int, write: bool = False, user: bool = False, execute: bool = False
+    ) -> int:
+        """
+        Returns the guest-physical address of gva. Raises PageFault like the
+        CPU would for the given kind of access.
+        """
+        translation = self.lookup(gva)
+        if user and not translation.user:
+            raise PageFault(gva, "supervisor page")
+        if write and not translation.writable and (user or self.cr0 & CR0_WP):
+            raise PageFault(gva, "read-only page")
+        if execute and not translation.executable:
+            raise PageFault(gva, "no-execute page")
+        return translation.gpa(gva)
+
+    def ranges(self, gva: int, size: int) -> List[Tuple[int, int]]:
+        """
+        Splits a virtual range into guest-physical (gpa, size) ranges.
+        """
+        ranges: List[Tuple[int, int]] = []
+        while size > 0:
+            translation = self.lookup(gva)
+            n = min(size, translation.page_size - (gva & (translation.page_size - 1)))
+            gpa = translation.gpa(gva)
+            if ranges and ranges[-1][0] + ranges[-1][1] == gpa:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + n)
+            else:
+                ranges.append((gpa, n))
+            gva += n
+            size -= n
+        return ranges
+
+    def read(self, gva: int, size: int) -> bytes:
+        """
+        Reads guest-virtual memory with one readv for all pages.
+        """
+        return b"".join(self.memory.readv(self.ranges(gva, size)))
@@ -2,11 +2,23 @@
 
 import os
 import re
+import resource
+import sys
 from contextlib import contextmanager
 from typing import Generator, Iterator
 from dataclasses import dataclass
 from mmap import MAP_PRIVATE, MAP_SHARED, PROT_EXEC, PROT_READ, PROT_WRITE
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
+
+PAGEMAP_ENTRY_SIZE = 8
+# bits in the most significant byte of a pagemap entry
+PAGEMAP_PRESENT = 1 << 7
+PAGEMAP_SWAPPED = 1 << 6
+_PAGEMAP_MSB = 0 if sys.byteorder == "big" else PAGEMAP_ENTRY_SIZE - 1
+# maps the most significant byte of each entry to 1 if the page is populated
+_POPULATED_TABLE = bytes(
+    1 if b & (PAGEMAP_PRESENT | PAGEMAP_SWAPPED) else 0 for b in range(256)
+)
 
 
 @dataclass
@@ -40,6 +52,11 @@ class Mapping:
 class KvmMapping(Mapping):
     physical_start: int
     hv_mapping: Mapping
+    # only known if the memslot was read from the kernel
+    memslot_id: Optional[int] = None
+    memslot_flags: int = 0
+    # size of the pages backing the slot, see hugepage.detect_page_sizes
+    page_size: int = resource.getpagesize()
 
 
 class Pid:
@@ -55,6 +72,21 @@ class Pid:
             for entry in it:
                 yield entry
 
+    def threads(self) -> Dict[int, str]:
+        """
+        Returns the name (comm) of each thread keyed by its tid.
+        """
+        threads: Dict[int, str] = {}
+        with os.scandir(self.entry("task")) as it:
+            for entry in it:
+                try:
+                    with open(os.path.join(entry.path, "comm")) as f:
+                        threads[int(entry.name)] = f.read().strip()
+                except FileNotFoundError:
+                    # thread exited
+                    continue
+        return threads
+
     def maps(self) -> List[Mapping]:
         mappings: List[Mapping] = []
         with open(self.entry("maps")) as f:
@@ -62,6 +94,76 @@ class Pid:
                 mappings.append(_parse_line(line))
         return mappings
 
+    def smaps(self) -> Dict[int, Dict[str, str]]:
+        """
+        Returns the fields of /proc/<pid>/smaps (i.e. "KernelPageSize" or
+        "VmFlags") keyed by the start address of each mapping.
+        """
+        smaps: Dict[int, Dict[str, str]] = {}
+        fields: Dict[str, str] = {}
+        with open(self.entry("smaps")) as f:
+            for line in f:
+                key, sep, value = line.partition(":")
+                if sep == "" or " " in key:
+                    # mapping header: 7f...-7f... rw-p ...
+                    fields = {}
+                    smaps[_parse_line(line).start] = fields
+                else:
+                    fields[key] = value.strip()
+        return smaps
+
+    def numa_maps(self) -> Dict[int, Dict[str, str]]:
+        """
+        Returns the fields of /proc/<pid>/numa_maps keyed by the start address
+        of each mapping, i.e. {"policy": "bind:1", "N1": "512", "anon": "512"}.
+        """
+        numa_maps: Dict[int, Dict[str, str]] = {}
+        with open(self.entry("numa_maps")) as f:
+            for line in f:
+                start, policy, *fields = line.split()
+                entry = {"policy": policy}
+                for field in fields:
+                    key, _, value = field.partition("=")
+                    entry[key] = value
+                numa_maps[int(start, 16)] = entry
+        return numa_maps
+
+    def populated_ranges(self, start: int, stop: int) -> List[Tuple[int, int]]:
+        """
+        Returns the (start, stop) ranges between start and stop that are backed
+        by memory or swap according to /proc/<pid>/pagemap. Pages that were
+        never faulted in by the process are skipped.
+        """
+        page_size = resource.getpagesize()
+        # 64k entries at a time to bound memory usage
+        batch = 65536
+        ranges: List[Tuple[int, int]] = []
+        with open(self.entry("pagemap"), "rb", buffering=0) as f:
+            page = start // page_size
+            last_page = stop // page_size
+            while page < last_page:
+                count = min(batch, last_page - page)
+                f.seek(page * PAGEMAP_ENTRY_SIZE)
+                data = f.read(count * PAGEMAP_ENTRY_SIZE)
+                assert len(data) == count * PAGEMAP_ENTRY_SIZE
+                # translate is done in C, which makes finding runs fast
+                populated = data[_PAGEMAP_MSB::PAGEMAP_ENTRY_SIZE]
+                populated = populated.translate(_POPULATED_TABLE)
+                idx = populated.find(1)
+                while idx != -1:
+                    end = populated.find(0, idx)
+                    if end == -1:
+                        end = count
+                    run_start = (page + idx) * page_size
+                    run_stop = (page + end) * page_size
+                    if ranges and ranges[-1][1] == run_start:
+                        ranges[-1] = (ranges[-1][0], run_stop)
+                    else:
+                        ranges.append((run_start, run_stop))
+                    idx = populated.find(1, end)
+                page += count
+        return ranges
+
 
 def _parse_flags(field: str) -> int:
     assert len(field) == 4
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+import json
+import mmap
+import os
+import re
+from typing import List, Optional, Tuple
+
+from . import cpu, proc
+from .guestmem import find_backing_fd
+from .proc import KvmMapping, Mapping
+
+MiB = 1024 * 1024
+GiB = 1024 * MiB
+
+# guest RAM below 4 GiB of QEMU's x86 machines (hw/i386/pc_piix.c, pc_q35.c)
+PC_LOWMEM = 0xE000_0000
+# i440fx moves the PCI hole to 3 GiB if RAM does not fit below it
+PC_GIGABYTE_LOWMEM = 0xC000_0000
+Q35_LOWMEM = 0x8000_0000
+Q35_LOWMEM_LIMIT = 0xB000_0000
+HIGHMEM_START = 4 * GiB
+
+# smaller mappings are no guest RAM, i.e. VGA memory or malloc arenas
+MIN_RAM_SIZE = 64 * MiB
+# RAM below 1 MiB that QEMU shadows with ROMs and the VGA window
+LEGACY_HOLES = MiB
+
+# -object memory-backend-memfd: "/memfd:<id> (deleted)",
+# -mem-path or memory-backend-file: "<dir>/qemu_back_mem.<ramblock>.XXXXXX"
+_NAMED_RAM = re.compile(r"^/memfd:|/qemu_back_mem\.")
+
+
+def qemu_machine(cmdline: List[str]) -> str:
+    """
+    Returns the machine type given to QEMU with -machine or -M.
+    """
+    machine = ""
+    for i, arg in enumerate(cmdline):
+        value = None
+        if arg in ("-machine", "--machine", "-M") and i + 1 < len(cmdline):
+            value = cmdline[i + 1]
+        elif arg.startswith(("-machine=", "--machine=")):
+            value = arg.split("=", 1)[1]
+        if value is None:
+            continue
+        for option in value.split(","):
+            key, _, val = option.partition("=")
+            if not val:
+                machine = key
+            elif key == "type":
+                machine = val
+    return machine
+
+
+def qemu_x86_layout(machine: str, ram_size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Returns the (gpa, size) ranges of guest RAM for QEMU's pc and q35
+    machines. RAM is split at the PCI hole and continues at 4 GiB.
+    """
+    if machine == "q35" or machine.startswith("pc-q35"):
+        lowmem = Q35_LOWMEM if ram_size >= Q35_LOWMEM_LIMIT else Q35_LOWMEM_LIMIT
+    elif machine in ("", "pc") or machine.startswith("pc-i440fx"):
+        lowmem = PC_GIGABYTE_LOWMEM if ram_size >= PC_LOWMEM else PC_LOWMEM
+    else:
+        # i.e. microvm or isapc
+        return None
+    below = min(ram_size, lowmem)
+    ranges = [(0, below)]
+    if ram_size > below:
+        ranges.append((HIGHMEM_START, ram_size - below))
+    return ranges
+
+
+def find_ram_mapping(mappings: List[Mapping]) -> Optional[Mapping]:
+    """
+    Returns the mapping of guest RAM: the only named RAM backend or else the
+    largest writable anonymous mapping. Guests with several backends (i.e.
+    NUMA nodes) are not supported.
+    """
+    named = [m for m in mappings if _NAMED_RAM.search(m.pathname)]
+    if len(named) > 1:
+        return None
+    if named:
+        return named[0]
+    anonymous = [
+        m
+        for m in mappings
+        if m.pathname == ""
+        and m.flags & mmap.PROT_WRITE
+        and not m.flags & mmap.PROT_EXEC
+    ]
+    if not anonymous:
+        return None
+    ram = max(anonymous, key=lambda m: m.size)
+    if ram.size < MIN_RAM_SIZE:
+        return None
+    return ram
+
+
+def qemu_maps(mappings: List[Mapping], machine: str) -> Optional[List[KvmMapping]]:
+    ram = find_ram_mapping(mappings)
+    if ram is None:
+        return None
+    layout = qemu_x86_layout(machine, ram.size)
+    if layout is None:
+        return None
+    maps = []
+    offset = 0
+    for gpa, size in layout:
+        attrs = dict(ram.__dict__)
+        attrs.update(
+            physical_start=gpa,
+            start=ram.start + offset,
+            stop=ram.start + offset + size,
+            hv_mapping=ram,
+        )
+        maps.append(KvmMapping(**attrs))
+        offset += size
+    return maps
+
+
+def _is_whole_file(pid_fd: proc.Pid, mapping: Mapping) -> bool:
+    """
+    QEMU maps the whole file of a memory backend, a partial mapping is
+    something else.
+    """
+    fd = find_backing_fd(pid_fd, mapping)
+    if fd is None:
+        return False
+    try:
+        size = os.stat(pid_fd.entry(f"fd/{fd}")).st_size
+    except OSError:
+        return False
+    return mapping.offset == 0 and size == mapping.size
+
+
+def guess_maps(pid: int, mappings: List[Mapping]) -> Optional[List[KvmMapping]]:
+    """
+    Derives the guest RAM memslots of a QEMU x86 guest from its mappings and
+    command line, without BPF. Returns None for other hypervisors and setups
+    that cannot be told apart from the mappings. ROMs, flash and VGA memory
+    are not included.
+    """
+    if not cpu.CPU_X86_64:
+        return None
+    with proc.openpid(pid) as pid_fd:
+        with open(pid_fd.entry("cmdline"), "rb") as f:
+            cmdline = [arg.decode(errors="replace") for arg in f.read().split(b"\0")]
+        if not os.path.basename(cmdline[0]).startswith(("qemu-system-x86", "qemu-kvm")):
+            return None
+        maps = qemu_maps(mappings, qemu_machine(cmdline[1:]))
+        if maps is None:
+            return None
+        ram = maps[0].hv_mapping
+        if ram.flags & mmap.MAP_SHARED and not _is_whole_file(pid_fd, ram):
+            return None
+    return maps
+
+
+def verify(guessed: List[KvmMapping], memslots: List[KvmMapping]) -> List[str]:
+    """
+    Compares guessed memslots with the ones read from the kernel. Returns
+    the differences, i.e. an empty list if the guess translates all guest
+    RAM like the kernel.
+    """
+    problems = []
+    ram_mappings = {m.hv_mapping.start for m in guessed}
+    covered = 0
+    for slot in memslots:
+        if slot.hv_mapping.start not in ram_mappings:
+            continue
+        for g in guessed:
+            if g.physical_start <= slot.physical_start < g.physical_start + g.size:
+                expected = g.start + slot.physical_start - g.physical_start
+                if expected != slot.start:
+                    problems.append(
+                        f"gpa 0x{slot.physical_start:x} is at 0x{slot.start:x}, guessed 0x{expected:x}"
+                    )
+                elif slot.physical_start + slot.size > g.physical_start + g.size:
+                    problems.append(
+                        f"memslot at gpa 0x{slot.physical_start:x} exceeds the guessed range"
+                    )
+                covered += slot.size
+                break
+        else:
+            problems.append(f"memslot at gpa 0x{slot.physical_start:x} not guessed")
+    total = sum(g.size for g in guessed)
+    if total - covered > LEGACY_HOLES:
+        problems.append(f"0x{total - covered:x} guessed bytes are in no memslot")
+    return problems
+
+
+def cache_dir() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "kvm-pirate", "memslots")
+
+
+def _verified_path(directory: str, pid: int) -> Optional[str]:
+    # the start time tells apart processes that reuse a pid
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    start_time = stat.rsplit(")", 1)[1].split()[19]
+    return os.path.join(directory, f"{pid}-{start_time}.json")
+
+
+def _signature(maps: List[KvmMapping]) -> List[List[int]]:
+    return [[m.physical_start, m.start, m.size] for m in maps]
+
+
+def mark_verified(directory: str, pid: int, guessed: List[KvmMapping]) -> None:
+    """
+    Remembers that the guess matched the kernel for this process, so later
+    inspections can skip BPF.
+    """
+    path = _verified_path(directory, pid)
+    if path is None:
+        return
+    os.makedirs(directory, exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(_signature(guessed), f)
+    os.replace(tmp, path)
+
+
+def is_verified(directory: str, pid: int, guessed: List[KvmMapping]) -> bool:
+    """
+    Returns True if the same guess was verified for this process before.
+    A different guess (i.e. after the RAM mapping changed) is not trusted.
+    """
+    path = _verified_path(directory, pid)
+    if path is None:
+        return False
+    try:
+        with open(path) as f:
+            return bool(json.load(f) == _signature(guessed))
+    except (OSError, ValueError):
+        return False
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import time
+from typing import IO, Counter, Optional, Tuple
+
+from .kallsyms import Symbolizer
+
+DEFAULT_FREQUENCY = 99
+MAX_SAMPLE_KEYS = 65536
+
+bpf_text = """
+struct sample_t {
+    u32 vcpu;
+    u64 rip;
+};
+
+BPF_HASH(samples, struct sample_t, u64, MAX_SAMPLE_KEYS);
+BPF_HASH(last_sample, u32, u64, 1024);
+
+TRACEPOINT_PROBE(kvm, kvm_exit) {
+    u64 pid_tgid = bpf_get_current_pid_tgid();
+    if (pid_tgid >> 32 != TARGET_PID) {
+        return 0;
+    }
+    u32 vcpu = args->vcpu_id;
+    u64 now = bpf_ktime_get_ns();
+    u64 *last = last_sample.lookup(&vcpu);
+    if (last && now - *last < SAMPLE_PERIOD_NS) {
+        return 0;
+    }
+    last_sample.update(&vcpu, &now);
+
+    struct sample_t sample = {};
+    sample.vcpu = vcpu;
+    sample.rip = args->guest_rip;
+    samples.increment(sample);
+    return 0;
+}
+"""
+
+
+def sample_guest_rip(
+    pid: int, duration: float, frequency: int = DEFAULT_FREQUENCY
+) -> Counter[Tuple[int, int]]:
+    """
+    Samples the guest instruction pointer of each vCPU at most frequency
+    times per second for duration seconds, or until interrupted. Samples are
+    taken from the kvm_exit tracepoint and counted in a BPF map, so the
+    hypervisor keeps running. vCPUs that do not exit are not sampled, though
+    the host timer tick makes busy vCPUs exit regularly.
+    Returns the number of samples keyed by (vcpu, guest rip).
+    """
+    from bcc import BPF
+
+    bpf = BPF(
+        text=bpf_text,
+        cflags=[
+            f"-DTARGET_PID={pid}",
+            f"-DSAMPLE_PERIOD_NS={10**9 // frequency}",
+            f"-DMAX_SAMPLE_KEYS={MAX_SAMPLE_KEYS}",
+        ],
+    )
+    try:
+        try:
+            time.sleep(duration)
+        except KeyboardInterrupt:
+            pass
+        samples: Counter[Tuple[int, int]] = Counter()
+        for key, value in bpf["samples"].items():
+            samples[(key.vcpu, key.rip)] += value.value
+        return samples
+    finally:
+        bpf.cleanup()
+
+
+def write_folded(
+    out: IO[str],
+    samples: Counter[Tuple[int, int]],
+    symbolizer: Optional[Symbolizer],
+) -> None:
+    """
+    Writes samples as folded stacks ("vcpu0;function count") as read by
+    flamegraph.pl. Only the sampled instruction is known, so each stack
+    has the vCPU and the function.
+    """
+    folded: Counter[str] = Counter()
+    for (vcpu, rip), count in samples.items():
+        function = symbolizer.symbolize(rip) if symbolizer else f"0x{rip:x}"
+        folded[f"vcpu{vcpu};{function}"] += count
+    for stack, count in sorted(folded.items()):
+        out.write(f"{stack} {count}\n")
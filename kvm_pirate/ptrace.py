@@ -19,6 +19,10 @@ PTRACE_ATTACH = 16
 PTRACE_DETACH = 17
 PTRACE_O_TRACEEXIT = 0x00000040
 PTRACE_O_TRACESYSGOOD = 0x00000001
+PTRACE_O_TRACECLONE = 0x00000008
+
+# waitpid() flag
+WALL = 0x40000000
 
 
 def request(request: int, pid: int, addr: int, data: Any) -> int:
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import mmap
+import os
+import resource
+import signal
+import sys
+import time
+from contextlib import contextmanager
+from typing import IO, Generator, List, Tuple
+
+from . import inject_syscall, kvm, proc, ptrace
+from .coredump import mapped_corefile, print_copy_stats
+from .proc import KvmMapping
+from .syscalls import SYSCALL_NAMES
+from .vmcopy import (
+    DEFAULT_CHUNK_SIZE,
+    Chunk,
+    batch_chunks,
+    copy_chunks,
+    slot_offsets,
+)
+
+MADV_DONTFORK = 10
+MADV_DOFORK = 11
+
+# stop pre-copying once less memory than this was dirtied in a round
+PRECOPY_THRESHOLD = 64 * 1024 * 1024
+PRECOPY_MAX_ROUNDS = 10
+
+# maps each byte to 1 if it has any bit set
+_NONZERO_TABLE = bytes([0] + [1] * 255)
+
+
+def _reap(pid: int, child: int) -> None:
+    # The hypervisor is the real parent of the child and would keep a zombie around
+    with inject_syscall.attach(pid) as process:
+        flags = ptrace.WALL | os.WNOHANG
+        process.syscall(SYSCALL_NAMES["wait4"], child, 0, flags, 0)
+
+
+@contextmanager
+def fork_snapshot(
+    hv: "kvm.Hypervisor", slots: List[KvmMapping]
+) -> Generator[int, None, None]:
+    """
+    Makes the hypervisor fork a stopped child and yields its pid.
+    The child has a copy-on-write image of the guest memory, so the VM is only
+    paused while forking and the memory can be copied from the child at leisure.
+    Shared memory (i.e. memfd or hugetlbfs backed RAM) is not copied-on-write
+    and therefore still changes while the child is read.
+    """
+    with proc.openpid(hv.pid) as pid_fd:
+        smaps = pid_fd.smaps()
+    dontfork = []
+    for slot in slots:
+        if slot.hv_mapping.flags & mmap.MAP_SHARED:
+            print(
+                f"Warning: memslot at 0x{slot.physical_start:x} is shared memory, snapshot is not consistent",
+                file=sys.stderr,
+            )
+        flags = smaps.get(slot.hv_mapping.start, {}).get("VmFlags", "").split()
+        # qemu excludes guest memory from fork() by default
+        if "dc" in flags:
+            dontfork.append(slot)
+
+    with hv.attach() as tracee:
+        for slot in dontfork:
+            tracee.proc.madvise(slot.start, slot.size, MADV_DOFORK)
+        try:
+            child = tracee.proc.fork()
+        finally:
+            for slot in dontfork:
+                tracee.proc.madvise(slot.start, slot.size, MADV_DONTFORK)
+
+    try:
+        yield child
+    finally:
+        os.kill(child, signal.SIGKILL)
+        os.waitpid(child, ptrace.WALL)
+        _reap(hv.pid, child)
+
+
+def bitmap_runs(bitmap: bytes) -> List[Tuple[int, int]]:
+    """
+    Returns the (first, last + 1) page ranges of set bits in a KVM dirty bitmap.
+    The kernel sets bits in little-endian order, so bit n is in byte n // 8.
+    """
+    runs: List[Tuple[int, int]] = []
+
+    def add(first: int, last: int) -> None:
+        if runs and runs[-1][1] == first:
+            runs[-1] = (runs[-1][0], last)
+        else:
+            runs.append((first, last))
+
+    # skip over zero bytes in C
+    nonzero = bitmap.translate(_NONZERO_TABLE)
+    idx = nonzero.find(1)
+    while idx != -1:
+        end = nonzero.find(0, idx)
+        if end == -1:
+            end = len(bitmap)
+        for byte_idx in range(idx, end):
+            byte = bitmap[byte_idx]
+            page = byte_idx * 8
+            if byte == 0xFF:
+                add(page, page + 8)
+                continue
+            for bit in range(8):
+                if byte & (1 << bit):
+                    add(page + bit, page + bit + 1)
+        idx = nonzero.find(1, end)
+    return runs
+
+
+def _set_dirty_logging(
+    tracee: "kvm.Tracee", slots: List[Tuple[KvmMapping, int]], enable: bool
+) -> None:
+    for slot, _ in slots:
+        assert slot.memslot_id is not None
+        region = kvm.UserspaceMemoryRegion()
+        region.slot = slot.memslot_id
+        region.flags = slot.memslot_flags
+        if enable:
+            region.flags |= kvm.MEM_LOG_DIRTY_PAGES
+        region.guest_phys_addr = slot.physical_start
+        region.memory_size = slot.size
+        region.userspace_addr = slot.start
+        tracee.set_user_memory_region(region)
+
+
+def _dirty_chunks(
+    tracee: "kvm.Tracee", slots: List[Tuple[KvmMapping, int]]
+) -> List[Chunk]:
+    page_size = resource.getpagesize()
+    chunks = []
+    for slot, offset in slots:
+        assert slot.memslot_id is not None
+        bitmap = tracee.get_dirty_log(slot.memslot_id, slot.size // page_size)
+        for first, last in bitmap_runs(bitmap):
+            chunks.append(
+                Chunk(
+                    slot.start + first * page_size,
+                    offset + first * page_size,
+                    (last - first) * page_size,
+                )
+            )
+    return chunks
+
+
+def precopy_corefile(
+    hv: "kvm.Hypervisor",
+    core_file: IO[bytes],
+    slots: List[KvmMapping],
+    jobs: int = 1,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> None:
+    """
+    Writes a consistent core file like live migration does: all memory is
+    copied while the guest runs, then pages dirtied by the vcpus (according to
+    KVM's dirty log) are copied again until few enough are left to copy them
+    while the hypervisor is stopped.
+    Memslots the hypervisor already logs itself (i.e. the VGA framebuffer)
+    are left alone and copied during the stop.
+    Writes by the hypervisor itself, i.e. emulated DMA, are not in KVM's
+    dirty log and may be missed before the final stop.
+    """
+    tracked = []
+    untracked = []
+    for slot, offset in zip(slots, slot_offsets(slots, 0)):
+        if slot.memslot_id is None or slot.memslot_flags & kvm.MEM_LOG_DIRTY_PAGES:
+            untracked.append(Chunk(slot.start, offset, slot.size))
+        else:
+            tracked.append((slot, offset))
+
+    with mapped_corefile(core_file, slots) as (buf, ptr, _):
+        logging = False
+        try:
+            with hv.attach() as tracee:
+                _set_dirty_logging(tracee, tracked, True)
+                logging = True
+                # reset the bitmap, we copy everything next
+                _dirty_chunks(tracee, tracked)
+
+            chunks = [Chunk(slot.start, offset, slot.size) for slot, offset in tracked]
+            for i in range(PRECOPY_MAX_ROUNDS):
+                dirty = sum(c.size for c in chunks)
+                print(f"Pre-copy round {i}: {dirty // (1024 * 1024)} MiB")
+                start = time.monotonic()
+                stats = copy_chunks(hv.pid, ptr, batch_chunks(chunks, chunk_size), jobs)
+                print_copy_stats(stats, time.monotonic() - start, jobs)
+                with hv.attach() as tracee:
+                    chunks = _dirty_chunks(tracee, tracked)
+                if sum(c.size for c in chunks) <= PRECOPY_THRESHOLD:
+                    break
+
+            with hv.attach() as tracee:
+                start = time.monotonic()
+                # pages dirtied since the last round plus everything we do not track
+                chunks += _dirty_chunks(tracee, tracked)
+                chunks += untracked
+                dirty = sum(c.size for c in chunks)
+                copy_chunks(hv.pid, ptr, batch_chunks(chunks, chunk_size), jobs)
+                _set_dirty_logging(tracee, tracked, False)
+                logging = False
+                pause = time.monotonic() - start
+            print(
+                f"Stop-and-copy: {dirty // (1024 * 1024)} MiB, VM paused for {pause * 1000:.1f}ms"
+            )
+        finally:
+            if logging:
+                with hv.attach() as tracee:
+                    _set_dirty_logging(tracee, tracked, False)
+
+
+def generate_precopy_coredump(
+    hv: "kvm.Hypervisor", maps: List[KvmMapping], jobs: int = 1
+) -> None:
+    core_path = f"core.{hv.pid}"
+    print(f"Write {core_path}")
+    with open(core_path, "wb+") as core_file:
+        precopy_corefile(hv, core_file, maps, jobs)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import lzma
+import socket
+import sys
+import time
+import zlib
+from contextlib import contextmanager
+from typing import IO, Callable, Dict, Generator, List, Optional, Tuple
+
+from .coredump import core_headers, populated_slots, print_copy_stats
+from .proc import KvmMapping
+from .throttle import Throttle
+from .vmcopy import WorkerStats, read_ordered, split_chunks
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# smaller than vmcopy.DEFAULT_CHUNK_SIZE, up to STREAM_WINDOW * jobs chunks
+# are held in memory at once
+STREAM_CHUNK_SIZE = 8 * 1024 * 1024
+STREAM_WINDOW = 2
+
+
+def _gzip(data: bytes) -> bytes:
+    # wbits=31 writes a gzip member
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _xz(data: bytes) -> bytes:
+    return lzma.compress(data, format=lzma.FORMAT_XZ, preset=1)
+
+
+def _zstd(data: bytes) -> bytes:
+    # ZstdCompressor is not thread-safe
+    return zstandard.ZstdCompressor(level=3).compress(data)  # type: ignore
+
+
+def _identity(data: bytes) -> bytes:
+    return data
+
+
+# Each chunk is compressed independently into a complete gzip member, xz stream
+# or zstd frame. Concatenations of those are valid files for gzip -d, xz -d and
+# zstd -d, so chunks can be compressed in parallel.
+COMPRESSORS: Dict[str, Callable[[bytes], bytes]] = {
+    "none": _identity,
+    "gzip": _gzip,
+    "xz": _xz,
+}
+if zstandard is not None:
+    COMPRESSORS["zstd"] = _zstd
+
+
+@contextmanager
+def open_stream(dest: str) -> Generator[IO[bytes], None, None]:
+    """
+    Opens stdout for "-" or connects to the Unix socket at dest.
+    """
+    if dest == "-":
+        yield sys.stdout.buffer
+        sys.stdout.buffer.flush()
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(dest)
+        with sock.makefile("wb") as f:
+            yield f
+        sock.shutdown(socket.SHUT_WR)
+
+
+def stream_corefile(
+    pid: int,
+    out: IO[bytes],
+    slots: List[KvmMapping],
+    jobs: int = 1,
+    compress: Callable[[bytes], bytes] = _identity,
+    chunk_size: int = STREAM_CHUNK_SIZE,
+    throttle: Optional[Throttle] = None,
+) -> Tuple[int, List[WorkerStats]]:
+    """
+    Writes the core file as an ordered stream to out. Workers copy and compress
+    chunks in parallel, while at most STREAM_WINDOW * jobs chunks are in flight.
+    Returns the number of written bytes and the stats of the workers.
+    """
+    headers, offset = core_headers(slots)
+    written = 0
+
+    def emit(data: bytes) -> None:
+        nonlocal written
+        out.write(data)
+        written += len(data)
+
+    # padding up to the first segment
+    emit(compress(bytes(headers) + bytes(offset - len(headers))))
+
+    stats: Dict[str, WorkerStats] = {}
+    batches = split_chunks(slots, offset, chunk_size)
+    for data in read_ordered(
+        pid,
+        batches,
+        lambda _, data: compress(data),
+        jobs,
+        stats,
+        STREAM_WINDOW,
+        throttle,
+    ):
+        emit(data)
+    return written, sorted(stats.values(), key=lambda s: s.name)
+
+
+def generate_stream_coredump(
+    pid: int,
+    maps: List[KvmMapping],
+    dest: str,
+    jobs: int = 1,
+    compression: str = "none",
+    sparse: bool = False,
+    throttle: Optional[Throttle] = None,
+) -> None:
+    # stdout may be the dump itself
+    log = sys.stderr
+    if sparse:
+        maps = populated_slots(pid, maps)
+    print(f"Stream core.{pid} to {dest} ({compression})", file=log)
+    start = time.monotonic()
+    with open_stream(dest) as out:
+        written, stats = stream_corefile(
+            pid, out, maps, jobs, COMPRESSORS[compression], throttle=throttle
+        )
+    elapsed = time.monotonic() - start
+    print_copy_stats(stats, elapsed, jobs, file=log)
+    size = sum(slot.size for slot in maps)
+    ratio = written / size if size else 1.0
+    print(
+        f"Wrote {written // (1024 * 1024)} MiB ({ratio:.1%} of guest memory)",
+        file=log,
+    )
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import re
+import threading
+import time
+from typing import IO, List, Optional
+
+from . import proc
+
+# process_vm_readv calls are split into this many bytes, so a throttled copy
+# does not burst at full speed for a whole batch
+THROTTLE_CHUNK_SIZE = 1024 * 1024
+# used for adaptive mode without --max-bandwidth
+ADAPTIVE_START_BANDWIDTH = 1024 * 1024 * 1024
+MIN_BANDWIDTH = 16 * 1024 * 1024
+# how often the vCPU run delay is sampled
+SAMPLE_INTERVAL = 0.5
+# back off once vCPUs wait for a CPU this much longer (seconds per second)
+# than before the dump started
+RUN_DELAY_THRESHOLD = 0.01
+
+# qemu: "CPU 0/KVM", cloud-hypervisor: "vcpu0", firecracker: "fc_vcpu 0"
+_VCPU_THREAD = re.compile(r"CPU \d+/KVM|vcpu", re.IGNORECASE)
+
+
+class RunDelay:
+    """
+    Sums the time the vCPU threads of a hypervisor spent waiting on a run
+    queue, as reported by /proc/<pid>/task/<tid>/schedstat.
+    All threads are used if none is recognized as a vCPU thread.
+    """
+
+    def __init__(self, pid: int) -> None:
+        self.files: List[IO[bytes]] = []
+        with proc.openpid(pid) as pid_fd:
+            threads = pid_fd.threads()
+            tids = [tid for tid, name in threads.items() if _VCPU_THREAD.search(name)]
+            for tid in tids or list(threads):
+                try:
+                    path = pid_fd.entry(f"task/{tid}/schedstat")
+                    self.files.append(open(path, "rb", buffering=0))
+                except FileNotFoundError:
+                    continue
+
+    def read(self) -> int:
+        """
+        Returns the total run delay of all threads in nanoseconds.
+        """
+        total = 0
+        for f in list(self.files):
+            try:
+                f.seek(0)
+                # run time, run delay, timeslices
+                total += int(f.read().split()[1])
+            except (OSError, IndexError):
+                # thread exited
+                self.files.remove(f)
+                f.close()
+        return total
+
+    @property
+    def threads(self) -> int:
+        return len(self.files)
+
+    def close(self) -> None:
+        for f in self.files:
+            f.close()
+
+
+class Throttle:
+    """
+    Paces copies from the hypervisor to at most max_bandwidth bytes per second
+    for all workers together. If run_delay is given, the bandwidth is adapted
+    like TCP congestion control: halved when the vCPUs wait for a CPU more
+    often than before the dump started, and increased slowly otherwise.
+    """
+
+    def __init__(
+        self, max_bandwidth: Optional[int], run_delay: Optional[RunDelay] = None
+    ) -> None:
+        self.max_bandwidth = max_bandwidth
+        self.run_delay = run_delay
+        self.rate: Optional[float] = max_bandwidth
+        self.lock = threading.Lock()
+        self.next_free = time.monotonic()
+        self.sample_time = self.next_free
+        self.sample_delay = 0
+        self.baseline = 0.0
+        if run_delay is not None:
+            if self.rate is None:
+                self.rate = ADAPTIVE_START_BANDWIDTH
+            self.baseline = self._calibrate()
+
+    def _calibrate(self) -> float:
+        assert self.run_delay is not None
+        self.sample_time = time.monotonic()
+        self.sample_delay = self.run_delay.read()
+        time.sleep(SAMPLE_INTERVAL)
+        baseline = self._sample(time.monotonic())
+        assert baseline is not None
+        return baseline
+
+    def _sample(self, now: float) -> Optional[float]:
+        """
+        Returns the run delay per vCPU and second since the last sample,
+        or None if the last sample is too recent.
+        """
+        assert self.run_delay is not None
+        elapsed = now - self.sample_time
+        if elapsed < SAMPLE_INTERVAL:
+            return None
+        delay = self.run_delay.read()
+        per_second = (delay - self.sample_delay) / 1e9 / elapsed
+        self.sample_time = now
+        self.sample_delay = delay
+        return per_second / max(self.run_delay.threads, 1)
+
+    def _adapt(self, now: float) -> None:
+        assert self.rate is not None
+        delay = self._sample(now)
+        if delay is None:
+            return
+        if delay > self.baseline + RUN_DELAY_THRESHOLD:
+            self.rate = max(self.rate / 2, MIN_BANDWIDTH)
+        else:
+            step = (self.max_bandwidth or ADAPTIVE_START_BANDWIDTH) / 16
+            self.rate += step
+            if self.max_bandwidth is not None:
+                self.rate = min(self.rate, self.max_bandwidth)
+
+    def acquire(self, n: int) -> None:
+        """
+        Blocks until n more bytes may be copied.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.run_delay is not None:
+                self._adapt(now)
+            if self.rate is None:
+                return
+            # do not save up idle time for later bursts
+            start = max(self.next_free, now)
+            self.next_free = start + n / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+    def describe(self) -> str:
+        mib = 1024 * 1024
+        limit = "unlimited"
+        if self.max_bandwidth is not None:
+            limit = f"{self.max_bandwidth // mib} MiB/s"
+        if self.run_delay is None:
+            return f"max bandwidth {limit}"
+        assert self.rate is not None
+        return f"adaptive up to {limit}, now {self.rate / mib:.0f} MiB/s, {self.run_delay.threads} vCPU threads, baseline run delay {self.baseline * 1000:.1f}ms/s"
+
+    def close(self) -> None:
+        if self.run_delay is not None:
+            self.run_delay.close()
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+
+import ctypes
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass
+from functools import partial
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    TypeVar,
+)
+
+from .hugepage import copy_align
+from .libc import iovec, libc
+from .proc import KvmMapping
+from .throttle import THROTTLE_CHUNK_SIZE, Throttle
+
+T = TypeVar("T")
+
+IOV_MAX = os.sysconf("SC_IOV_MAX")
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+@dataclass
+class Chunk:
+    # address in the hypervisor
+    src: int
+    # offset in the destination buffer
+    offset: int
+    size: int
+
+
+@dataclass
+class WorkerStats:
+    name: str
+    bytes: int = 0
+    seconds: float = 0.0
+
+    @property
+    def bandwidth(self) -> float:
+        if self.seconds == 0:
+            return 0.0
+        return self.bytes / self.seconds
+
+    def __repr__(self) -> str:
+        return "%s(%r, %d MiB in %.2fs, %.1f MiB/s)" % (
+            self.__class__.__name__,
+            self.name,
+            self.bytes // (1024 * 1024),
+            self.seconds,
+            self.bandwidth / (1024 * 1024),
+        )
+
+
+class Progress:
+    """
+    Prints the copied amount and bandwidth at most every interval seconds.
+    """
+
+    def __init__(self, total: int, done: int = 0, interval: float = 1.0) -> None:
+        self.total = total
+        self.done = done
+        self.interval = interval
+        self.start = time.monotonic()
+        self.copied = 0
+        self.last = self.start
+        self.lock = threading.Lock()
+
+    def update(self, n: int) -> None:
+        with self.lock:
+            self.done += n
+            self.copied += n
+            now = time.monotonic()
+            if now - self.last < self.interval:
+                return
+            self.last = now
+            self._print(now)
+
+    def _print(self, now: float) -> None:
+        mib = 1024 * 1024
+        bandwidth = self.copied / max(now - self.start, 1e-9)
+        percent = 100 * self.done / self.total if self.total else 100
+        eta = (self.total - self.done) / bandwidth if bandwidth else 0
+        end = "" if sys.stderr.isatty() else "\n"
+        print(
+            f"\r{self.done // mib}/{self.total // mib} MiB ({percent:.1f}%), {bandwidth / mib:.1f} MiB/s, {eta:.0f}s left",
+            end=end,
+            file=sys.stderr,
+            flush=True,
+        )
+
+    def finish(self) -> None:
+        self._print(time.monotonic())
+        if sys.stderr.isatty():
+            print(file=sys.stderr)
+
+
+def batch_chunks(
+    chunks: Iterable[Chunk], chunk_size: int = DEFAULT_CHUNK_SIZE, align: int = 1
+) -> List[List[Chunk]]:
+    """
+    Groups chunks into batches of at most chunk_size bytes and IOV_MAX
+    chunks, so each batch can be copied with a single process_vm_readv call.
+    Larger chunks are split at source addresses that are a multiple of align
+    where possible, so huge pages are not shared between batches.
+    """
+    batches: List[List[Chunk]] = []
+    batch: List[Chunk] = []
+    batch_size = 0
+    for chunk in chunks:
+        done = 0
+        while done < chunk.size:
+            size = min(chunk.size - done, chunk_size - batch_size)
+            if size < chunk.size - done:
+                src = chunk.src + done
+                aligned = (src + size) // align * align - src
+                if aligned > 0:
+                    size = aligned
+                elif batch:
+                    # start a new batch instead of splitting a huge page
+                    batches.append(batch)
+                    batch = []
+                    batch_size = 0
+                    continue
+            batch.append(Chunk(chunk.src + done, chunk.offset + done, size))
+            batch_size += size
+            done += size
+            split = done < chunk.size
+            if split or batch_size == chunk_size or len(batch) == IOV_MAX:
+                batches.append(batch)
+                batch = []
+                batch_size = 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def slot_offsets(slots: Iterable[KvmMapping], offset: int) -> List[int]:
+    """
+    Returns the destination offset of each memslot if they are placed
+    back-to-back starting at offset.
+    """
+    offsets = []
+    for slot in slots:
+        offsets.append(offset)
+        offset += slot.size
+    return offsets
+
+
+def split_chunks(
+    slots: Iterable[KvmMapping], offset: int, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> List[List[Chunk]]:
+    """
+    Splits the memslots into batches (see batch_chunks), small slots are merged.
+    The memslots are placed back-to-back in the destination starting at offset.
+    Batches are split at boundaries of the largest page size of the slots.
+    """
+    slots = list(slots)
+    chunks = (
+        Chunk(slot.start, slot_offset, slot.size)
+        for slot, slot_offset in zip(slots, slot_offsets(slots, offset))
+    )
+    return batch_chunks(chunks, chunk_size, copy_align(slots, chunk_size))
+
+
+def read_chunks(
+    pid: int, dst: int, chunks: List[Chunk], throttle: Optional[Throttle] = None
+) -> int:
+    """
+    Copies chunks from pid to the local address dst + chunk.offset.
+    With a throttle, the copy is split into paced THROTTLE_CHUNK_SIZE pieces.
+    """
+    if throttle is not None:
+        copied = 0
+        for piece in batch_chunks(chunks, THROTTLE_CHUNK_SIZE):
+            throttle.acquire(sum(chunk.size for chunk in piece))
+            copied += read_chunks(pid, dst, piece)
+        return copied
+    return _transfer(libc.process_vm_readv, pid, dst, chunks)
+
+
+def write_chunks(pid: int, src: int, chunks: List[Chunk]) -> int:
+    """
+    Copies the local address src + chunk.offset to chunk.src in pid.
+    """
+    return _transfer(libc.process_vm_writev, pid, src, chunks)
+
+
+def _transfer(
+    syscall: Callable[..., int], pid: int, local: int, chunks: List[Chunk]
+) -> int:
+    """
+    The kernel may stop a transfer early at an iovec boundary,
+    in this case we retry with the remaining chunks.
+    """
+    assert len(chunks) <= IOV_MAX
+    total = 0
+    while chunks:
+        remote_iovecs = (iovec * len(chunks))()
+        local_iovecs = (iovec * len(chunks))()
+        for remote_iov, local_iov, chunk in zip(remote_iovecs, local_iovecs, chunks):
+            remote_iov.iov_base = chunk.src
+            remote_iov.iov_len = chunk.size
+            local_iov.iov_base = local + chunk.offset
+            local_iov.iov_len = chunk.size
+        n = syscall(
+            pid, local_iovecs, len(local_iovecs), remote_iovecs, len(remote_iovecs), 0
+        )
+        if n == 0:
+            raise OSError(f"{syscall.__name__} made no progress at 0x{chunks[0].src:x}")
+        total += n
+        remaining = []
+        for chunk in chunks:
+            if n >= chunk.size:
+                n -= chunk.size
+                continue
+            remaining.append(Chunk(chunk.src + n, chunk.offset + n, chunk.size - n))
+            n = 0
+        chunks = remaining
+    return total
+
+
+def _account(
+    stats: Dict[str, WorkerStats], lock: threading.Lock, n: int, seconds: float
+) -> None:
+    name = threading.current_thread().name
+    with lock:
+        worker = stats.setdefault(name, WorkerStats(name))
+        worker.bytes += n
+        worker.seconds += seconds
+
+
+@dataclass
+class BatchGroup:
+    batches: List[List[Chunk]]
+    jobs: int = 1
+    # pins the workers of the group, i.e. to the CPUs of a NUMA node
+    cpus: Optional[Set[int]] = None
+    name: str = "copy"
+
+
+def run_groups(
+    work: Callable[[List[Chunk]], int], groups: List[BatchGroup]
+) -> List[WorkerStats]:
+    """
+    Runs work on all batches, each group with its own pool of group.jobs
+    threads, and accounts the bytes it returns to the thread. ctypes releases
+    the GIL during process_vm_readv, so threads copy in parallel.
+    """
+    stats: Dict[str, WorkerStats] = {}
+    lock = threading.Lock()
+    # lets queued batches finish fast after an error or Ctrl-C
+    stop = threading.Event()
+
+    def run(batch: List[Chunk]) -> None:
+        if stop.is_set():
+            return
+        start = time.monotonic()
+        n = work(batch)
+        _account(stats, lock, n, time.monotonic() - start)
+
+    with ExitStack() as stack:
+        futures: List["Future[None]"] = []
+        for group in groups:
+            initializer = None
+            if group.cpus is not None:
+                # pid 0 is the calling thread
+                initializer = partial(os.sched_setaffinity, 0, group.cpus)
+            executor = ThreadPoolExecutor(
+                max_workers=max(group.jobs, 1),
+                thread_name_prefix=group.name,
+                initializer=initializer,
+            )
+            stack.enter_context(executor)
+            futures.extend(executor.submit(run, batch) for batch in group.batches)
+        try:
+            for future in futures:
+                # re-raises exceptions from the workers
+                future.result()
+        except BaseException:
+            stop.set()
+            raise
+    return sorted(stats.values(), key=lambda s: s.name)
+
+
+def run_batches(
+    work: Callable[[List[Chunk]], int], batches: List[List[Chunk]], jobs: int = 1
+) -> List[WorkerStats]:
+    return run_groups(work, [BatchGroup(batches, jobs)])
+
+
+def copy_groups(
+    pid: int,
+    dst: int,
+    groups: List[BatchGroup],
+    on_batch: Optional[Callable[[List[Chunk]], None]] = None,
+    throttle: Optional[Throttle] = None,
+) -> List[WorkerStats]:
+    """
+    Copies all batches to dst.
+    on_batch is called from the worker thread after each copied batch.
+    """
+
+    def work(batch: List[Chunk]) -> int:
+        n = read_chunks(pid, dst, batch, throttle)
+        if on_batch is not None:
+            on_batch(batch)
+        return n
+
+    return run_groups(work, groups)
+
+
+def copy_chunks(
+    pid: int,
+    dst: int,
+    batches: List[List[Chunk]],
+    jobs: int = 1,
+    on_batch: Optional[Callable[[List[Chunk]], None]] = None,
+    throttle: Optional[Throttle] = None,
+) -> List[WorkerStats]:
+    """
+    Copies all batches to dst with a pool of jobs threads.
+    """
+    return copy_groups(pid, dst, [BatchGroup(batches, jobs)], on_batch, throttle)
+
+
+def read_ordered(
+    pid: int,
+    batches: List[List[Chunk]],
+    process: Callable[[List[Chunk], bytes], T],
+    jobs: int = 1,
+    stats: Optional[Dict[str, WorkerStats]] = None,
+    window: int = 2,
+    throttle: Optional[Throttle] = None,
+) -> Iterator[T]:
+    """
+    Reads each batch into its own buffer in a pool of jobs threads and yields
+    process(batch, data) in the order of batches, where data holds the chunks
+    of the batch back-to-back. At most window * jobs batches are in flight,
+    which bounds the memory used by sequential writers.
+    """
+    if stats is None:
+        stats = {}
+    lock = threading.Lock()
+
+    def work(batch: List[Chunk]) -> T:
+        start = time.monotonic()
+        local = []
+        pos = 0
+        for chunk in batch:
+            local.append(Chunk(chunk.src, pos, chunk.size))
+            pos += chunk.size
+        buf = ctypes.create_string_buffer(pos)
+        n = read_chunks(pid, ctypes.addressof(buf), local, throttle)
+        result = process(batch, buf.raw)
+        _account(stats, lock, n, time.monotonic() - start)
+        return result
+
+    max_pending = max(jobs, 1) * window
+    pending: "Deque[Future[T]]" = deque()
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        for batch in batches:
+            pending.append(executor.submit(work, batch))
+            # only ever wait for the oldest batch
+            if len(pending) == max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
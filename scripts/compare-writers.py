@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Compares the throughput and page cache usage of the core file writers by
+dumping a buffer of this process, i.e.:
+
+    python scripts/compare-writers.py --size 4096 --dir /var/tmp
+"""
+
+import argparse
+import ctypes
+import mmap
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from kvm_pirate import proc  # noqa: E402
+from kvm_pirate.coredump import generate_coredump  # noqa: E402
+
+
+def meminfo(field: str) -> int:
+    with open("/proc/meminfo") as f:
+        for line in f:
+            name, value = line.split(":")
+            if name == field:
+                return int(value.split()[0]) * 1024
+    raise KeyError(field)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=1024, help="MiB to dump")
+    parser.add_argument("--dir", default=".", help="where to write the cores")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    mem = mmap.mmap(-1, size)
+    # incompressible and not zero, so every page is written
+    block = os.urandom(1024 * 1024)
+    for offset in range(0, size, len(block)):
+        end = offset + len(block)
+        mem[offset:end] = block
+    buf = (ctypes.c_char * size).from_buffer(mem)
+    start = ctypes.addressof(buf)
+    mapping = proc.Mapping(start, start + size, mmap.PROT_READ, 0, 0, 0, 0, "")
+    slot = proc.KvmMapping(**mapping.__dict__, physical_start=0, hv_mapping=mapping)
+
+    results = []
+    for io in ["mmap", "uncached", "direct"]:
+        core_path = os.path.join(args.dir, f"core.{io}")
+        os.sync()
+        cached = meminfo("Cached")
+        begin = time.monotonic()
+        generate_coredump(os.getpid(), [slot], args.jobs, core_path=core_path, io=io)
+        elapsed = time.monotonic() - begin
+        growth = meminfo("Cached") - cached
+        os.unlink(core_path)
+        results.append((io, size / elapsed, growth))
+
+    print(f"{'io':<10}{'MiB/s':>10}{'page cache MiB':>16}")
+    for io, bandwidth, growth in results:
+        print(
+            f"{io:<10}{bandwidth / (1024 * 1024):>10.1f}{growth // (1024 * 1024):>16}"
+        )
+    del buf
+    mem.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+from kvm_pirate.addrspace import MAP_EXEC, MAP_USER, MAP_WRITE, address_space
+from kvm_pirate.guestmem import GuestMemory
+from kvm_pirate.pagetable import (
+    CR4_LA57,
+    CR4_PAE,
+    EFER_LMA,
+    EFER_NXE,
+    PTE_PRESENT,
+    PTE_PS,
+    PTE_RW,
+    PageTableWalker,
+)
+
+from test_coredump import fake_slot
+from test_pagetable import LARGE_PAGE, PAGE, PML4, PML5, PT, make_memory, set_entry
+
+pytest.importorskip("numpy")
+
+ALL = MAP_WRITE | MAP_USER | MAP_EXEC
+
+
+@pytest.mark.parametrize("cr3,cr4", [(PML4, CR4_PAE), (PML5, CR4_PAE | CR4_LA57)])
+def test_address_space(cr3: int, cr4: int) -> None:
+    buf = make_memory()
+    # contiguous with the same permissions, merged into one range
+    set_entry(buf, PT, 3, 0x7000 | PTE_PRESENT)
+    set_entry(buf, PT, 4, 0x8000 | PTE_PRESENT)
+    # the last GiB of the address space
+    set_entry(buf, PML4, 511, 0x9000 | PTE_RW | PTE_PRESENT)
+    set_entry(buf, 0x9000, 511, 0x40000000 | PTE_PS | PTE_RW | PTE_PRESENT)
+    with GuestMemory(os.getpid(), [fake_slot(buf, 0)]) as memory:
+        walker = PageTableWalker(memory, cr3, cr4, EFER_LMA | EFER_NXE)
+        ranges = list(address_space(walker))
+    expected = [
+        (0x1000, PAGE, 0x1000, MAP_USER),
+        (0x2000, PAGE, 0x1000, MAP_WRITE | MAP_EXEC),
+        (0x3000, 0x7000, 0x2000, MAP_EXEC),
+        (0x200000, LARGE_PAGE, 0x200000, ALL),
+        (0x40000000, 0, 0x40000000, ALL),
+    ]
+    last_gib = 0xFFFF_FFFF_C000_0000
+    if cr3 == PML5:
+        # the lower half only ends at 2^56
+        last_gib = 0x0000_FFFF_C000_0000
+    expected.append((last_gib, 0x40000000, 0x40000000, MAP_WRITE | MAP_EXEC))
+    assert ranges == expected
@@ -0,0 +1,141 @@
+import mmap
+import os
+import struct
+import tempfile
+from typing import List
+
+import pytest
+
+from kvm_pirate import bpfcache
+
+from kvm_pirate.bpfcache import (
+    BPF_LD_IMM64,
+    BPF_PSEUDO_MAP_FD,
+    BPF_RINGBUF_BUSY_BIT,
+    BPF_RINGBUF_DISCARD_BIT,
+    CacheDir,
+    CompiledProgram,
+    MapSpec,
+    RingBuffer,
+    cache_key,
+    relocate,
+)
+
+
+def insn(code: int, regs: int = 0, off: int = 0, imm: int = 0) -> bytes:
+    return struct.pack("<BBhi", code, regs, off, imm)
+
+
+def test_relocate() -> None:
+    exit_insn = insn(0x95)
+    insns = (
+        # r1 = map fd 3
+        insn(BPF_LD_IMM64, (BPF_PSEUDO_MAP_FD << 4) | 1, imm=3)
+        + insn(0)
+        # r2 = 3, a plain 64-bit immediate
+        + insn(BPF_LD_IMM64, 2, imm=3)
+        + insn(0)
+        + exit_insn
+    )
+    relocated = relocate(insns, {3: 42})
+    assert struct.unpack_from("<i", relocated, 4)[0] == 42
+    assert relocated[16:] == insns[16:]
+
+
+def test_cache_round_trip() -> None:
+    compiled = CompiledProgram(
+        prog_type=2,
+        license="GPL",
+        kern_version=0,
+        functions={"kvm_vm_ioctl": insn(0x95)},
+        maps=[MapSpec("slots_cpu", 2, 4, 4, 1, 0, 3)],
+    )
+    with tempfile.TemporaryDirectory() as cache:
+        path = os.path.join(cache, "bpf", "prog.json")
+        compiled.save(path)
+        assert CompiledProgram.load(path) == compiled
+    assert cache_key("text", ["-DTARGET_PID=1"]) != cache_key(
+        "text", ["-DTARGET_PID=2"]
+    )
+
+
+def test_rejected_cache_entry(monkeypatch: pytest.MonkeyPatch) -> None:
+    stale = CompiledProgram(2, "GPL", 0, {"probe": insn(0)}, [])
+    fresh = CompiledProgram(2, "GPL", 0, {"probe": insn(0x95)}, [])
+    compiled: List[CompiledProgram] = []
+
+    def compile_kprobes(*args: object) -> CompiledProgram:
+        compiled.append(fresh)
+        return fresh
+
+    class Program:
+        def __init__(self, program: CompiledProgram) -> None:
+            if program != fresh:
+                raise OSError(13, "verifier rejected the program")
+            self.compiled = program
+
+        def close(self) -> None:
+            pass
+
+    monkeypatch.setattr(bpfcache, "compile_kprobes", compile_kprobes)
+    monkeypatch.setattr(bpfcache, "LoadedProgram", Program)
+    with tempfile.TemporaryDirectory() as cache:
+        stale.save(os.path.join(cache, f"{cache_key('text', [])}.json"))
+        prog = bpfcache.load_kprobes("text", [], ["probe"], cache)
+        assert prog.compiled == fresh
+        assert compiled == [fresh]
+        # the recompiled program replaced the rejected one
+        bpfcache.load_kprobes("text", [], ["probe"], cache)
+        assert compiled == [fresh]
+
+
+def test_cache_argument(monkeypatch: pytest.MonkeyPatch) -> None:
+    program = CompiledProgram(2, "GPL", 0, {"probe": insn(0x95)}, [])
+    monkeypatch.setattr(bpfcache, "compile_kprobes", lambda *args: program)
+    monkeypatch.setattr(bpfcache, "LoadedProgram", lambda compiled: compiled)
+    with tempfile.TemporaryDirectory() as home:
+        # looked up on each load, not at import time
+        monkeypatch.setenv("XDG_CACHE_HOME", home)
+        bpfcache.load_kprobes("text", [], ["probe"], None)
+        assert os.listdir(home) == []
+        bpfcache.load_kprobes("text", [], ["probe"], CacheDir.DEFAULT)
+        cached = os.path.join(home, "kvm-pirate", "bpf")
+        assert os.listdir(cached) == [f"{cache_key('text', [])}.json"]
+
+
+def test_ring_buffer() -> None:
+    page = mmap.PAGESIZE
+    size = page
+    record = struct.Struct("<IQ")
+    stride = 24
+    # consumer page, producer page and the data pages, which the kernel maps
+    # twice in a row
+    fd = os.memfd_create("ringbuf")
+    try:
+        os.ftruncate(fd, 2 * page + 2 * size)
+        data = bytearray(size)
+        # the second record wraps around
+        consumer = size - stride
+        headers = [record.size, record.size | BPF_RINGBUF_DISCARD_BIT, record.size]
+        headers.append(record.size | BPF_RINGBUF_BUSY_BIT)
+        pos = consumer
+        for i, header in enumerate(headers):
+            raw = struct.pack("<II", header, 0) + record.pack(i, i * 2**40)
+            for j, byte in enumerate(raw):
+                data[(pos + j) % size] = byte
+            pos += stride
+        os.pwrite(fd, struct.pack("<Q", consumer), 0)
+        os.pwrite(fd, struct.pack("<Q", pos), page)
+        os.pwrite(fd, bytes(data) * 2, 2 * page)
+
+        ring = RingBuffer(fd, size)
+        try:
+            assert ring.wait(0)
+            assert ring.read_fixed(record) == [(0, 0), (2, 2 * 2**40)]
+            # stopped at the busy record
+            consumed = struct.unpack("<Q", os.pread(fd, 8, 0))[0]
+            assert consumed == consumer + 3 * stride
+        finally:
+            ring.close()
+    finally:
+        os.close(fd)
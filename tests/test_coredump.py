@@ -0,0 +1,104 @@
+import ctypes
+import mmap
+import os
+import tempfile
+from typing import List
+
+from kvm_pirate import proc, vmcopy
+from kvm_pirate.coredump import core_headers, write_corefile, write_corefile_uncached
+from kvm_pirate.elf import Ehdr, Phdr, Shdr
+from kvm_pirate.elf.consts import PN_XNUM
+
+
+def fake_slot(
+    buf: "ctypes.Array[ctypes.c_char]", physical_start: int
+) -> proc.KvmMapping:
+    start = ctypes.addressof(buf)
+    mapping = proc.Mapping(start, start + len(buf), mmap.PROT_READ, 0, 0, 0, 0, "")
+    return proc.KvmMapping(
+        **mapping.__dict__, physical_start=physical_start, hv_mapping=mapping
+    )
+
+
+def read_segments(path: str) -> List[bytes]:
+    with open(path, "rb") as f:
+        data = f.read()
+    ehdr = Ehdr.from_buffer_copy(data)
+    phnum = ehdr.e_phnum
+    if phnum == PN_XNUM:
+        phnum = Shdr.from_buffer_copy(data, ehdr.e_shoff).sh_info
+    segments = []
+    for i in range(phnum):
+        ph = Phdr.from_buffer_copy(data, ehdr.e_phoff + i * ehdr.e_phentsize)
+        start = ph.p_offset
+        end = start + ph.p_filesz
+        segments.append(data[start:end])
+    return segments
+
+
+def test_split_chunks() -> None:
+    bufs = [ctypes.create_string_buffer(10), ctypes.create_string_buffer(25)]
+    slots = [fake_slot(buf, 0) for buf in bufs]
+    batches = vmcopy.split_chunks(slots, 100, chunk_size=16)
+    assert [sum(c.size for c in batch) for batch in batches] == [16, 16, 3]
+    # the first batch merges the end of the first slot with the second slot
+    assert batches[0][0] == vmcopy.Chunk(slots[0].start, 100, 10)
+    assert batches[0][1] == vmcopy.Chunk(slots[1].start, 110, 6)
+    assert batches[2][0] == vmcopy.Chunk(slots[1].start + 22, 132, 3)
+
+
+def test_write_corefile() -> None:
+    contents = [os.urandom(3 * 4096), os.urandom(5 * 4096 + 7)]
+    bufs = [ctypes.create_string_buffer(c, len(c)) for c in contents]
+    slots = [fake_slot(buf, i * 0x100000) for i, buf in enumerate(bufs)]
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "core")
+        with open(path, "wb+") as f:
+            write_corefile(os.getpid(), f, slots, jobs=3, chunk_size=4096)
+        assert read_segments(path) == contents
+
+
+def test_sparse_corefile() -> None:
+    page_size = mmap.PAGESIZE
+    mem = mmap.mmap(-1, 8 * page_size)
+    data = os.urandom(page_size)
+    # page 0 and 2 hold data, page 3 is faulted in but zero, the rest is untouched
+    mem.write(data)
+    mem.seek(2 * page_size)
+    mem.write(data)
+    mem[3 * page_size] = 0
+    buf = (ctypes.c_char * len(mem)).from_buffer(mem)
+    slot = fake_slot(buf, 0x100000)
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "core")
+        with open(path, "wb+") as f:
+            write_corefile(os.getpid(), f, [slot], sparse=True)
+        assert read_segments(path) == [data, data + bytes(page_size)]
+    del buf
+    mem.close()
+
+
+def test_core_headers_extnum() -> None:
+    buf = ctypes.create_string_buffer(mmap.PAGESIZE)
+    slots = [fake_slot(buf, 0)] * (PN_XNUM + 1)
+    headers, offset = core_headers(slots)
+    ehdr = Ehdr.from_buffer_copy(headers)
+    assert ehdr.e_phnum == PN_XNUM
+    shdr = Shdr.from_buffer_copy(headers, ehdr.e_shoff)
+    assert shdr.sh_info == len(slots)
+    assert offset >= len(headers)
+
+
+def test_write_corefile_uncached() -> None:
+    page_size = mmap.PAGESIZE
+    contents = [os.urandom(3 * page_size), os.urandom(page_size) + bytes(page_size)]
+    bufs = [ctypes.create_string_buffer(c, len(c)) for c in contents]
+    slots = [fake_slot(buf, i * 0x100000) for i, buf in enumerate(bufs)]
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "core")
+        for direct in [False, True]:
+            with open(path, "wb+") as f:
+                write_corefile_uncached(
+                    os.getpid(), f, slots, jobs=2, chunk_size=page_size, direct=direct
+                )
+            assert read_segments(path) == contents
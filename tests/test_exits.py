@@ -0,0 +1,41 @@
+import io
+from collections import Counter
+
+from kvm_pirate.exits import (
+    ISA_SVM,
+    ISA_VMX,
+    ExitStats,
+    exit_reason_name,
+    render_top,
+)
+
+
+def test_exit_reason_name() -> None:
+    assert exit_reason_name(ISA_VMX, 48) == "EPT_VIOLATION"
+    # failed VM entry flag
+    assert exit_reason_name(ISA_VMX, (1 << 31) | 33) == "INVALID_STATE"
+    assert exit_reason_name(ISA_SVM, 0x400) == "NPF"
+    assert exit_reason_name(ISA_SVM, 0x13) == "WRITE_CR3"
+    assert exit_reason_name(ISA_SVM, 0x4E) == "EXCP_14"
+    assert exit_reason_name(ISA_SVM, 0x500) == "SVM_0x500"
+
+
+def test_render_top() -> None:
+    first = ExitStats(exits=Counter({(0, ISA_VMX, 30): 10}))
+    second = ExitStats(
+        exits=Counter({(0, ISA_VMX, 30): 210, (1, ISA_VMX, 12): 50}),
+        exit_time=Counter({(ISA_VMX, 30): 400_000, (ISA_VMX, 12): 50_000_000}),
+        latency=Counter({(ISA_VMX, 30, 11): 200, (ISA_VMX, 12, 20): 50}),
+        pio=Counter({(0x3F8, 1): 200}),
+    )
+    delta = second - first
+    assert delta.exits == Counter({(0, ISA_VMX, 30): 200, (1, ISA_VMX, 12): 50})
+
+    out = io.StringIO()
+    render_top(out, delta, 2.0)
+    lines = out.getvalue().splitlines()
+    assert lines[0] == "125 exits/s"
+    assert lines[3].split() == ["IO_INSTRUCTION", "100", "2.0us", "0.0%"]
+    assert lines[4].split() == ["HLT", "25", "1.0ms", "2.5%"]
+    assert "0x3f8 write" in out.getvalue()
+    assert "latency of IO_INSTRUCTION:" in lines
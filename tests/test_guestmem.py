@@ -0,0 +1,74 @@
+import ctypes
+import mmap
+import os
+
+import pytest
+
+from kvm_pirate import proc
+from kvm_pirate.guestmem import AddressError, GuestMemory, GuestRam
+
+from test_coredump import fake_slot
+
+
+def test_memfd_is_mapped() -> None:
+    page_size = mmap.PAGESIZE
+    fd = os.memfd_create("guest-ram")
+    try:
+        os.ftruncate(fd, 4 * page_size)
+        mem = mmap.mmap(fd, 4 * page_size, mmap.MAP_SHARED)
+        mem.write(os.urandom(len(mem)))
+        buf = (ctypes.c_char * (2 * page_size)).from_buffer(mem, page_size)
+        slot = fake_slot(buf, 0x100000)
+        with proc.openpid(os.getpid()) as pid_fd:
+            vma = [m for m in pid_fd.maps() if m.pathname.startswith("/memfd:")]
+        slot.hv_mapping = [
+            m for m in vma if m.start == ctypes.addressof(buf) - page_size
+        ][0]
+
+        with GuestRam(os.getpid(), [slot], writable=True) as ram:
+            assert ram.mapped == 1
+            view = ram.view(0)
+            assert view is not None
+            assert view.tobytes() == mem[page_size:-page_size]
+            ram.write(0, 8, b"pirate")
+            assert mem.find(b"pirate", 0) == page_size + 8
+            assert ram.read(0, 8, 6) == b"pirate"
+        del buf
+        mem.close()
+    finally:
+        os.close(fd)
+
+
+def test_fallback_to_process_vm_readv() -> None:
+    buf = ctypes.create_string_buffer(os.urandom(mmap.PAGESIZE), mmap.PAGESIZE)
+    slot = fake_slot(buf, 0)
+    with GuestRam(os.getpid(), [slot]) as ram:
+        assert ram.mapped == 0
+        assert ram.read(0, 16, 32) == buf.raw[16:48]
+        ram.write(0, 0, b"pirate")
+        assert buf.raw[:6] == b"pirate"
+
+
+def test_guest_memory() -> None:
+    page_size = mmap.PAGESIZE
+    low = ctypes.create_string_buffer(os.urandom(page_size), page_size)
+    high = ctypes.create_string_buffer(os.urandom(2 * page_size), 2 * page_size)
+    # adjacent in guest-physical memory, but not in the hypervisor
+    slots = [fake_slot(high, 0x1000 + page_size), fake_slot(low, 0x1000)]
+    with GuestMemory(os.getpid(), slots) as memory:
+        assert memory.read(0x1000 + 16, 32) == low.raw[16:48]
+        # spans both slots
+        assert memory.read(0x1000 + page_size - 8, 16) == low.raw[-8:] + high.raw[:8]
+        gpa = 0x1000 + page_size
+        assert memory.readv([(gpa, 4), (0x1000, 4), (gpa + 4, 4)]) == [
+            high.raw[:4],
+            low.raw[:4],
+            high.raw[4:8],
+        ]
+        memory.writev([(0x1000, b"kvm"), (gpa, b"pirate")])
+        assert low.raw[:3] == b"kvm"
+        assert high.raw[:6] == b"pirate"
+        with pytest.raises(AddressError):
+            memory.read(0x1000 + 3 * page_size - 8, 16)
+        with pytest.raises(AddressError):
+            memory.read(0, 1)
@@ -0,0 +1,69 @@
+import ctypes
+import dataclasses
+import mmap
+import os
+
+from kvm_pirate import vmcopy
+from kvm_pirate.coredump import core_headers
+from kvm_pirate.elf import Ehdr, Phdr
+from kvm_pirate.hugepage import detect_page_sizes, is_hugetlbfs_path
+
+from test_coredump import fake_slot
+
+HUGE_PAGE = 2 * 1024 * 1024
+
+
+def test_batches_split_at_huge_pages() -> None:
+    # the first slot leaves a partial chunk, so the second one would be split
+    # in the middle of a huge page without alignment
+    chunks = [
+        vmcopy.Chunk(0x1000, 0, 0x3000),
+        vmcopy.Chunk(10 * HUGE_PAGE, 0x3000, 4 * HUGE_PAGE),
+    ]
+    batches = vmcopy.batch_chunks(chunks, 2 * HUGE_PAGE, HUGE_PAGE)
+    for batch in batches:
+        assert sum(chunk.size for chunk in batch) <= 2 * HUGE_PAGE
+        end = batch[-1].src + batch[-1].size
+        assert end % HUGE_PAGE == 0 or end == 0x4000
+    copied = [(c.src, c.offset, c.size) for batch in batches for c in batch]
+    assert sum(size for _, _, size in copied) == 0x3000 + 4 * HUGE_PAGE
+
+
+def test_huge_page_layout() -> None:
+    buf = ctypes.create_string_buffer(mmap.PAGESIZE)
+    small = dataclasses.replace(
+        fake_slot(buf, 0), start=0x7F0000001000, stop=0x7F0000002000
+    )
+    huge = dataclasses.replace(
+        fake_slot(buf, HUGE_PAGE),
+        start=0x7F0000200000,
+        stop=0x7F0000400000,
+        page_size=HUGE_PAGE,
+    )
+    headers, offset = core_headers([small, huge])
+    assert offset == HUGE_PAGE
+    phdrs = (Phdr * 2).from_buffer_copy(headers, ctypes.sizeof(Ehdr))
+    assert phdrs[0].p_offset == offset
+    # required by the ELF spec
+    for phdr in phdrs:
+        assert phdr.p_offset % phdr.p_align == phdr.p_vaddr % phdr.p_align
+
+
+def test_detect_page_sizes() -> None:
+    mem = mmap.mmap(-1, 4 * mmap.PAGESIZE)
+    mem.write(b"x" * len(mem))
+    buf = (ctypes.c_char * len(mem)).from_buffer(mem)
+    slot = fake_slot(buf, 0)
+    [detected] = detect_page_sizes(os.getpid(), [slot])
+    # too small for a huge page
+    assert detected.page_size == mmap.PAGESIZE
+    del buf
+    mem.close()
+
+
+def test_is_hugetlbfs_path() -> None:
+    mounts = {"/dev/hugepages"}
+    assert is_hugetlbfs_path("/anon_hugepage (deleted)", mounts)
+    assert is_hugetlbfs_path("/dev/hugepages/qemu_back_mem.pc.ram", mounts)
+    assert not is_hugetlbfs_path("/dev/hugepages2/ram", mounts)
+    assert not is_hugetlbfs_path("/memfd:pc.ram (deleted)", mounts)
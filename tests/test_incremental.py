@@ -0,0 +1,49 @@
+import ctypes
+import mmap
+import os
+import tempfile
+
+import pytest
+
+from kvm_pirate.coredump import write_corefile
+from kvm_pirate.incremental import apply_delta, load_index, write_delta
+from kvm_pirate.pageindex import LayoutError, PageIndex
+
+from test_coredump import fake_slot, read_segments
+
+
+def test_incremental_corefile() -> None:
+    page_size = mmap.PAGESIZE
+    contents = [os.urandom(3 * page_size), os.urandom(5 * page_size)]
+    bufs = [ctypes.create_string_buffer(c, len(c)) for c in contents]
+    slots = [fake_slot(buf, i * 0x100000) for i, buf in enumerate(bufs)]
+    with tempfile.TemporaryDirectory() as d:
+        core_path = os.path.join(d, "core")
+        with open(core_path, "wb+") as f:
+            index = write_corefile(os.getpid(), f, slots, index=True)
+        assert index is not None
+        with open(core_path, "rb") as f:
+            assert PageIndex.from_core(f, page_size).hashes == index.hashes
+
+        # change the last page of the first slot and one page in the second
+        ctypes.memset(ctypes.addressof(bufs[0]) + 2 * page_size, 1, page_size)
+        ctypes.memset(ctypes.addressof(bufs[1]) + page_size, 2, 10)
+        delta_path = os.path.join(d, "delta")
+        with open(delta_path, "wb") as f:
+            new_index = write_delta(os.getpid(), f, slots, load_index(core_path))
+        assert os.path.getsize(delta_path) < 3 * page_size
+
+        with open(delta_path, "r+b") as delta:
+            complete = delta.read()
+            delta.truncate(len(complete) - 1)
+        with open(core_path, "r+b") as core, open(delta_path, "rb") as delta:
+            with pytest.raises(LayoutError):
+                apply_delta(core, delta)
+        with open(delta_path, "wb") as delta:
+            delta.write(complete)
+
+        with open(core_path, "r+b") as core, open(delta_path, "rb") as delta:
+            apply_delta(core, delta)
+        assert read_segments(core_path) == [buf.raw for buf in bufs]
+        with open(core_path, "rb") as f:
+            assert PageIndex.from_core(f, page_size).hashes == new_index.hashes
@@ -0,0 +1,57 @@
+import ctypes
+import mmap
+import os
+import tempfile
+from typing import Callable, Optional
+
+import pytest
+
+from kvm_pirate.coredump import core_index, write_corefile, write_corefile_uncached
+from kvm_pirate.journal import Journal
+from kvm_pirate.pageindex import LayoutError, PageIndex
+from kvm_pirate.vmcopy import split_chunks
+
+from test_coredump import fake_slot, read_segments
+
+
+@pytest.mark.parametrize("writer", [write_corefile, write_corefile_uncached])
+def test_resume_corefile(writer: Callable[..., Optional[PageIndex]]) -> None:
+    page_size = mmap.PAGESIZE
+    buf = ctypes.create_string_buffer(os.urandom(4 * page_size), 4 * page_size)
+    slots = [fake_slot(buf, 0)]
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "core")
+        journal_path = f"{path}.journal"
+        with open(path, "wb+") as f:
+            writer(
+                os.getpid(), f, slots, chunk_size=page_size, journal_path=journal_path
+            )
+        assert not os.path.exists(journal_path)
+        old = buf.raw
+
+        # pretend the dump was interrupted after the second page, the
+        # resumed dump uses a smaller chunk size
+        layout = core_index(slots).layout
+        journal = Journal.create(journal_path, layout, 2 * page_size)
+        journal.complete(split_chunks(slots, 0, page_size)[1])
+        journal.close()
+        ctypes.memset(buf, 1, len(buf))
+        with open(path, "r+b") as f:
+            writer(
+                os.getpid(),
+                f,
+                slots,
+                chunk_size=page_size,
+                journal_path=journal_path,
+                resume=True,
+            )
+        assert not os.path.exists(journal_path)
+        second = slice(page_size, 2 * page_size)
+        expected = bytearray(buf.raw)
+        expected[second] = old[second]
+        assert read_segments(path) == [expected]
+
+        moved = core_index([fake_slot(buf, 0x100000)]).layout
+        Journal.create(journal_path, layout, page_size).close()
+        with pytest.raises(LayoutError, match="different memslots"):
+            Journal.resume(journal_path, moved)
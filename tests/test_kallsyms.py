@@ -0,0 +1,138 @@
+import ctypes
+import os
+import struct
+import tempfile
+from typing import List, Tuple
+
+from kvm_pirate.guestmem import GuestMemory
+from kvm_pirate.kallsyms import (
+    BUILD_ID_NOTE,
+    DEFAULT_KERNEL_BASE,
+    KERNEL_MAP_START,
+    KernelSymbols,
+    Symbolizer,
+    kernel_symbols,
+)
+from kvm_pirate.pagetable import (
+    CR4_PAE,
+    EFER_LMA,
+    PTE_PRESENT,
+    PTE_PS,
+    PTE_RW,
+    PageTableWalker,
+)
+
+from test_coredump import fake_slot
+
+PML4, PDPT, PD = 0x1000, 0x2000, 0x3000
+IMAGE = 0x200000
+IMAGE_SIZE = 0x200000
+BUILD_ID = bytes(range(20))
+
+
+def pad(data: bytearray) -> None:
+    data += bytes(-len(data) % 8)
+
+
+def build_image(base: int, symbols: List[Tuple[int, str, str]]) -> bytes:
+    """
+    Lays out kallsyms like scripts/kallsyms.c of Linux 6.4 with
+    CONFIG_KALLSYMS_ABSOLUTE_PERCPU, every character is its own token.
+    """
+    image = bytearray(0x1000)
+    image += BUILD_ID_NOTE + BUILD_ID
+    pad(image)
+
+    names = bytearray()
+    markers = []
+    for i, (_, symbol_type, name) in enumerate(symbols):
+        if i % 256 == 0:
+            markers.append(len(names))
+        encoded = (symbol_type + name).encode()
+        if len(encoded) > 127:
+            names += bytes([len(encoded) & 0x7F | 0x80, len(encoded) >> 7])
+        else:
+            names.append(len(encoded))
+        names += encoded
+    tokens = [bytes([i]) if 0x20 < i < 0x7F else b"<%d>" % i for i in range(256)]
+    token_table = b"".join(token + b"\0" for token in tokens)
+    token_index, pos = [], 0
+    for token in tokens:
+        token_index.append(pos)
+        pos += len(token) + 1
+
+    image += struct.pack("<Q", len(symbols))
+    image += names
+    pad(image)
+    image += struct.pack(f"<{len(markers)}I", *markers)
+    pad(image)
+    image += token_table
+    pad(image)
+    image += struct.pack("<256H", *token_index)
+    pad(image)
+    offsets = [
+        address if address < KERNEL_MAP_START else base - 1 - address
+        for address, _, _ in symbols
+    ]
+    image += struct.pack(f"<{len(offsets)}i", *offsets)
+    pad(image)
+    image += struct.pack("<Q", base)
+    return bytes(image)
+
+
+def map_kernel(buf: "ctypes.Array[ctypes.c_char]", base: int) -> None:
+    entry = PTE_PRESENT | PTE_RW
+    struct.pack_into("<Q", buf, PML4 + 511 * 8, PDPT | entry)
+    struct.pack_into("<Q", buf, PDPT + 510 * 8, PD | entry)
+    ctypes.memset(ctypes.addressof(buf) + PD, 0, 0x1000)
+    index = (base - KERNEL_MAP_START) // IMAGE_SIZE
+    struct.pack_into("<Q", buf, PD + index * 8, IMAGE | PTE_PS | entry)
+
+
+def test_kernel_symbols() -> None:
+    base = DEFAULT_KERNEL_BASE + 0x2A00000
+    symbols = [(0x1000, "A", "fixed_percpu_data")]
+    symbols += [(base + i * 16, "T", f"function_{i}") for i in range(600)]
+    symbols.append((base + 0x10000, "t", "long_" + "x" * 200))
+    image = build_image(base, symbols)
+
+    buf = ctypes.create_string_buffer(IMAGE + IMAGE_SIZE)
+    ctypes.memmove(ctypes.addressof(buf) + IMAGE, image, len(image))
+    map_kernel(buf, base)
+    with GuestMemory(
+        os.getpid(), [fake_slot(buf, 0)]
+    ) as memory, tempfile.TemporaryDirectory() as cache:
+        walker = PageTableWalker(memory, PML4, CR4_PAE, EFER_LMA)
+        kernel = kernel_symbols(walker, cache)
+        assert kernel.base == base
+        assert kernel.slide == 0x2A00000
+        assert kernel.build_id == BUILD_ID.hex()
+        assert kernel.symbols == symbols
+        assert not kernel.cached
+
+        # the same kernel with another KASLR slide
+        map_kernel(buf, DEFAULT_KERNEL_BASE)
+        walker.flush()
+        kernel = kernel_symbols(walker, cache)
+        assert kernel.cached
+        assert kernel.base == DEFAULT_KERNEL_BASE
+        assert kernel.symbols[0] == symbols[0]
+        assert kernel.symbols[1] == (DEFAULT_KERNEL_BASE, "T", "function_0")
+
+
+def test_symbolizer() -> None:
+    base = DEFAULT_KERNEL_BASE
+    symbols = [
+        (0x1000, "A", "fixed_percpu_data"),
+        (base, "T", "_text"),
+        (base + 0x100, "T", "schedule"),
+        (base + 0x1000, "B", "_end"),
+    ]
+    symbolizer = Symbolizer(KernelSymbols(base, BUILD_ID.hex(), symbols, 0))
+    assert symbolizer.symbolize(0x7F00_0000_1000) == "[user]"
+    assert symbolizer.symbolize(base + 0x180) == "schedule"
+    assert symbolizer.symbolize(base + 0x180, offset=True) == "schedule+0x80"
+    assert symbolizer.symbolize(base + 0x10) == "_text"
+    # modules are outside of the image
+    assert symbolizer.symbolize(base + 0x2000) == f"0x{base + 0x2000:x}"
+    assert symbolizer.symbolize(base - 1) == f"0x{base - 1:x}"
@@ -0,0 +1,65 @@
+import ctypes
+import mmap
+import os
+import tempfile
+import zlib
+from typing import Dict
+
+from kvm_pirate.kdump import (
+    DUMP_DH_COMPRESSED_ZLIB,
+    KDUMP_SIGNATURE,
+    DiskDumpHeader,
+    KdumpSubHeader,
+    PageDesc,
+    write_kdump,
+)
+
+from test_coredump import fake_slot
+
+
+def read_kdump(path: str) -> Dict[int, bytes]:
+    """
+    Returns the dumped pages by page frame number, like crash reads them.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    header = DiskDumpHeader.from_buffer_copy(data)
+    assert header.signature == KDUMP_SIGNATURE
+    block_size = header.block_size
+    sub_header = KdumpSubHeader.from_buffer_copy(data, block_size)
+    bitmap_offset = (1 + header.sub_hdr_size) * block_size
+    bitmap_size = header.bitmap_blocks * block_size // 2
+    dumpable_offset = bitmap_offset + bitmap_size
+    desc_offset = dumpable_offset + bitmap_size
+    pages = {}
+    for pfn in range(sub_header.max_mapnr_64):
+        if not data[dumpable_offset + pfn // 8] & (1 << (pfn % 8)):
+            continue
+        desc = PageDesc.from_buffer_copy(data, desc_offset)
+        desc_offset += ctypes.sizeof(PageDesc)
+        start = desc.offset
+        end = start + desc.size
+        page = data[start:end]
+        if desc.flags & DUMP_DH_COMPRESSED_ZLIB:
+            page = zlib.decompress(page)
+        pages[pfn] = page
+    return pages
+
+
+def test_write_kdump() -> None:
+    page_size = mmap.PAGESIZE
+    random_page = os.urandom(page_size)
+    text_page = b"kvm-pirate" * (page_size // 10) + bytes(page_size % 10)
+    contents = [
+        random_page + bytes(page_size) + text_page,
+        bytes(page_size) + text_page,
+    ]
+    bufs = [ctypes.create_string_buffer(c, len(c)) for c in contents]
+    # slots in reverse physical order with a gap between them
+    slots = [fake_slot(bufs[0], 16 * page_size), fake_slot(bufs[1], 0)]
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "vmcore")
+        with open(path, "wb") as f:
+            write_kdump(os.getpid(), f, slots, jobs=2, chunk_size=page_size)
+        pages = read_kdump(path)
+    assert pages == {1: text_page, 16: random_page, 18: text_page}
@@ -0,0 +1,33 @@
+import subprocess
+import sys
+
+from conftest import TEST_ROOT
+
+# bcc is optional, None in sys.modules makes every import of it fail
+WITHOUT_BCC = 'import sys; sys.modules["bcc"] = None\n'
+
+PARSE_ARGS = """
+sys.argv = ["kvm_pirate", "--memslots", "proc", "inspect", "1"]
+from kvm_pirate.__main__ import parse_args
+args = parse_args()
+assert args.memslots == "proc" and args.pid == 1 and "guess_memslots" in args
+"""
+
+
+def run_python(source: str) -> str:
+    return subprocess.run(
+        [sys.executable, "-c", WITHOUT_BCC + source],
+        cwd=TEST_ROOT.parent,
+        check=True,
+        text=True,
+        stdout=subprocess.PIPE,
+    ).stdout
+
+
+def test_cli_without_bcc() -> None:
+    run_python(PARSE_ARGS)
+    usage = run_python(
+        'import runpy; sys.argv = ["kvm_pirate", "--help"]\n'
+        'runpy.run_module("kvm_pirate", run_name="__main__")'
+    )
+    assert "--memslots" in usage
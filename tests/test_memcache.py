@@ -0,0 +1,42 @@
+import ctypes
+import os
+
+from kvm_pirate.guestmem import GuestMemory
+from kvm_pirate.memcache import CACHE_PAGE_SIZE, CachedGuestMemory
+
+from test_coredump import fake_slot
+
+
+def test_cached_reads() -> None:
+    size = 4 * CACHE_PAGE_SIZE
+    buf = ctypes.create_string_buffer(os.urandom(size), size)
+    with GuestMemory(os.getpid(), [fake_slot(buf, 0)]) as memory:
+        cache = CachedGuestMemory(memory, max_pages=2)
+        assert cache.read(8, 16) == buf.raw[8:24]
+        assert cache.read(32, 8) == buf.raw[32:40]
+        assert (cache.stats.hits, cache.stats.misses) == (1, 1)
+
+        # spans two pages, only the second one is missing
+        start = CACHE_PAGE_SIZE - 4
+        end = start + 8
+        assert cache.read(start, 8) == buf.raw[start:end]
+        assert (cache.stats.hits, cache.stats.misses) == (2, 2)
+
+        # stale until invalidated
+        ctypes.memmove(buf, b"pirate", 6)
+        assert cache.read(0, 6) != b"pirate"
+        cache.invalidate(0, 6)
+        assert cache.read(0, 6) == b"pirate"
+
+        cache.write(1, b"KVM")
+        assert cache.read(0, 6) == b"pKVMte"
+
+        ctypes.memmove(buf, b"guest!", 6)
+        cache.next_generation()
+        assert cache.read(0, 6) == b"guest!"
+
+        cache.read(2 * CACHE_PAGE_SIZE, 1)
+        cache.read(3 * CACHE_PAGE_SIZE, 1)
+        assert cache.stats.evictions > 0
+        assert len(cache.pages) == 2
+        assert 0 < cache.stats.hit_rate < 1
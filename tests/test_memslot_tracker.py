@@ -0,0 +1,58 @@
+from typing import Tuple
+
+from kvm_pirate.memslot_tracker import (
+    Slot,
+    SlotChange,
+    SlotTable,
+    apply_events,
+    diff_tables,
+)
+
+GiB = 1024 * 1024 * 1024
+
+
+Event = Tuple[int, int, int, int, int, int, int]
+
+
+def event(pid: int, slot: int, gpa: int, size: int, addr: int) -> Event:
+    return (pid, slot, gpa, size, addr, 0, 0)
+
+
+def test_apply_events() -> None:
+    ram = Slot(0, 0, 0, GiB, 0x7F0000000000, 0)
+    table: SlotTable = {(0, 0): ram}
+    tables = {42: table}
+    hotplug = Slot(0, 1, 4 * GiB, GiB, 0x7F0080000000, 0)
+    smram = Slot(1, 2, 0xA0000, 0x20000, 0x7F00000A0000, 0)
+    events = [
+        # the initial table already has it
+        event(42, 0, 0, GiB, 0x7F0000000000),
+        event(42, 1, 4 * GiB, GiB, 0x7F0080000000),
+        event(42, (1 << 16) | 2, 0xA0000, 0x20000, 0x7F00000A0000),
+        # not tracked
+        event(43, 0, 0, GiB, 0x1000),
+    ]
+    assert apply_events(tables, events) == [
+        SlotChange(42, None, hotplug),
+        SlotChange(42, None, smram),
+    ]
+    assert table == {(0, 0): ram, (0, 1): hotplug, (1, 2): smram}
+    # applying the same events again changes nothing
+    assert apply_events(tables, events) == []
+
+    # unplugged again
+    unplug = [event(42, 1, 4 * GiB, 0, 0x7F0080000000)]
+    assert apply_events(tables, unplug) == [SlotChange(42, hotplug, None)]
+    assert (0, 1) not in table
+
+
+def test_diff_tables() -> None:
+    ram = Slot(0, 0, 0, GiB, 0x7F0000000000, 0)
+    moved = Slot(0, 0, 0, GiB, 0x7F0040000000, 0)
+    rom = Slot(0, 1, 0xFFFC0000, 0x40000, 0x7F0000100000, 2)
+    old: SlotTable = {(0, 0): ram, (0, 1): rom}
+    new: SlotTable = {(0, 0): moved}
+    assert diff_tables(7, old, new) == [
+        SlotChange(7, ram, moved),
+        SlotChange(7, rom, None),
+    ]
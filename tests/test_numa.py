@@ -0,0 +1,56 @@
+import ctypes
+import mmap
+import os
+import tempfile
+
+from kvm_pirate import proc
+from kvm_pirate.coredump import write_corefile
+from kvm_pirate.numa import mapping_node, numa_groups, parse_cpulist, share_jobs
+
+from test_coredump import fake_slot, read_segments
+
+
+def test_parse_cpulist() -> None:
+    assert parse_cpulist("0-3,8-9,12\n") == {0, 1, 2, 3, 8, 9, 12}
+
+
+def test_mapping_node() -> None:
+    assert mapping_node({"policy": "default", "N0": "2", "N1": "512"}) == 1
+    assert mapping_node({"policy": "bind:2-3"}) == 2
+    assert mapping_node({"policy": "default"}) is None
+
+
+def test_share_jobs() -> None:
+    assert share_jobs([3, 1], 4) == [3, 1]
+    assert share_jobs([1, 1, 1], 4) == [2, 1, 1]
+    assert share_jobs([100, 1], 2) == [1, 1]
+    assert sum(share_jobs([5, 3, 2, 7], 9)) == 9
+    assert share_jobs([], 4) == []
+
+
+def test_numa_corefile() -> None:
+    page_size = mmap.PAGESIZE
+    mem = mmap.mmap(-1, 4 * page_size)
+    mem.write(os.urandom(len(mem)))
+    buf = (ctypes.c_char * len(mem)).from_buffer(mem)
+    other = ctypes.create_string_buffer(os.urandom(page_size), page_size)
+    slots = [fake_slot(buf, 0), fake_slot(other, 0x100000)]
+    # the anonymous mapping is a line in numa_maps
+    with proc.openpid(os.getpid()) as pid_fd:
+        vma = [m for m in pid_fd.maps() if m.start == slots[0].start][0]
+    slots[0].hv_mapping = vma
+
+    groups = numa_groups(os.getpid(), slots, 0, page_size, jobs=4)
+    assert sum(len(group.batches) for group in groups) == 5
+    assert any(group.cpus for group in groups)
+    assert sum(group.jobs for group in groups) <= 4
+    groups = numa_groups(os.getpid(), slots, 0, page_size, jobs=1)
+    assert [group.jobs for group in groups] == [1]
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "core")
+        with open(path, "wb+") as f:
+            write_corefile(os.getpid(), f, slots, jobs=2, numa=True)
+        assert read_segments(path) == [bytes(mem), other.raw]
+    del buf
+    mem.close()
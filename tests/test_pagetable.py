@@ -0,0 +1,106 @@
+import ctypes
+import os
+import struct
+
+import pytest
+
+from kvm_pirate.guestmem import GuestMemory
+from kvm_pirate.memcache import CachedGuestMemory
+from kvm_pirate.pagetable import (
+    CR4_LA57,
+    CR4_PAE,
+    EFER_LMA,
+    EFER_NXE,
+    PTE_NX,
+    PTE_PRESENT,
+    PTE_PS,
+    PTE_RW,
+    PTE_US,
+    PageFault,
+    PageTableWalker,
+)
+
+from test_coredump import fake_slot
+
+MEM_SIZE = 4 * 1024 * 1024
+PML5, PML4, PDPT, PD, PT = 0x1000, 0x2000, 0x3000, 0x4000, 0x5000
+PAGE = 0x6000
+LARGE_PAGE = 0x200000
+
+
+def set_entry(
+    buf: "ctypes.Array[ctypes.c_char]", table: int, index: int, value: int
+) -> None:
+    struct.pack_into("<Q", buf, table + index * 8, value)
+
+
+def make_memory() -> "ctypes.Array[ctypes.c_char]":
+    buf = ctypes.create_string_buffer(MEM_SIZE)
+    user = PTE_PRESENT | PTE_RW | PTE_US
+    set_entry(buf, PML5, 0, PML4 | user)
+    set_entry(buf, PML4, 0, PDPT | user)
+    set_entry(buf, PDPT, 0, PD | user)
+    # 0x0 - 0x200000: 4 KiB pages
+    set_entry(buf, PD, 0, PT | user)
+    set_entry(buf, PT, 1, PAGE | PTE_PRESENT | PTE_US | PTE_NX)
+    set_entry(buf, PT, 2, PAGE | PTE_PRESENT | PTE_RW)
+    # 0x200000 - 0x400000: a 2 MiB page
+    set_entry(buf, PD, 1, LARGE_PAGE | PTE_PS | user)
+    # 0x40000000 - 0x80000000: a 1 GiB page at 0
+    set_entry(buf, PDPT, 1, PTE_PS | user)
+    ctypes.memmove(ctypes.addressof(buf) + PAGE, b"pirate", 6)
+    return buf
+
+
+def test_translate() -> None:
+    buf = make_memory()
+    with GuestMemory(os.getpid(), [fake_slot(buf, 0)]) as memory:
+        walker = PageTableWalker(memory, PML4, CR4_PAE, EFER_LMA | EFER_NXE)
+        assert walker.translate(0x1234) == PAGE + 0x234
+        assert walker.read(0x1000, 6) == b"pirate"
+        assert walker.translate(0x212345) == LARGE_PAGE + 0x12345
+        assert walker.translate(0x40006000) == PAGE
+        assert walker.lookup(0x40000000).page_size == 1 << 30
+
+        with pytest.raises(PageFault):
+            walker.translate(0x1000, execute=True)
+        with pytest.raises(PageFault):
+            walker.translate(0x1000, write=True)
+        with pytest.raises(PageFault):
+            walker.translate(0x2000, user=True)
+        with pytest.raises(PageFault):
+            walker.translate(0x3000)
+        with pytest.raises(PageFault):
+            walker.translate(1 << 47)
+
+        # spans the 4 KiB pages 1 and 2, which both map PAGE
+        assert walker.ranges(0x1FFE, 4) == [(PAGE + 0xFFE, 2), (PAGE, 2)]
+
+
+def test_tlb() -> None:
+    buf = make_memory()
+    with GuestMemory(os.getpid(), [fake_slot(buf, 0)]) as memory:
+        cache = CachedGuestMemory(memory)
+        walker = PageTableWalker(cache, PML4, CR4_PAE, EFER_LMA)
+        walker.translate(0x1000)
+        walker.translate(0x1008)
+        walker.translate(0x200000)
+        walker.translate(0x3FFFFF)
+        assert (walker.stats.hits, walker.stats.misses) == (2, 2)
+
+        # remap page 1, the TLB is stale until cr3 changes
+        set_entry(buf, PT, 1, LARGE_PAGE | PTE_PRESENT)
+        cache.invalidate()
+        assert walker.translate(0x1000) == PAGE
+        walker.set_cr3(PML4 | 1)
+        assert walker.translate(0x1000) == LARGE_PAGE
+
+
+def test_5_level_paging() -> None:
+    buf = make_memory()
+    with GuestMemory(os.getpid(), [fake_slot(buf, 0)]) as memory:
+        walker = PageTableWalker(memory, PML5, CR4_PAE | CR4_LA57, EFER_LMA)
+        assert walker.translate(0x1234) == PAGE + 0x234
+        # canonical with 57 bits, but not with 48 bits
+        with pytest.raises(PageFault, match="not present"):
+            walker.translate(1 << 47)
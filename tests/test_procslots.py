@@ -0,0 +1,114 @@
+import mmap
+import os
+from tempfile import TemporaryDirectory
+
+from kvm_pirate.proc import KvmMapping, Mapping
+from kvm_pirate.procslots import (
+    GiB,
+    MiB,
+    is_verified,
+    mark_verified,
+    qemu_machine,
+    qemu_maps,
+    qemu_x86_layout,
+    verify,
+)
+
+RW_PRIVATE = mmap.PROT_READ | mmap.PROT_WRITE | mmap.MAP_PRIVATE
+
+
+def mapping(start: int, size: int, pathname: str = "") -> Mapping:
+    return Mapping(
+        start=start,
+        stop=start + size,
+        flags=RW_PRIVATE,
+        offset=0,
+        major_dev=0,
+        minor_dev=0,
+        inode=0,
+        pathname=pathname,
+    )
+
+
+def memslot(gpa: int, start: int, size: int, hv_mapping: Mapping) -> KvmMapping:
+    attrs = dict(hv_mapping.__dict__)
+    attrs.update(
+        start=start, stop=start + size, physical_start=gpa, hv_mapping=hv_mapping
+    )
+    return KvmMapping(**attrs)
+
+
+def test_qemu_machine() -> None:
+    assert qemu_machine(["-m", "4G"]) == ""
+    assert qemu_machine(["-M", "q35"]) == "q35"
+    assert qemu_machine(["-machine", "pc-q35-8.1,accel=kvm"]) == "pc-q35-8.1"
+    assert qemu_machine(["-machine", "accel=kvm,type=pc"]) == "pc"
+
+
+def test_qemu_x86_layout() -> None:
+    assert qemu_x86_layout("pc", GiB) == [(0, GiB)]
+    assert qemu_x86_layout("pc", 4 * GiB) == [(0, 3 * GiB), (4 * GiB, GiB)]
+    assert qemu_x86_layout("q35", 2 * GiB) == [(0, 2 * GiB)]
+    assert qemu_x86_layout("pc-q35-8.1", 4 * GiB) == [
+        (0, 2 * GiB),
+        (4 * GiB, 2 * GiB),
+    ]
+    assert qemu_x86_layout("microvm", GiB) is None
+
+
+def test_qemu_maps() -> None:
+    ram = mapping(0x7F0000000000, 4 * GiB)
+    mappings = [
+        mapping(0x1000000, 16 * MiB),
+        ram,
+        mapping(0x7E0000000000, 256 * MiB, "/memfd:vga (deleted)"),
+    ]
+    # the named mapping is preferred, even if it is too small for RAM
+    maps = qemu_maps(mappings, "pc")
+    assert maps is not None
+    assert [(m.physical_start, m.size) for m in maps] == [(0, 256 * MiB)]
+
+    maps = qemu_maps(mappings[:2], "q35")
+    assert maps is not None
+    assert [(m.physical_start, m.start, m.size) for m in maps] == [
+        (0, ram.start, 2 * GiB),
+        (4 * GiB, ram.start + 2 * GiB, 2 * GiB),
+    ]
+    assert all(m.hv_mapping is ram for m in maps)
+
+    # two RAM backends, i.e. NUMA nodes
+    numa = [mapping(0, GiB, "/memfd:ram0"), mapping(GiB, GiB, "/memfd:ram1")]
+    assert qemu_maps(numa, "pc") is None
+    # no mapping that is large enough
+    assert qemu_maps(mappings[:1], "pc") is None
+
+
+def test_verify() -> None:
+    ram = mapping(0x7F0000000000, 4 * GiB)
+    rom = mapping(0x7E0000000000, 2 * MiB)
+    maps = qemu_maps([ram], "pc")
+    assert maps is not None
+    # QEMU splits the RAM below 1 MiB around the VGA window
+    memslots = [
+        memslot(0, ram.start, 0xA0000, ram),
+        memslot(0xC0000, ram.start + 0xC0000, 3 * GiB - 0xC0000, ram),
+        memslot(4 * GiB, ram.start + 3 * GiB, GiB, ram),
+        memslot(0xFFE00000, rom.start, rom.size, rom),
+    ]
+    assert verify(maps, memslots) == []
+
+    assert len(verify(maps, memslots[:2])) == 1
+    moved = memslot(4 * GiB, ram.start + 2 * GiB, GiB, ram)
+    assert len(verify(maps, memslots[:2] + [moved])) == 1
+
+
+def test_mark_verified() -> None:
+    ram = mapping(0x7F0000000000, 4 * GiB)
+    maps = qemu_maps([ram], "pc")
+    assert maps is not None
+    with TemporaryDirectory() as directory:
+        assert not is_verified(directory, os.getpid(), maps)
+        mark_verified(directory, os.getpid(), maps)
+        assert is_verified(directory, os.getpid(), maps)
+        # i.e. after the guest RAM was mapped somewhere else
+        assert not is_verified(directory, os.getpid(), maps[:1])
@@ -0,0 +1,33 @@
+import io
+from typing import Counter, Tuple
+
+from kvm_pirate.kallsyms import DEFAULT_KERNEL_BASE, KernelSymbols, Symbolizer
+from kvm_pirate.profile import write_folded
+
+
+def test_write_folded() -> None:
+    base = DEFAULT_KERNEL_BASE
+    symbols = [
+        (base, "T", "_text"),
+        (base + 0x100, "T", "schedule"),
+        (base + 0x1000, "B", "_end"),
+    ]
+    symbolizer = Symbolizer(KernelSymbols(base, "", symbols, 0))
+    samples: Counter[Tuple[int, int]] = Counter(
+        {
+            (0, base + 0x120): 3,
+            (0, base + 0x180): 2,
+            (1, 0x7F00_0000_1000): 4,
+            (1, base + 0x2000): 1,
+        }
+    )
+    out = io.StringIO()
+    write_folded(out, samples, symbolizer)
+    # samples in the same function are merged
+    assert out.getvalue() == (
+        "vcpu0;schedule 5\n" f"vcpu1;0x{base + 0x2000:x} 1\n" "vcpu1;[user] 4\n"
+    )
+
+    out = io.StringIO()
+    write_folded(out, Counter({(2, 0x1000): 7}), None)
+    assert out.getvalue() == "vcpu2;0x1000 7\n"
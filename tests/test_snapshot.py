@@ -0,0 +1,149 @@
+import ctypes
+import dataclasses
+import mmap
+import os
+import tempfile
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Any, Generator, List
+
+import pytest
+
+from kvm_pirate import kvm, snapshot
+from kvm_pirate.kvm import (
+    CHECK_EXTENSION,
+    CLEAR_DIRTY_LOG,
+    GET_DIRTY_LOG,
+    MEM_LOG_DIRTY_PAGES,
+    ClearDirtyLog,
+    DirtyLog,
+    Tracee,
+    UserspaceMemoryRegion,
+    dirty_bitmap_size,
+)
+from kvm_pirate.snapshot import bitmap_runs, precopy_corefile
+
+from test_coredump import fake_slot, read_segments
+
+
+def test_bitmap_runs() -> None:
+    bitmap = bytearray(16)
+    # pages 3-4, 8-23 (crossing bytes) and 127
+    bitmap[0] = 0b00011000
+    bitmap[1] = 0xFF
+    bitmap[2] = 0xFF
+    bitmap[15] = 0x80
+    assert bitmap_runs(bytes(bitmap)) == [(3, 5), (8, 24), (127, 128)]
+    assert bitmap_runs(bytes(8)) == []
+
+
+class FakeProcess:
+    """
+    Scratch memory and the dirty log ioctls of a hypervisor.
+    """
+
+    base = 0x10000
+
+    def __init__(self, bitmap: bytes, manual_protect: bool) -> None:
+        self.memory = bytearray(mmap.PAGESIZE)
+        self.bitmap = bitmap
+        self.manual_protect = manual_protect
+        # bitmaps passed to CLEAR_DIRTY_LOG
+        self.cleared: List[bytes] = []
+
+    def mmap(self, length: int) -> int:
+        assert length <= len(self.memory)
+        return self.base
+
+    def munmap(self, addr: int, length: int) -> None:
+        pass
+
+    def read(self, addr: int, length: int) -> bytes:
+        start = addr - self.base
+        end = start + length
+        return bytes(self.memory[start:end])
+
+    def write(self, addr: int, data: bytes) -> None:
+        start = addr - self.base
+        end = start + len(data)
+        self.memory[start:end] = data
+
+    def ioctl(self, fd: int, request: int, arg: Any = 0) -> int:
+        if request == CHECK_EXTENSION:
+            return int(self.manual_protect)
+        if request == GET_DIRTY_LOG:
+            log = DirtyLog.from_buffer_copy(self.read(arg, ctypes.sizeof(DirtyLog)))
+            self.write(log.dirty_bitmap, self.bitmap)
+        elif request == CLEAR_DIRTY_LOG:
+            size = ctypes.sizeof(ClearDirtyLog)
+            clear = ClearDirtyLog.from_buffer_copy(self.read(arg, size))
+            length = dirty_bitmap_size(clear.num_pages)
+            self.cleared.append(self.read(clear.dirty_bitmap, length))
+        return 0
+
+
+@pytest.mark.parametrize("manual_protect", [True, False])
+def test_dirty_log_scratch_layout(manual_protect: bool) -> None:
+    # struct kvm_dirty_log and struct kvm_clear_dirty_log
+    assert ctypes.sizeof(DirtyLog) == 16
+    assert ctypes.sizeof(ClearDirtyLog) == 24
+    npages = 200
+    bitmap = bytes(range(1, dirty_bitmap_size(npages) + 1))
+    process = FakeProcess(bitmap, manual_protect)
+    tracee = Tracee(SimpleNamespace(vm_fd=3), process)  # type: ignore
+    assert tracee.get_dirty_log(1, npages) == bitmap
+    # the kernel clears exactly the pages it returned
+    assert process.cleared == ([bitmap] if manual_protect else [])
+
+
+class FakeTracee:
+    """
+    Simulates a guest that writes a page before each dirty log read.
+    """
+
+    def __init__(self, buf: "ctypes.Array[ctypes.c_char]", writes: List[int]):
+        self.buf = buf
+        self.writes = writes
+        self.logging: List[bool] = []
+
+    def set_user_memory_region(self, region: UserspaceMemoryRegion) -> None:
+        self.logging.append(bool(region.flags & MEM_LOG_DIRTY_PAGES))
+
+    def get_dirty_log(self, slot: int, npages: int) -> bytes:
+        bitmap = bytearray(dirty_bitmap_size(npages))
+        if self.writes:
+            page = self.writes.pop(0)
+            if page >= 0:
+                address = ctypes.addressof(self.buf) + page * mmap.PAGESIZE
+                ctypes.memset(address, page + 1, mmap.PAGESIZE)
+                bitmap[page // 8] |= 1 << (page % 8)
+        return bytes(bitmap)
+
+
+class FakeHypervisor:
+    def __init__(self, tracee: FakeTracee) -> None:
+        self.pid = os.getpid()
+        self.tracee = tracee
+
+    @contextmanager
+    def attach(self) -> Generator[FakeTracee, None, None]:
+        yield self.tracee
+
+
+def test_precopy_rounds(monkeypatch: pytest.MonkeyPatch) -> None:
+    # copy again until a round finds no dirty pages
+    monkeypatch.setattr(snapshot, "PRECOPY_THRESHOLD", 0)
+    page_size = mmap.PAGESIZE
+    buf = ctypes.create_string_buffer(os.urandom(4 * page_size), 4 * page_size)
+    slot = dataclasses.replace(fake_slot(buf, 0), memslot_id=1)
+    # -1 is a round without writes: none while resetting the log, pages 1
+    # and 3 during the first rounds, then page 2 before the final stop
+    tracee = FakeTracee(buf, [-1, 1, 3, -1, 2])
+    hv: "kvm.Hypervisor" = FakeHypervisor(tracee)  # type: ignore
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "core")
+        with open(path, "wb+") as f:
+            precopy_corefile(hv, f, [slot], chunk_size=page_size)
+        assert read_segments(path) == [buf.raw]
+    assert tracee.writes == []
+    assert tracee.logging == [True, False]
@@ -0,0 +1,39 @@
+import ctypes
+import gzip
+import io
+import lzma
+import os
+import tempfile
+from typing import Callable, List, Tuple
+
+from kvm_pirate.stream import COMPRESSORS, stream_corefile
+
+from test_coredump import fake_slot, read_segments
+
+
+def test_stream_corefile() -> None:
+    contents = [os.urandom(3 * 4096), bytes(5 * 4096)]
+    bufs = [ctypes.create_string_buffer(c, len(c)) for c in contents]
+    slots = [fake_slot(buf, i * 0x100000) for i, buf in enumerate(bufs)]
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "core")
+        decompressors: List[Tuple[str, Callable[[bytes], bytes]]] = [
+            ("none", bytes),
+            ("gzip", gzip.decompress),
+            ("xz", lzma.decompress),
+        ]
+        for name, decompress in decompressors:
+            out = io.BytesIO()
+            written, stats = stream_corefile(
+                os.getpid(),
+                out,
+                slots,
+                jobs=2,
+                compress=COMPRESSORS[name],
+                chunk_size=4096,
+            )
+            assert written == len(out.getvalue())
+            assert sum(worker.bytes for worker in stats) == sum(map(len, contents))
+            with open(path, "wb") as f:
+                f.write(decompress(out.getvalue()))
+            assert read_segments(path) == contents
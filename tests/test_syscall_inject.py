@@ -4,6 +4,7 @@ import subprocess
 import os
 import tempfile
 import signal
+from kvm_pirate import ptrace
 from kvm_pirate.inject_syscall import attach
 from kvm_pirate.syscalls import SYSCALL_NAMES
 
@@ -70,3 +71,25 @@ def test_multi_threaded(helpers: conftest.Helpers) -> None:
             proc.wait(5)
             line = proc.stdout.read()
             assert line == "OK\n"
+
+
+def test_fork(helpers: conftest.Helpers) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        binary = os.path.join(d, "main")
+        with open(helpers.root().joinpath("threaded.c")) as f:
+            source = f.read()
+        compile_executable(source, binary)
+        with subprocess.Popen([binary], text=True, stdout=subprocess.PIPE) as proc:
+            assert proc.stdout is not None
+            line = proc.stdout.readline()
+            assert line == "threads started\n"
+            with attach(proc.pid) as ctx:
+                child = ctx.fork()
+            with open(f"/proc/{child}/status") as status:
+                assert f"PPid:\t{proc.pid}\n" in status.read()
+            os.kill(child, signal.SIGKILL)
+            os.waitpid(child, ptrace.WALL)
+            proc.send_signal(signal.SIGTERM)
+            proc.wait(5)
+            line = proc.stdout.read()
+            assert line == "OK\n"
@@ -0,0 +1,60 @@
+import ctypes
+import os
+import time
+
+import pytest
+
+from kvm_pirate import throttle
+from kvm_pirate.throttle import MIN_BANDWIDTH, RunDelay, Throttle
+from kvm_pirate.vmcopy import Chunk, read_chunks
+
+MiB = 1024 * 1024
+
+
+def test_throttle_paces_copies() -> None:
+    src = ctypes.create_string_buffer(os.urandom(2 * MiB), 2 * MiB)
+    dst = ctypes.create_string_buffer(2 * MiB)
+    limit = Throttle(8 * MiB)
+    start = time.monotonic()
+    chunks = [Chunk(ctypes.addressof(src), 0, 2 * MiB)]
+    assert read_chunks(os.getpid(), ctypes.addressof(dst), chunks, limit) == 2 * MiB
+    # the first MiB is copied right away, the second one after 1/8s
+    assert time.monotonic() - start >= 0.1
+    assert dst.raw == src.raw
+
+
+class FakeRunDelay(RunDelay):
+    def __init__(self) -> None:
+        self.files = []
+        self.delay = 0
+
+    def read(self) -> int:
+        return self.delay
+
+
+def test_adaptive_throttle(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(throttle, "SAMPLE_INTERVAL", 0.01)
+    run_delay = FakeRunDelay()
+    limit = Throttle(256 * MiB, run_delay)
+    assert limit.rate == 256 * MiB
+    # vCPUs wait 100ms per second for a CPU
+    time.sleep(0.01)
+    run_delay.delay += int(0.1 * 0.01 * 1e9)
+    limit.acquire(1)
+    assert limit.rate == 128 * MiB
+    for _ in range(10):
+        time.sleep(0.01)
+        run_delay.delay += int(0.1 * 0.01 * 1e9)
+        limit.acquire(1)
+    assert limit.rate == MIN_BANDWIDTH
+    # recovers while the vCPUs are not contended
+    time.sleep(0.01)
+    limit.acquire(1)
+    assert limit.rate > MIN_BANDWIDTH
+
+
+def test_run_delay() -> None:
+    run_delay = RunDelay(os.getpid())
+    assert run_delay.threads >= 1
+    assert run_delay.read() >= 0
+    run_delay.close()
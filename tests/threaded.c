@@ -16,21 +16,16 @@ void *test_thread(void* arg) {
 }
 
 void term(int _signum) {
+    // stdio is not async-signal-safe, main() prints the result
     barrier = 0;
-
-    for (size_t i = 0; i < sizeof(thread)/sizeof(thread[0]); i++) {
-        void* result = NULL;
-        pthread_join(thread[i], &result);
-        if (result != NULL) {
-            fprintf(stderr, "thread %zu failed!\n", i);
-        }
-    }
-    puts("OK");
-    fflush(stdout);
-    exit(0);
 }
 
 int main(int argc, char** argv) {
+    // threads
+    struct sigaction action = {};
+    action.sa_handler = term;
+    sigaction(SIGTERM, &action, NULL);
+
     for (size_t i = 0; i < sizeof(thread)/sizeof(thread[0]); i++) {
         int r = pthread_create(&thread[i], NULL, test_thread, NULL);
         if (r != 0) {
@@ -40,11 +35,16 @@ int main(int argc, char** argv) {
     puts("threads started");
     fflush(stdout);
 
-    // threads
-    struct sigaction action = {};
-    action.sa_handler = term;
-    sigaction(SIGTERM, &action, NULL);
-
     test_thread(0);
+
+    for (size_t i = 0; i < sizeof(thread)/sizeof(thread[0]); i++) {
+        void* result = NULL;
+        pthread_join(thread[i], &result);
+        if (result != NULL) {
+            fprintf(stderr, "thread %zu failed!\n", i);
+        }
+    }
+    puts("OK");
+    fflush(stdout);
     return 0;
 }